@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Benchmark for the BlacklistManager, measures how fast chat lines are
+checked against rule sets of different sizes.
+
+The rules and chat lines are generated from a fixed seed, so the results
+can be compared between versions of the matcher.
+
+Run from the repository root: python -m benchmarks.blacklist
+"""
+
+from argparse import ArgumentParser
+from random import Random
+from time import time
+
+from bot.blacklist import BlacklistManager
+
+
+WORDS = (
+    "hello", "hi", "lol", "kappa", "pogchamp", "gg", "wp", "nice", "what",
+    "is", "this", "game", "stream", "chat", "the", "a", "you", "i", "so",
+    "good", "bad", "play", "again", "when", "next", "raid", "sub", "hype",
+    "why", "how", "boss", "fight", "music", "song", "name", "please", "yes",
+    "no", "maybe", "omg", "wow", "clip", "that", "run", "world", "record"
+)
+
+LONG_WORDS = [word for word in WORDS if len(word) > 4]
+
+DOMAINS = ("example", "spam", "free-stuff", "cheap", "clickme", "prizes")
+TLDS = ("com", "net", "org", "tv", "ru")
+
+
+class Rule(object):
+    """Stands in for the blacklist and whitelist database models"""
+
+    def __init__(self, rule_id, match, ban_time="10m"):
+        self.id = rule_id
+        self.match = match
+        self.banTime = ban_time
+
+
+def _make_url(rng):
+    return "{0}{1}.{2}/{3}".format(
+        rng.choice(DOMAINS),
+        rng.randint(0, 9999),
+        rng.choice(TLDS),
+        rng.choice(WORDS)
+    )
+
+
+def make_rules(count, rng):
+    """
+    Generate a rule set with literal and wildcard rules, and a whitelist
+    with entries overlapping some of them
+
+    :param count: Number of blacklist rules
+    :param rng: Random instance
+    :return: Tuple of (blacklist, whitelist)
+    """
+
+    blacklist = []
+    whitelist = []
+
+    for rule_id in range(count):
+        kind = rng.random()
+
+        if kind < 0.5:
+            match = "http://" + _make_url(rng)
+        elif kind < 0.8:
+            match = "http://{0}{1}.{2}/*".format(
+                rng.choice(DOMAINS), rng.randint(0, 9999), rng.choice(TLDS)
+            )
+        else:
+            # Catch words glued together, e.g. to dodge other rules
+            match = "{0}*{1}".format(rng.choice(LONG_WORDS),
+                                     rng.choice(LONG_WORDS))
+
+        blacklist.append(Rule(rule_id, match))
+
+        # Allow a specific page on some of the blocked sites
+        if "/*" in match and rng.random() < 0.2:
+            whitelist.append(Rule(rule_id, match.replace("*", "ok")))
+
+    return blacklist, whitelist
+
+
+def make_lines(count, blacklist, rng):
+    """
+    Generate chat lines of realistic length, some with URLs, some matching
+    the rules, and some repeated like spam
+
+    :param count: Number of lines
+    :param blacklist: The rules, to make some of the lines match
+    :param rng: Random instance
+    :return: List of lines
+    """
+
+    lines = []
+
+    for i in range(count):
+        kind = rng.random()
+
+        if lines and kind < 0.1:
+            # Copypasta, sometimes with Twitch's duplicate message marker
+            line = rng.choice(lines)
+            if rng.random() < 0.5:
+                line += u" \U000E0000"
+            lines.append(line)
+            continue
+
+        words = [rng.choice(WORDS) for j in range(rng.randint(1, 15))]
+
+        if kind < 0.15 and blacklist:
+            match = rng.choice(blacklist).match
+            words.insert(rng.randint(0, len(words)),
+                         match.replace("*", rng.choice(WORDS)))
+        elif kind < 0.3:
+            words.insert(rng.randint(0, len(words)),
+                         "http://" + _make_url(rng))
+
+        lines.append(u" ".join(words))
+
+    return lines
+
+
+def _create_manager(cache_size):
+    """
+    Create a BlacklistManager, older versions have no verdict cache
+
+    :param cache_size: Size of the verdict cache
+    :return: BlacklistManager
+    """
+
+    try:
+        return BlacklistManager(cache_size=cache_size)
+    except TypeError:
+        return BlacklistManager()
+
+
+def _percentile(values, percent):
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def run(rule_counts, line_count, cache_size, seed):
+    """
+    Run the benchmark for each rule set size
+
+    :param rule_counts: List of the numbers of rules to try
+    :param line_count: How many chat lines to check
+    :param cache_size: Size of the verdict cache, 0 to disable
+    :param seed: Seed for generating the rules and lines
+    :return: List of dicts with the results
+    """
+
+    results = []
+
+    for count in rule_counts:
+        rng = Random(seed)
+        blacklist, whitelist = make_rules(count, rng)
+        lines = make_lines(line_count, blacklist, rng)
+
+        manager = _create_manager(cache_size)
+
+        start = time()
+        manager.set_data(blacklist, whitelist)
+        compile_time = time() - start
+
+        timings = []
+        matched = 0
+
+        start = time()
+        for line in lines:
+            before = time()
+            if manager.is_blacklisted(line)[0]:
+                matched += 1
+            timings.append(time() - before)
+        elapsed = time() - start
+
+        timings.sort()
+
+        results.append({
+            "rules": count,
+            "whitelist": len(whitelist),
+            "compile": compile_time,
+            "lines_per_second": len(lines) / elapsed,
+            "p50": _percentile(timings, 50),
+            "p99": _percentile(timings, 99),
+            "matched": matched
+        })
+
+    return results
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description=__doc__)
+    ap.add_argument(
+        "-n", "--lines", type=int, default=20000,
+        help="How many chat lines to check for each rule set"
+    )
+    ap.add_argument(
+        "-r", "--rules", type=int, nargs="+",
+        default=[10, 100, 1000, 10000],
+        help="The rule set sizes to benchmark"
+    )
+    ap.add_argument(
+        "-c", "--cache-size", type=int, default=0,
+        help="Size of the verdict cache, off by default to measure the "
+             "matcher itself"
+    )
+    ap.add_argument(
+        "-s", "--seed", type=int, default=1,
+        help="Seed for generating the rules and chat lines"
+    )
+    options = ap.parse_args()
+
+    print(u"{0:>7} {1:>9} {2:>11} {3:>10} {4:>10} {5:>10} {6:>8}".format(
+        "rules", "whitelist", "compile ms", "lines/s", "p50 us", "p99 us",
+        "matched"
+    ))
+
+    for result in run(options.rules, options.lines, options.cache_size,
+                      options.seed):
+        print(u"{rules:>7} {whitelist:>9} {compile:>11.1f} "
+              u"{lines_per_second:>10.0f} {p50:>10.1f} {p99:>10.1f} "
+              u"{matched:>8}".format(
+                  rules=result["rules"],
+                  whitelist=result["whitelist"],
+                  compile=result["compile"] * 1000,
+                  lines_per_second=result["lines_per_second"],
+                  p50=result["p50"] * 1000000,
+                  p99=result["p99"] * 1000000,
+                  matched=result["matched"]
+              ))
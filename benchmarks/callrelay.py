@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Microbenchmark for the CallRelay, measures how many relayed calls per
+second the loop gets through.
+
+Run from the repository root: python -m benchmarks.callrelay
+"""
+
+from argparse import ArgumentParser
+from threading import Thread
+from time import time
+import logging
+
+from bot.utils import ThreadCallRelay
+
+
+class Target(object):
+    """Call object that does as little work as possible"""
+
+    def __init__(self):
+        self.values = {}
+
+    def noop(self, value):
+        return value
+
+    def record(self, value):
+        self.values[None] = value
+
+    def store(self, channel, key, value):
+        self.values[(channel, key)] = value
+
+    def store_batch(self, calls):
+        for channel, key, value in calls:
+            self.values[(channel, key)] = value
+
+
+def _start(logger):
+    relay = ThreadCallRelay(logger, fire_and_forget=("store", "record"))
+    relay.set_call_object(Target())
+
+    thread = Thread(target=relay.loop)
+    thread.daemon = True
+    thread.start()
+
+    return relay, thread
+
+
+def _stop(relay, thread):
+    relay.stop()
+    thread.join()
+
+
+def bench_blocking(relay, calls):
+    for i in range(calls):
+        relay.noop(i)
+
+
+def bench_threads(relay, calls, threads=4):
+    def caller():
+        for i in range(calls // threads):
+            relay.noop(i)
+
+    workers = [Thread(target=caller) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def bench_fire_and_forget(relay, calls):
+    for i in range(calls):
+        relay.store("#channel", "key{0}".format(i % 10), i)
+
+    # Wait for the loop to get through all of them
+    relay.noop(None)
+
+
+def bench_unbatched(relay, calls):
+    for i in range(calls):
+        relay.record(i)
+
+    relay.noop(None)
+
+
+BENCHMARKS = (
+    ("blocking", bench_blocking),
+    ("blocking, 4 threads", bench_threads),
+    ("fire and forget", bench_unbatched),
+    ("fire and forget, batched", bench_fire_and_forget),
+)
+
+
+def run(calls, logger):
+    """
+    Run all the benchmarks
+
+    :param calls: How many calls to make in each benchmark
+    :param logger: The logger given to the relays
+    :return: List of (name, calls per second)
+    """
+
+    results = []
+
+    for name, benchmark in BENCHMARKS:
+        relay, thread = _start(logger)
+
+        start = time()
+        benchmark(relay, calls)
+        elapsed = time() - start
+
+        _stop(relay, thread)
+        results.append((name, calls / elapsed))
+
+    return results
+
+
+if __name__ == "__main__":
+    ap = ArgumentParser(description=__doc__)
+    ap.add_argument(
+        "-n", "--calls", type=int, default=50000,
+        help="How many calls to make in each benchmark"
+    )
+    options = ap.parse_args()
+
+    # Like in production, with debug output disabled
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    for name, rate in run(options.calls, logger):
+        print(u"{0:<24} {1:>10.0f} calls/s".format(name, rate))
@@ -1,7 +1,7 @@
 import os
 import time
 from threading import Thread
-from .bot import Bot
+from .bot import Bot, BOT_FIRE_AND_FORGET
 from .ircwrapper import IRCWrapper
 from .utils import log, set_log_file
 from .utils import ThreadCallRelay
@@ -17,19 +17,41 @@ if __name__ == "__main__":
     # Set LUA_PATH environment variable so our Lua code can find the libraries
     os.environ["LUA_PATH"] = settings.LUA_PATH
 
-    wrapper = ThreadCallRelay()
-    bot = Bot(settings, wrapper=wrapper, irc_wrapper=IRCWrapper, logger=log)
-    wrapper.set_call_object(bot)
-
-    def run():
-        bot.run()
-
-    thread = Thread(target=run)
-    thread.daemon = True
-    thread.start()
+    irc_wrapper = IRCWrapper
+    if settings.CHANNELS_PER_CONNECTION:
+        from .ircpool import IRCConnectionPool
+        irc_wrapper = IRCConnectionPool
+
+    if settings.WORKER_PROCESSES:
+        # The channels are handled in worker processes, only IRC runs here
+        from .workers import WorkerPool
+        workers = WorkerPool(settings, log)
+        workers.start(irc_wrapper)
+        stop = workers.stop
+    else:
+        wrapper = ThreadCallRelay(fire_and_forget=BOT_FIRE_AND_FORGET)
+
+        if settings.IRC_TRANSPORT == "asyncio":
+            # Thread safe on its own, so no need to relay calls to it
+            from .aioirc import AsyncIRCWrapper
+            bot = Bot(settings, wrapper=wrapper,
+                      irc_wrapper=AsyncIRCWrapper, logger=log,
+                      wrap_irc=False)
+        else:
+            bot = Bot(settings, wrapper=wrapper, irc_wrapper=irc_wrapper,
+                      logger=log)
+        wrapper.set_call_object(bot)
+
+        def run():
+            bot.run()
+
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        stop = wrapper.stop
 
     try:
         while True:
             time.sleep(1)
     finally:
-        wrapper.stop()
\ No newline at end of file
+        stop()
\ No newline at end of file
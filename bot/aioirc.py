@@ -0,0 +1,475 @@
+"""
+asyncio based IRC transport, an alternative to the thread based IRCWrapper.
+
+The whole connection runs on a single event loop: a reader coroutine parses
+the incoming lines and dispatches the events, and a writer coroutine sends
+the queued messages as the rate limits allow. Requires Python 3.5 or newer.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from time import time
+
+import irc.events
+import irc.modes
+from irc.bot import Channel
+from irc.client import Event, NickMask, is_channel
+
+from .ircwrapper import BaseIRCWrapper
+from .outbound import PRIORITY_COMMAND
+
+# Escape sequences used in IRCv3 tag values
+TAG_ESCAPES = {
+    ":": ";",
+    "s": " ",
+    "\\": "\\",
+    "r": "\r",
+    "n": "\n"
+}
+
+
+def unescape_tag_value(value):
+    """
+    Convert an escaped IRCv3 tag value to the actual value
+
+    >>> from bot.aioirc import unescape_tag_value
+    >>> unescape_tag_value("Hello\\\\sworld\\\\:")
+    'Hello world;'
+
+    :param value: The raw value
+    :return: The unescaped value
+    """
+
+    result = []
+    escaped = False
+
+    for char in value:
+        if escaped:
+            result.append(TAG_ESCAPES.get(char, char))
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        else:
+            result.append(char)
+
+    return "".join(result)
+
+
+def parse_line(line):
+    """
+    Parse a raw line from the server into an event like the ones
+    irc.client produces
+
+    >>> from bot.aioirc import parse_line
+    >>> e = parse_line("@mod=1 :foo!foo@foo.tmi.twitch.tv PRIVMSG #bar :hi")
+    >>> e.type, e.source.nick, e.target, e.arguments, e.tags
+    ('pubmsg', 'foo', '#bar', ['hi'], [{'key': 'mod', 'value': '1'}])
+    >>> parse_line(":tmi.twitch.tv 001 foo :Welcome, GLHF!").type
+    'welcome'
+
+    :param line: The line without the trailing newline
+    :return: An irc.client.Event
+    """
+
+    tags = None
+    if line.startswith("@"):
+        raw_tags, line = line[1:].split(" ", 1)
+        tags = []
+        for raw_tag in raw_tags.split(";"):
+            key, _, value = raw_tag.partition("=")
+            tags.append({"key": key, "value": unescape_tag_value(value)})
+
+    source = None
+    if line.startswith(":"):
+        prefix, line = line[1:].split(" ", 1)
+        source = NickMask(prefix)
+
+    if " :" in line:
+        line, trailing = line.split(" :", 1)
+        params = line.split() + [trailing]
+    else:
+        params = line.split()
+
+    command = params.pop(0).lower()
+    command = irc.events.numeric.get(command, command)
+
+    target = None
+    if params:
+        target = params.pop(0)
+
+    # Split messages and notices by target like irc.client does
+    if command == "privmsg" and is_channel(target):
+        command = "pubmsg"
+    elif command == "notice":
+        if is_channel(target):
+            command = "pubnotice"
+        else:
+            command = "privnotice"
+
+    return Event(command, source, target, params, tags)
+
+
+class AsyncConnection(object):
+    """
+    The parts of irc.client.ServerConnection the event handlers use,
+    on top of an asyncio StreamWriter
+    """
+
+    def __init__(self, writer, nickname):
+        self.writer = writer
+        self.nickname = nickname
+
+    def send_raw(self, line):
+        """
+        Send a single line to the server
+
+        :param line: The line without the trailing newline
+        :return: None
+        """
+
+        self.writer.write((line + "\r\n").encode("utf-8"))
+
+    def privmsg(self, target, text):
+        self.send_raw("PRIVMSG {0} :{1}".format(target, text))
+
+    def join(self, channel, key=""):
+        self.send_raw("JOIN {0}{1}".format(channel, key and " " + key))
+
+    def part(self, channel):
+        self.send_raw("PART {0}".format(channel))
+
+    def cap(self, subcommand, *args):
+        if args:
+            self.send_raw("CAP {0} :{1}".format(subcommand, " ".join(args)))
+        else:
+            self.send_raw("CAP {0}".format(subcommand))
+
+    def pong(self, target):
+        self.send_raw("PONG :{0}".format(target))
+
+    def get_nickname(self):
+        return self.nickname
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncIRCWrapper(BaseIRCWrapper):
+    """
+    IRC wrapper that runs the connection on an asyncio event loop instead of
+    separate IRC and outbound threads, with the same API the Bot uses.
+
+    The loop runs on its own thread so start() returns right away like with
+    the IRCWrapper. message() and the other public methods are safe to call
+    from other threads, so the Bot can use this without wrapping it in a
+    ThreadCallRelay. Chat messages are relayed to the Bot from a single
+    dispatcher thread so a busy Bot never stalls the loop.
+    """
+
+    reconnection_interval = 15
+
+    def __init__(self, logger=None, bot=None, settings=None, channelList=None,
+                 nickname=None,
+                 server=None, password=None,
+                 port=6667, commandPrefix='!'):
+
+        self._setup(logger, bot, settings, channelList, commandPrefix)
+
+        self.nickname = nickname
+        self.server = server
+        self.password = password
+        self.port = port
+
+        self.channels = {}
+        self.connection = None
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
+        self.running = False
+        self.dispatcher = ThreadPoolExecutor(max_workers=1)
+
+    # Public API
+
+    def start(self):
+        """
+        Start the event loop thread, which connects to the server
+
+        :return: None
+        """
+
+        self.loop = asyncio.new_event_loop()
+        self.running = True
+
+        self.loop_thread = Thread(target=self._run_loop)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
+
+    def stop(self):
+        """
+        Disconnect and stop the event loop
+
+        :return: None
+        """
+
+        self.running = False
+        self.queue.close()
+
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._disconnect)
+
+        if self.call_relay:
+            self.call_relay.stop()
+
+    def message(self, channel, message, priority=PRIORITY_COMMAND):
+        """
+        Request to send a message to the channel, request is placed in output
+        buffering task queue.
+
+        :param channel: The channel to send the message to
+        :param message: The message to be sent
+        :param priority: Which outbound lane to use, one of the
+                         bot.outbound.PRIORITY_* constants
+        :return: None
+        """
+
+        super(AsyncIRCWrapper, self).message(channel, message, priority)
+        self._wake_writer()
+
+    # Event loop
+
+    def _run_loop(self):
+        """
+        Run the event loop until stopped, on the loop thread
+
+        :return: None
+        """
+
+        asyncio.set_event_loop(self.loop)
+        self.wakeup = asyncio.Event()
+
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+
+    async def _run(self):
+        """
+        Stay connected to the server, reconnecting after a delay when
+        disconnected
+
+        :return: None
+        """
+
+        while self.running:
+            try:
+                await self._connect_and_serve()
+            except (OSError, EOFError) as e:
+                self.logger.warn(u"IRC connection failed: {0}".format(e))
+
+            if self.running:
+                await asyncio.sleep(self.reconnection_interval)
+
+    async def _connect_and_serve(self):
+        """
+        Connect to the server and process the connection until it closes
+
+        :return: None
+        """
+
+        reader, writer = await asyncio.open_connection(self.server, self.port)
+        self.connection = AsyncConnection(writer, self.nickname)
+
+        if self.password:
+            self.connection.send_raw("PASS {0}".format(self.password))
+        self.connection.send_raw("NICK {0}".format(self.nickname))
+        self.connection.send_raw("USER {0} 0 * :{0}".format(self.nickname))
+
+        writer_task = asyncio.ensure_future(self._write_loop())
+
+        try:
+            await self._read_loop(reader)
+        finally:
+            writer_task.cancel()
+            self.connection.close()
+            self.channels = {}
+
+            event = Event("disconnect", None, self.server)
+            self.on_disconnect(self.connection, event)
+
+    async def _read_loop(self, reader):
+        """
+        Read and dispatch the lines sent by the server
+
+        :param reader: asyncio StreamReader for the connection
+        :return: None
+        """
+
+        while self.running:
+            raw = await reader.readline()
+            if not raw:
+                return
+
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if not line:
+                continue
+
+            # A bad line or a failing handler must not drop the connection
+            try:
+                self._handle_event(parse_line(line))
+            except Exception:
+                self.logger.error(u"Error handling line {0}".format(line),
+                                  exc_info=True)
+
+    async def _write_loop(self):
+        """
+        Send the queued messages as the rate limits allow
+
+        :return: None
+        """
+
+        while True:
+            # Clear before polling, so a wakeup for a message queued after
+            # the poll is not lost
+            self.wakeup.clear()
+            task, wait = self.queue.poll(self._acquire_send)
+
+            if task is not None:
+                self._process_task(task)
+                await self.connection.writer.drain()
+                continue
+
+            if self.queue.closed:
+                return
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _wake_writer(self):
+        """
+        Tell the writer coroutine there might be something to send, can be
+        called from any thread
+
+        :return: None
+        """
+
+        if self.loop and self.wakeup:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def _call_later(self, delay, function):
+        """
+        Call the function on the loop thread after a delay
+
+        :param delay: Seconds to wait
+        :param function: Function to call without arguments
+        :return: None
+        """
+
+        self.loop.call_later(delay, function)
+
+    def _disconnect(self):
+        """
+        Close the connection, on the loop thread
+
+        :return: None
+        """
+
+        if self.wakeup:
+            self.wakeup.set()
+
+        if self.connection:
+            self.connection.close()
+
+    # Event handling
+
+    def _handle_event(self, event):
+        """
+        Track the channel state and call the on_* handler for the event
+
+        :param event: An irc.client.Event
+        :return: None
+        """
+
+        if event.type == "ping":
+            self.connection.pong(event.target)
+            return
+
+        self._track_channels(event)
+
+        if event.type == "pubmsg":
+            # Relaying to the Bot may block, keep it off the loop
+            self.dispatcher.submit(
+                self._dispatch, self.on_pubmsg, event, time()
+            )
+            return
+
+        handler = getattr(self, "on_" + event.type, None)
+        if handler:
+            handler(self.connection, event)
+
+    def _dispatch(self, handler, event, timestamp):
+        """
+        Run a message handler on the dispatcher thread
+
+        :param handler: The on_* handler
+        :param event: The event
+        :param timestamp: When the event was received
+        :return: None
+        """
+
+        try:
+            handler(self.connection, event, timestamp)
+        except Exception:
+            self.logger.error(u"Error handling {0}".format(event.type),
+                              exc_info=True)
+
+    def _track_channels(self, event):
+        """
+        Keep the channels and their users and operators up to date, the
+        same way irc.bot.SingleServerIRCBot does
+
+        :param event: An irc.client.Event
+        :return: None
+        """
+
+        me = self.connection.get_nickname()
+
+        if event.type == "join":
+            nick = event.source.nick
+            if nick.lower() == me.lower():
+                self.channels[event.target] = Channel()
+            if event.target in self.channels:
+                self.channels[event.target].add_user(nick)
+
+        elif event.type == "part":
+            nick = event.source.nick
+            if nick.lower() == me.lower():
+                self.channels.pop(event.target, None)
+            elif event.target in self.channels:
+                self.channels[event.target].remove_user(nick)
+
+        elif event.type == "namreply":
+            channel = self.channels.get(event.arguments[1])
+            if channel is None:
+                return
+
+            for nick in event.arguments[2].split():
+                if nick[0] in "@+":
+                    if nick[0] == "@":
+                        channel.set_mode("o", nick[1:])
+                    nick = nick[1:]
+                channel.add_user(nick)
+
+        elif event.type == "mode":
+            channel = self.channels.get(event.target)
+            if channel is None:
+                return
+
+            modes = irc.modes.parse_channel_modes(" ".join(event.arguments))
+            for sign, mode, argument in modes:
+                if sign == "+":
+                    channel.set_mode(mode, argument)
+                else:
+                    channel.clear_mode(mode, argument)
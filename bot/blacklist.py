@@ -1,4 +1,532 @@
 import re
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class VerdictCache(object):
+    """
+    Least recently used cache of the is_blacklisted() results for the
+    lines seen recently, so repeated spam is only checked once
+
+    >>> from bot.blacklist import VerdictCache
+    >>> cache = VerdictCache(2)
+    >>> cache.put("a", 1)
+    >>> cache.put("b", 2)
+    >>> cache.get("a")
+    1
+    >>> cache.put("c", 3)
+    >>> cache.get("b") is None, cache.get("a"), cache.get("c")
+    (True, 1, 3)
+    """
+
+    def __init__(self, size=1000):
+        """
+        :param size: Maximum number of lines to remember, 0 to disable
+        """
+
+        self.size = size
+        self.lock = Lock()
+        self.verdicts = OrderedDict()
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, line):
+        """
+        Get the cached verdict for the line
+
+        :param line: The normalized line
+        :return: The verdict, or None if not cached
+        """
+
+        with self.lock:
+            verdict = self.verdicts.pop(line, None)
+
+            if verdict is None:
+                self.misses += 1
+                return None
+
+            # Move it to the end, as the most recently used
+            self.verdicts[line] = verdict
+            self.hits += 1
+
+            return verdict
+
+    def put(self, line, verdict, generation=None):
+        """
+        Remember the verdict for the line, forgetting the least recently
+        used one if the cache is full
+
+        :param line: The normalized line
+        :param verdict: The is_blacklisted() result
+        :param generation: The generation the verdict was made in, it's not
+                           stored if the cache has been cleared since
+        :return: None
+        """
+
+        if not self.size:
+            return
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self.verdicts.pop(line, None)
+            self.verdicts[line] = verdict
+
+            while len(self.verdicts) > self.size:
+                self.verdicts.popitem(last=False)
+
+    def clear(self):
+        """
+        Forget all the verdicts, e.g. when the rules change
+
+        :return: None
+        """
+
+        with self.lock:
+            self.verdicts.clear()
+            self.generation += 1
+
+    def get_stats(self):
+        """
+        Get how often the cache had the verdict
+
+        :return: Dict with "size", "hits", "misses" and "hit_rate"
+        """
+
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            hit_rate = 0.0
+            if lookups:
+                hit_rate = float(self.hits) / lookups
+
+            return {
+                "size": len(self.verdicts),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate
+            }
+
+
+class RuleStats(object):
+    """
+    How often a blacklist rule has matched, and how long finding out which
+    rule matched took
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.overrides = 0
+        self.total_time = 0.0
+
+    def as_dict(self):
+        """
+        Get the counters
+
+        :return: Dict with "hits", "overrides", "total_time" and
+                 "average_time"
+        """
+
+        average_time = 0.0
+        if self.hits:
+            average_time = self.total_time / self.hits
+
+        return {
+            "hits": self.hits,
+            "overrides": self.overrides,
+            "total_time": self.total_time,
+            "average_time": average_time
+        }
+
+
+class RuleMatcher(object):
+    """
+    Tells with a single regex search if any of a set of rules matches
+    anywhere in a line.
+
+    The rules are merged into a trie, so rules sharing a beginning, like
+    most URLs do, are only tried once per position. A rule that is a
+    prefix of another one makes the longer one redundant, as whenever the
+    longer one matches so does the shorter one.
+
+    Rules can be added and removed one at a time, which only touches
+    their own path in the trie. compile() then builds the regex.
+
+    >>> from bot.blacklist import RuleMatcher
+    >>> matcher = RuleMatcher(["http://a.com/*/x", "http://a.com/b", "foo"])
+    >>> bool(matcher.search("see http://a.com/zzz/x")), matcher.search("a")
+    (True, None)
+    >>> matcher.remove("foo")
+    >>> matcher.compile() and matcher.search("foo")
+    """
+
+    # Marks the end of a rule in the trie, with the number of rules ending
+    # there
+    END = None
+
+    # Stands for a * in a rule
+    WILDCARD = ""
+
+    def __init__(self, rules=()):
+        """
+        :param rules: List of the rule match strings, * is a wildcard for
+                      any amount of non-whitespace
+        """
+
+        self.trie = {}
+        self.pattern = None
+        self.regex = None
+
+        for rule in rules:
+            self.add(rule)
+
+        self.compile()
+
+    def add(self, rule):
+        """
+        Add a rule, call compile() to start using it
+
+        :param rule: The rule match string
+        :return: None
+        """
+
+        node = self.trie
+        for token in self._tokens(rule):
+            node = node.setdefault(token, {})
+
+        node[self.END] = node.get(self.END, 0) + 1
+
+    def remove(self, rule):
+        """
+        Remove a rule added earlier, call compile() to stop using it
+
+        :param rule: The rule match string
+        :return: None
+        """
+
+        path = []
+        node = self.trie
+
+        for token in self._tokens(rule):
+            if token not in node:
+                return
+            path.append((node, token))
+            node = node[token]
+
+        if self.END not in node:
+            return
+
+        node[self.END] -= 1
+        if node[self.END]:
+            return
+
+        del node[self.END]
+
+        # Prune the branches no other rule uses
+        for parent, token in reversed(path):
+            if parent[token]:
+                break
+            del parent[token]
+
+    def compile(self):
+        """
+        Build the regex from the rules currently in the trie
+
+        :return: The compiled regex, None if there are no rules
+        """
+
+        if self.trie:
+            self.pattern = self._to_regex(self.trie)
+            self.regex = re.compile(self.pattern)
+        else:
+            self.pattern = None
+            self.regex = None
+
+        return self.regex
+
+    def search(self, line):
+        """
+        Check if any of the rules matches the line
+
+        :param line: The text to check
+        :return: A match object, or None if no rule matches
+        """
+
+        if self.regex is None:
+            return None
+
+        return self.regex.search(line)
+
+    def _tokens(self, rule):
+        """
+        Split a rule into the tokens used in the trie
+
+        :param rule: The rule match string
+        :return: List of characters and WILDCARDs
+        """
+
+        return [self.WILDCARD if char == "*" else char for char in rule]
+
+    def _to_regex(self, node):
+        """
+        Convert a trie node to a regular expression matching the rules under
+        it
+
+        :param node: Dict of token to child node
+        :return: Regex as a string
+        """
+
+        result = []
+
+        # Follow the parts with no branches without recursing, rules can be
+        # long
+        while self.END not in node and len(node) == 1:
+            token, node = next(iter(node.items()))
+            result.append(self._token_regex(token))
+
+        # A rule ends here, anything longer under this node is redundant
+        if self.END in node:
+            return "".join(result)
+
+        alternatives = [
+            self._token_regex(token) + self._to_regex(child)
+            for token, child in sorted(node.items())
+        ]
+
+        result.append("(?:" + "|".join(alternatives) + ")")
+        return "".join(result)
+
+    def _token_regex(self, token):
+        """
+        Get the regular expression for a single character of a rule
+
+        :param token: The character, or WILDCARD
+        :return: Regex as a string
+        """
+
+        if token == self.WILDCARD:
+            return "[^\\s]*"
+
+        return re.escape(token)
+
+
+class RuleSnapshot(object):
+    """
+    The rules of a RuleSet at one point in time, never changed afterwards
+    """
+
+    __slots__ = ("rules", "regex", "prefixes")
+
+    def __init__(self, rules, regex, prefixes=None):
+        """
+        :param rules: Tuple of the rules in the order they were added
+        :param regex: The compiled combined regex, None if there are no
+                      rules
+        :param prefixes: Trie of the text the rules start with, listing the
+                         indexes of the rules under RuleMatcher.END
+        """
+
+        self.rules = rules
+        self.regex = regex
+        self.prefixes = prefixes
+
+    def search(self, line, pos=0):
+        """
+        Check if any of the rules matches the line
+
+        :param line: The text to check
+        :param pos: Where in the line to start looking
+        :return: A match object, or None if no rule matches
+        """
+
+        if self.regex is None:
+            return None
+
+        return self.regex.search(line, pos)
+
+    def match_rule(self, line, pos):
+        """
+        Find the first rule that matches at the given position of the line,
+        the same one an alternation of all the rules in order would
+
+        Only the rules starting with the text at the position are tried, so
+        rules sharing a beginning, like most URLs do, don't all have to be
+        tried one by one.
+
+        :param line: The text to check
+        :param pos: Where in the line the match must start
+        :return: Tuple of (rule, matched text), or None if no rule matches
+        """
+
+        end = RuleMatcher.END
+        node = self.prefixes
+        candidates = list(node.get(end, ()))
+
+        for char in line[pos:]:
+            node = node.get(char)
+            if node is None:
+                break
+            candidates.extend(node.get(end, ()))
+
+        for index in sorted(candidates):
+            rule = self.rules[index]
+            match = rule.regex.match(line, pos)
+            if match:
+                return rule, match.group(1)
+
+        return None
+
+
+class RuleSet(object):
+    """
+    Black- or whitelist rules indexed by their integer ID, in the order they
+    were added.
+
+    Every change publishes a new RuleSnapshot by replacing the snapshot
+    attribute. A reader that takes the snapshot once sees a consistent set
+    of rules and the matching combined regex, even if the rules are
+    changed by another thread in the middle.
+
+    >>> from bot.blacklist import RuleSet
+    >>> class Rule(object):
+    ...     def __init__(self, id, match):
+    ...         self.id, self.match = id, match
+    >>> rules = RuleSet([Rule(1, "foo"), Rule(2, "bar")])
+    >>> rules.remove("1")
+    True
+    >>> [rule.id for rule in rules.snapshot.rules]
+    [2]
+    >>> bool(rules.snapshot.search("foo")), bool(rules.snapshot.search("bar"))
+    (False, True)
+    """
+
+    def __init__(self, rules=(), find_rules=False):
+        """
+        :param rules: List of the rules, with id and match attributes
+        :param find_rules: Also index the rules by the text they start
+                           with, for RuleSnapshot.match_rule()
+        """
+
+        self.find_rules = find_rules
+        self.lock = Lock()
+        self.rules = OrderedDict()
+        self.matcher = RuleMatcher()
+        self.snapshot = RuleSnapshot((), None)
+
+        self.replace(rules)
+
+    def replace(self, rules):
+        """
+        Replace all the rules
+
+        :param rules: List of the rules
+        :return: None
+        """
+
+        with self.lock:
+            self.rules = OrderedDict(
+                (self._get_id(rule.id), rule) for rule in rules
+            )
+            self.matcher = RuleMatcher(
+                [rule.match for rule in self.rules.values()]
+            )
+            self._publish()
+
+    def add(self, rule):
+        """
+        Add a rule, or replace the one with the same ID
+
+        :param rule: The rule
+        :return: None
+        """
+
+        rule_id = self._get_id(rule.id)
+
+        with self.lock:
+            old = self.rules.pop(rule_id, None)
+            if old is not None:
+                self.matcher.remove(old.match)
+
+            self.rules[rule_id] = rule
+            self.matcher.add(rule.match)
+            self._publish()
+
+    def remove(self, rule_id):
+        """
+        Remove a rule
+
+        :param rule_id: The ID of the rule, as a number or a string
+        :return: True if the rule was removed, False if there's no such rule
+        """
+
+        try:
+            rule_id = self._get_id(rule_id)
+        except ValueError:
+            return False
+
+        with self.lock:
+            rule = self.rules.pop(rule_id, None)
+            if rule is None:
+                return False
+
+            self.matcher.remove(rule.match)
+            self._publish()
+
+        return True
+
+    def __len__(self):
+        return len(self.snapshot.rules)
+
+    def _get_id(self, rule_id):
+        """
+        Convert a rule ID to the integer the rules are indexed by, e.g. when
+        it comes from the chat as a string
+
+        :param rule_id: The ID
+        :return: The ID as an integer
+        :raise ValueError: If the ID is not a number
+        """
+
+        return int(rule_id)
+
+    def _publish(self):
+        """
+        Replace the snapshot after a change, the caller must hold the lock
+
+        :return: None
+        """
+
+        rules = tuple(self.rules.values())
+        regex = self.matcher.compile()
+
+        prefixes = None
+        if self.find_rules:
+            prefixes = self._index_prefixes(rules)
+
+        self.snapshot = RuleSnapshot(rules, regex, prefixes)
+
+    def _index_prefixes(self, rules):
+        """
+        Build a trie of the text before the first * of every rule
+
+        :param rules: Tuple of the rules
+        :return: The trie, with the rule indexes listed under
+                 RuleMatcher.END
+        """
+
+        trie = {}
+
+        for index, rule in enumerate(rules):
+            node = trie
+            for char in rule.match.split("*", 1)[0]:
+                node = node.setdefault(char, {})
+            node.setdefault(RuleMatcher.END, []).append(index)
+
+        return trie
 
 
 class BlacklistManager(object):
@@ -6,14 +534,47 @@ class BlacklistManager(object):
     Manager for blacklist and whitelist functionalities
     """
 
+    # How get_top_rules() can order the rules, as sort keys for the
+    # get_rule_stats() dicts and whether the biggest come first
+    rule_orders = {
+        "hot": (lambda stats: stats["hits"], True),
+        "cold": (lambda stats: stats["hits"], False),
+        "slow": (lambda stats: stats["total_time"], True)
+    }
+
     rule_regexp = "({rule})"
     rule_until_whitespace_regexp = "({rule}[^\s]*)"
 
-    def __init__(self, logger=None):
+    # Twitch clients add this after a space to send the same message again
+    normalize_regexp = re.compile(u"[\\s\U000E0000]+$")
+
+    def __init__(self, logger=None, cache_size=1000, clock=time):
         self.logger = logger
-        self.blacklist = []
-        self.whitelist = []
+        self.clock = clock
+        self.blacklist_rules = RuleSet(find_rules=True)
+        self.whitelist_rules = RuleSet()
+        self.verdicts = VerdictCache(cache_size)
+
+        # Per blacklist rule ID, and for all the lines checked
+        self.rule_stats = {}
+        self.lines = 0
+        self.line_time = 0.0
+
+    @property
+    def blacklist(self):
+        """
+        The blacklist rules, in the order they are checked
+        :return:
+        """
+        return list(self.blacklist_rules.snapshot.rules)
 
+    @property
+    def whitelist(self):
+        """
+        The whitelist rules, in the order they are checked
+        :return:
+        """
+        return list(self.whitelist_rules.snapshot.rules)
 
     def set_data(self, blacklist=None, whitelist=None):
         """
@@ -24,10 +585,17 @@ class BlacklistManager(object):
         """
 
         if blacklist is not None:
-            self.blacklist = self._compile_rules(blacklist, True)
+            self.blacklist_rules.replace(self._compile_rules(blacklist, True))
+
+            self.rule_stats = dict(
+                (rule.id, self.rule_stats.get(rule.id, RuleStats()))
+                for rule in self.blacklist
+            )
 
         if whitelist is not None:
-            self.whitelist = self._compile_rules(whitelist)
+            self.whitelist_rules.replace(self._compile_rules(whitelist))
+
+        self.verdicts.clear()
 
     def add_blacklist(self, rule):
         """
@@ -35,7 +603,9 @@ class BlacklistManager(object):
         :param rule:
         :return:
         """
-        self.blacklist = self.blacklist + self._compile_rules([rule], True)
+        self.blacklist_rules.add(self._compile_rules([rule], True)[0])
+        self.rule_stats[rule.id] = RuleStats()
+        self.verdicts.clear()
 
     def add_whitelist(self, rule):
         """
@@ -43,40 +613,134 @@ class BlacklistManager(object):
         :param rule:
         :return:
         """
-        self.whitelist = self.whitelist + self._compile_rules([rule])
+        self.whitelist_rules.add(self._compile_rules([rule])[0])
+        self.verdicts.clear()
 
     def remove_blacklist(self, rule_id):
         """
         Remove a rule from the blacklist
-        :param rule_id:
-        :return:
+        :param rule_id: The rule ID, as a number or a string from the chat
+        :return: True if the rule was removed
         """
-        self.blacklist = [
-            item
-            for item in self.blacklist
-            if item.id != rule_id
-        ]
+        if not self.blacklist_rules.remove(rule_id):
+            return False
+
+        self.rule_stats.pop(int(rule_id), None)
+        self.verdicts.clear()
+        return True
 
     def remove_whitelist(self, rule_id):
         """
         Remove a rule from the whitelist
-        :param rule_id:
-        :return:
+        :param rule_id: The rule ID, as a number or a string from the chat
+        :return: True if the rule was removed
         """
-        self.whitelist = [
-            item
-            for item in self.whitelist
-            if item.id != rule_id
-        ]
+        if not self.whitelist_rules.remove(rule_id):
+            return False
+
+        self.verdicts.clear()
+        return True
 
     def is_blacklisted(self, line):
         """
-        Check if anything on this line is blacklisted
+        Check if anything on this line is blacklisted. Trailing whitespace
+        and Twitch's invisible duplicate message marker are ignored, so
+        the copies of the same spam share the cached verdict.
         :param line:
         :return:
         """
 
-        blacklist_hits = self._get_blacklist_hits(line)
+        line = self.normalize_regexp.sub(u"", line)
+
+        # Taken before the rules, so a verdict for rules that have since
+        # changed is not cached
+        generation = self.verdicts.generation
+        verdict = self.verdicts.get(line)
+
+        if verdict is None:
+            start = self.clock()
+            verdict = self._check_line(line)
+            self.line_time += self.clock() - start
+            self.lines += 1
+
+            self.verdicts.put(line, verdict, generation)
+        elif verdict[0]:
+            # The rule fired again, even if it didn't need to be checked
+            self._get_rule_stats(verdict[1]).hits += 1
+
+        return verdict
+
+    def get_rule_stats(self):
+        """
+        Get the counters of every blacklist rule, e.g. to find the rules
+        that never match or cost the most
+        :return: List of dicts with "id", "match", "ban_time" and the
+                 RuleStats counters
+        """
+
+        result = []
+
+        for rule in self.blacklist:
+            stats = self._get_rule_stats(rule.id).as_dict()
+            stats["id"] = rule.id
+            stats["match"] = rule.match
+            stats["ban_time"] = rule.banTime
+            result.append(stats)
+
+        return result
+
+    def get_top_rules(self, order="hot", count=5):
+        """
+        Get the rules that match the most (hot) or the least (cold), or took
+        the most time to check (slow)
+        :param order: "hot", "cold" or "slow"
+        :param count: How many rules to return
+        :return: List of get_rule_stats() dicts
+        """
+
+        key, reverse = self.rule_orders[order]
+
+        # Sorts are stable, on ties the oldest rules come first
+        rules = sorted(self.get_rule_stats(), key=key, reverse=reverse)
+
+        return rules[:count]
+
+    def get_line_stats(self):
+        """
+        Get how many lines have been checked against the rules and how long
+        it took, not counting the cached verdicts
+        :return: Dict with "lines", "total_time" and "average_time"
+        """
+
+        average_time = 0.0
+        if self.lines:
+            average_time = self.line_time / self.lines
+
+        return {
+            "lines": self.lines,
+            "total_time": self.line_time,
+            "average_time": average_time
+        }
+
+    def get_cache_stats(self):
+        """
+        Get how often the verdict for a line was cached
+        :return: Dict of counters
+        """
+
+        return self.verdicts.get_stats()
+
+    def _check_line(self, line):
+        """
+        Check the line against the black- and whitelist
+        :param line:
+        :return:
+        """
+
+        blacklist_hits = self._get_blacklist_hits(
+            line, self.blacklist_rules.snapshot
+        )
+        whitelist = self.whitelist_rules.snapshot
 
         matched = False
         matched_rule = None
@@ -87,13 +751,14 @@ class BlacklistManager(object):
                 id=rule_id,
                 match=match
             ))
-            whitelist_id = self._is_on_whitelist(match)
+            whitelist_id = self._is_on_whitelist(match, whitelist)
             if not whitelist_id:
                 if not matched_ban_time or ban_time > matched_ban_time:
                     matched = True
                     matched_rule = rule_id
                     matched_ban_time = ban_time
             else:
+                self._get_rule_stats(rule_id).overrides += 1
                 self._log("However whitelist rule #{id} also matches".format(
                     id=whitelist_id
                 ))
@@ -132,36 +797,80 @@ class BlacklistManager(object):
         result = result.replace("\\*", "[^\s]*")
         return result
 
-    def _get_blacklist_hits(self, line):
+    def _get_blacklist_hits(self, line, snapshot=None):
         """
         Get any and all occurrences of strings matching the blacklist in the
         text given
         :param line:
+        :param snapshot: RuleSnapshot of the blacklist to use
         :return:
         """
 
+        if snapshot is None:
+            snapshot = self.blacklist_rules.snapshot
+
         result = []
+        clock = self.clock
+        pos = 0
 
-        for rule in self.blacklist:
-            match = rule.regex.search(line)
+        # The combined regex finds where the next match starts, and only
+        # there the rules' alternation tells which rule it is. Where several
+        # rules match, the one added first wins, like in a single
+        # alternation of all of them.
+        while True:
+            match = snapshot.search(line, pos)
+            if not match:
+                break
 
-            if match:
-                text = match.group(1)
-                result.append(
-                    (text, rule.id, self._parse_ban_time(rule.banTime))
-                )
-                line = line.replace(text, "")
+            pos = match.start()
+
+            start = clock()
+            found = snapshot.match_rule(line, pos)
+            elapsed = clock() - start
+
+            if found is None:
+                pos += 1
+                continue
+
+            rule, text = found
+
+            stats = self._get_rule_stats(rule.id)
+            stats.hits += 1
+            stats.total_time += elapsed
+
+            result.append((text, rule.id, self._parse_ban_time(rule.banTime)))
+            pos += max(1, len(text))
 
         return result
 
-    def _is_on_whitelist(self, string):
+    def _get_rule_stats(self, rule_id):
+        """
+        Get the counters of a blacklist rule, creating them if needed
+        :param rule_id:
+        :return:
+        """
+
+        stats = self.rule_stats.get(rule_id)
+        if stats is None:
+            stats = self.rule_stats[rule_id] = RuleStats()
+
+        return stats
+
+    def _is_on_whitelist(self, string, snapshot=None):
         """
         Check if the given matched string is on the whitelist
         :param string:
+        :param snapshot: RuleSnapshot of the whitelist to use
         :return:
         """
 
-        for rule in self.whitelist:
+        if snapshot is None:
+            snapshot = self.whitelist_rules.snapshot
+
+        if not snapshot.search(string):
+            return False
+
+        for rule in snapshot.rules:
             match = rule.regex.search(string)
 
             if match:
@@ -2,18 +2,31 @@
 The main bot logic module
 """
 
+from collections import OrderedDict
 from datetime import datetime
-import dateutil.parser
 from glob import glob
 import json
+from multiprocessing import current_process
 from lupa import LuaError
 from .commandmanager import CommandManager, CommandPermissionError, \
     CommandCooldownError
 from .database import Database
 from .utils import ThreadCallRelay, human_readable_time, ArgumentParser
 from .blacklist import BlacklistManager
+from .chat import Chat
+from .inbound import InboundQueue
+from .usercache import UserLevelCache
+from .outbound import PRIORITY_MODERATION, PRIORITY_COMMAND
+from .router import CommandRouter
+from .streaminfo import StreamInfoCache
+from .executor import ChannelExecutor
+from .moderation import ModerationPool
 from twitch import TwitchTV, Keys, Urls, TwitchException
 
+# Bot methods called through the relay whose results nobody needs, so the
+# callers don't have to wait for them
+BOT_FIRE_AND_FORGET = ("chat_message", "update_global_value", "_message")
+
 class Bot(object):
     """A bot instance"""
 
@@ -22,6 +35,18 @@ class Bot(object):
         self.settings = settings
         self.wrapper = wrapper
         self.logger = logger
+        self.event_queue = None
+        self.remote_irc = False
+        self.user_levels = UserLevelCache()
+
+        if settings:
+            # Chat messages are queued for us, and we're told to process
+            # them with a call through our own relay
+            self.event_queue = InboundQueue(
+                settings.INBOUND_BATCH_SIZE,
+                notify=lambda: self.wrapper.send("process_events")
+            )
+            self.user_levels = UserLevelCache(settings.MOD_STATUS_CACHE_TTL)
 
         if irc_wrapper:
             iw = irc_wrapper(
@@ -36,8 +61,12 @@ class Bot(object):
                 settings.COMMAND_PREFIX
             )
 
+            iw.set_event_queue(self.event_queue)
+
             if wrap_irc:
-                self.ircWrapper = ThreadCallRelay()
+                self.ircWrapper = ThreadCallRelay(
+                    fire_and_forget=("message",)
+                )
                 self.ircWrapper.set_call_object(iw)
                 iw.set_call_relay(self.ircWrapper)
             else:
@@ -50,6 +79,12 @@ class Bot(object):
         self.channel_models = {}
         self.db = None
         self.twitchapi = None
+        self.stream_info = None
+        self.executor = None
+        self.moderation = None
+
+        self.router = CommandRouter()
+        self._initialize_router()
 
     #
     # Public API
@@ -64,14 +99,18 @@ class Bot(object):
         self.logger.info(u"Starting bot...")
 
         self._initialize_models()
+        self._initialize_user_levels()
         self._initialize_twitchapi()
 
         self._initialize_command_managers()
 
         self._initialize_blacklists()
 
-        self.logger.info(u"Starting IRC connection")
-        self.ircWrapper.start()
+        self._initialize_executor()
+
+        if not self.remote_irc:
+            self.logger.info(u"Starting IRC connection")
+            self.ircWrapper.start()
 
         # Run until we want to exit
         self.wrapper.loop()
@@ -84,13 +123,34 @@ class Bot(object):
 
         :return:
         """
-        if self.ircWrapper:
+        if self.ircWrapper and not self.remote_irc:
             self.ircWrapper.stop()
 
+        if self.stream_info:
+            self.stream_info.stop()
+
+        if self.executor:
+            self.executor.stop()
+
+        if self.moderation:
+            self.moderation.stop()
+
         for key in self.command_managers:
             self.command_managers[key].stop_timers()
 
 
+    def set_remote_irc(self, irc):
+        """
+        Use an IRC connection owned by another process, e.g. a relay to it
+        when running as a worker process. We don't start or stop it.
+
+        :param irc: Object with the IRC wrapper's public API
+        :return: None
+        """
+
+        self.ircWrapper = irc
+        self.remote_irc = True
+
     def get_settings(self):
         """
         Get the bot settings, needed due to ThreadCallRelay
@@ -109,7 +169,86 @@ class Bot(object):
 
         return self.ircWrapper
 
-    def chat_message(self, channel, nick, text, timestamp):
+    def process_events(self):
+        """
+        Handle a batch of the chat messages waiting in the event queue
+
+        :return: None
+        """
+
+        for event in self.event_queue.get_batch():
+            if self.executor and not event.command:
+                # Plain chat lines can be skipped if the channel is that far
+                # behind, the commands and database writes are never dropped
+                self.executor.try_submit(event.channel, self._handle_event,
+                                         event)
+            else:
+                self._run_for_channel(event.channel, self._handle_event,
+                                      event)
+
+    def get_inbound_stats(self):
+        """
+        Get how many chat messages are waiting to be processed, and how long
+        they have been waiting
+
+        :return: Dict of counters
+        """
+
+        return self.event_queue.get_stats()
+
+    def get_blacklist_stats(self, channel, count=10):
+        """
+        Export how the channel's blacklist rules have been doing, to find
+        the rules that could be removed
+
+        :param channel: Which channel
+        :param count: How many rules to list as hottest, coldest and slowest
+        :return: Dict with "lines", "cache", "hottest", "coldest", "slowest"
+                 and "rules", and "pool" if the channel's lines are checked
+                 in the moderation pool
+        """
+
+        manager = self.blacklist_managers[channel]
+
+        stats = {
+            "lines": manager.get_line_stats(),
+            "cache": manager.get_cache_stats(),
+            "hottest": manager.get_top_rules("hot", count),
+            "coldest": manager.get_top_rules("cold", count),
+            "slowest": manager.get_top_rules("slow", count),
+            "rules": manager.get_rule_stats()
+        }
+
+        # The lines checked in the moderation pool are counted there
+        if self.moderation and channel in self.moderation:
+            stats["pool"] = self.moderation.get_stats()
+
+        return stats
+
+    def get_channel_stats(self):
+        """
+        Get how much work each channel has waiting, and how long it waited
+        before being run
+
+        :return: Dict of channel to dict of counters, empty if the channels
+                 don't have their own threads
+        """
+
+        if not self.executor:
+            return {}
+
+        return self.executor.get_stats()
+
+    def get_user_level_stats(self):
+        """
+        Get the size of the user level cache, and how often it was used
+
+        :return: Dict of counters
+        """
+
+        return self.user_levels.get_stats()
+
+    def chat_message(self, channel, nick, text, timestamp, context=None):
         """
         Process a non-command line from the chat
 
@@ -117,35 +256,28 @@ class Bot(object):
         :param nick: The nick of the user that issued the command
         :param text: The text content of the message
         :param timestamp: The unixtime for when the event happened
+        :param context: UserContext from the message tags, if available
         :return:
         """
 
-        user_level = self._get_user_level(channel, nick)
-        if user_level not in ("mod", "owner"):
-            mgr = self.blacklist_managers[channel]
-            res, rule_id, ban_time = mgr.is_blacklisted(text)
-            if res:
-                self.logger.info(
-                    u"{nick} will be timed out for {time} due to blacklist "
-                    u"rule #{id}".format(
-                        nick=nick,
-                        time=human_readable_time(ban_time),
-                        id=rule_id
-                    )
-                )
-                self.timeout(channel, nick, ban_time)
+        user_level = self._get_user_level(channel, nick, context)
+        if user_level in ("mod", "owner"):
+            return
 
-                message = u"{nick}, you triggered blacklist rule #{id}, " \
-                          u"you were timed out for {time}".format(
-                              nick=nick,
-                              id=rule_id,
-                              time=human_readable_time(ban_time)
-                )
+        if self.moderation and channel in self.moderation:
+            def punish(verdict):
+                # Called from the moderation pool's thread
+                self._send_for_channel(channel, "_handle_blacklist_verdict",
+                                       channel, nick, verdict)
 
-                self._message(channel, message)
+            if self.moderation.check(channel, text, punish):
+                return
 
+        mgr = self.blacklist_managers[channel]
+        self._handle_blacklist_verdict(channel, nick, mgr.is_blacklisted(text))
 
-    def irc_command(self, channel, nick, command, args, timestamp):
+    def irc_command(self, channel, nick, command, args, timestamp,
+                    context=None):
         """
         Process a command from the chat
 
@@ -154,6 +286,7 @@ class Bot(object):
         :param command: The command issued
         :param args: All the words on the line after the command
         :param timestamp: The unixtime for when the event happened
+        :param context: UserContext from the message tags, if available
         :return: If this was a valid command that was executed
         """
 
@@ -162,71 +295,28 @@ class Bot(object):
                               u"{3}".format(command, nick, channel,
                                             " ".join(args)))
 
-            if not self._is_core_command(command):
+            route = self.router.get(command)
+
+            if route is None:
                 cm = self.command_managers[channel]
                 if cm.is_valid_command(command):
-                    self._handle_custom_command(
-                        channel, nick, command, args, timestamp
+                    self.router.timed(
+                        channel, command, self._handle_custom_command,
+                        channel, nick, command, args, timestamp, context
                     )
                 return False
 
-            if not self._is_allowed_to_run_command(channel, nick, command):
+            user_level = self._get_user_level(channel, nick, context)
+            if not route.allows(user_level):
+                self.router.deny(channel, command)
                 self.logger.info(u"Command access denied")
                 message = u"{0}, sorry, but you are not allowed to use that " \
                           u"command."
                 self._message(channel, message.format(nick))
                 return False
 
-            if command == u"addquote":
-                self._add_quote(channel, nick, args)
-            elif command == u"delquote":
-                self._del_quote(channel, nick, args)
-            elif command == u"quote":
-                self._show_quote(channel, nick, args)
-            elif command == u"addnote":
-                self._add_note(channel, nick, args)
-            elif command == u"reg":
-                self._manage_regulars(channel, nick, args)
-            elif command == u"def" or command == u"com":
-                cm = self.command_managers[channel]
-
-                if command == u"def":
-                    added, channel, command, flags, user_level, code = \
-                        cm.add_command(
-                            args
-                        )
-                else:
-                    added, channel, command, flags, user_level, code = \
-                        cm.add_simple_command(
-                            args
-                        )
-
-                if added:
-                    message = u"{0}, added command {1} for user level " \
-                              u"{2}".format(
-                        nick, command, user_level
-                    )
-                else:
-                    message = u"{0}, removed command {1}".format(
-                        nick, command, user_level
-                    )
-
-                self.set_command(
-                    channel, command, flags, user_level, code
-                )
-
-                self._message(channel, message)
-            elif command == u"blacklist":
-                message = self._add_to_blacklist(channel, nick, args)
-                self._message(channel, message)
-            elif command == u"whitelist":
-                message = self._add_to_whitelist(channel, nick, args)
-                self._message(channel, message)
-            elif command == u"unblacklist":
-                message = self._remove_from_blacklist(channel, nick, args)
-                self._message(channel, message)
-            elif command == u"unwhitelist":
-                message = self._remove_from_whitelist(channel, nick, args)
+            message = self.router.run(route, channel, nick, args)
+            if message:
                 self._message(channel, message)
 
             return True
@@ -244,6 +334,31 @@ class Bot(object):
 
         return False
 
+    def register_command(self, name, handler, user_level="mod", parser=None):
+        """
+        Add a core command, or replace an existing one
+
+        :param name: Name of the command
+        :param handler: Function called with the channel, nick and args,
+                        anything it returns is sent to the channel
+        :param user_level: The minimum user level to run the command
+        :param parser: ArgumentParser for the args, if the handler wants the
+                       parsed options instead of the list of words
+        :return: None
+        """
+
+        self.router.add(name, handler, user_level, parser)
+
+    def get_command_stats(self):
+        """
+        Get how many times each command has been run, and how long they
+        took
+
+        :return: Dict of channel to dict of command name to dict of counters
+        """
+
+        return self.router.get_stats()
+
     def set_command(self, channel, command, flags, user_level, code):
         """
         Save a new custom command or update existing one in the database
@@ -268,7 +383,26 @@ class Bot(object):
         :return: None
         """
 
-        self._update_channel_data(channel, key, value)
+        self._run_for_channel(channel, self._update_channel_data, channel,
+                              key, value)
+
+    def update_global_value_batch(self, calls):
+        """
+        Set several global persistent values at once, used by the CallRelay
+        for queued update_global_value calls. Only the last value for each
+        key is written, in a single transaction per channel.
+
+        :param calls: List of (channel, key, value) tuples
+        :return: None
+        """
+
+        channels = OrderedDict()
+        for channel, key, value in calls:
+            channels.setdefault(channel, OrderedDict())[key] = value
+
+        for channel, values in channels.items():
+            self._run_for_channel(channel, self._update_channel_values,
+                                  channel, values)
 
     def timeout(self, channel, nick, seconds):
         """
@@ -283,18 +417,53 @@ class Bot(object):
             nick=nick, seconds=seconds
         )
 
-        self._message(channel, message)
+        self._message(channel, message, PRIORITY_MODERATION)
 
     #
     # Internal API
     #
 
-    def _message(self, channel, message):
+    def _handle_blacklist_verdict(self, channel, nick, verdict):
+        """
+        Time out the user if their line was blacklisted
+
+        :param channel: The channel the line was on
+        :param nick: Who said it
+        :param verdict: The BlacklistManager.is_blacklisted() result
+        :return: None
+        """
+
+        res, rule_id, ban_time = verdict
+        if not res:
+            return
+
+        self.logger.info(
+            u"{nick} will be timed out for {time} due to blacklist "
+            u"rule #{id}".format(
+                nick=nick,
+                time=human_readable_time(ban_time),
+                id=rule_id
+            )
+        )
+        self.timeout(channel, nick, ban_time)
+
+        message = u"{nick}, you triggered blacklist rule #{id}, " \
+                  u"you were timed out for {time}".format(
+                      nick=nick,
+                      id=rule_id,
+                      time=human_readable_time(ban_time)
+        )
+
+        self._message(channel, message)
+
+    def _message(self, channel, message, priority=PRIORITY_COMMAND):
         """
         Deliver a message to the channel
 
         :param channel: The channel the message is to be delivered on
         :param message: The message text
+        :param priority: Which outbound lane to use, one of the
+                         bot.outbound.PRIORITY_* constants
         :return: None
         """
 
@@ -302,7 +471,7 @@ class Bot(object):
             channel, message
         ))
 
-        self.ircWrapper.message(channel, message)
+        self.ircWrapper.message(channel, message, priority)
 
     def _is_core_command(self, command):
         """
@@ -320,64 +489,36 @@ class Bot(object):
         False
         """
 
-        return command in [
-            u"addquote",
-            u"delquote",
-            u"blacklist",
-            u"whitelist",
-            u"unblacklist",
-            u"unwhitelist",
-            u"quote",
-            u"reg",
-            u"def",
-            u"com",
-            u"addnote"
-        ]
+        return command in self.router
 
-    def _get_user_level(self, channel, nick):
+    def _get_user_level(self, channel, nick, context=None):
         """
         Determine the nick's user level on the channel
 
         :param channel: Which channel
         :param nick: Whose user level
+        :param context: UserContext from the message tags, if available,
+                        used instead of asking the IRC connection
         :return: String "user", "reg", "mod", or "owner"
         """
 
         level = "user"
 
+        if context is not None:
+            is_mod = context.is_mod
+            self.user_levels.set_mod(channel, nick, is_mod)
+        else:
+            is_mod = None
+
         if self._is_owner(nick):
             level = "owner"
-        elif self._is_mod(channel, nick):
+        elif is_mod or (is_mod is None and self._is_mod(channel, nick)):
             level = "mod"
         elif self._is_regular(channel, nick):
             level = "reg"
 
         return level
 
-    def _is_allowed_to_run_command(self, channel, nick, command):
-        """
-        Check if the given user has the permissions to run the given core
-        command.
-
-        :param channel: The channel the command was run on
-        :param nick: Who is running the command
-        :param command: The command being run
-        :return: True or False
-        """
-
-        user_level = self._get_user_level(channel, nick)
-
-        if user_level in ("mod", "owner"):
-            # Mods and owners can run any and all core commands
-            return True
-        elif command == u"quote":
-            return True
-        elif command in (u"addquote", u"delquote"):
-            if user_level == "reg":
-                return True
-
-        return False
-
     def _is_mod(self, channel, nick):
         """
         Check if the given nick is a moderator on the given channel
@@ -387,7 +528,13 @@ class Bot(object):
         :return: True of False
         """
 
-        return self.ircWrapper.is_oper(channel, nick)
+        is_mod = self.user_levels.is_mod(channel, nick)
+
+        if is_mod is None:
+            is_mod = self.ircWrapper.is_oper(channel, nick)
+            self.user_levels.set_mod(channel, nick, is_mod)
+
+        return is_mod
 
     def _is_regular(self, channel, nick):
         """
@@ -398,8 +545,13 @@ class Bot(object):
         :return: True of False
         """
 
-        model = self._get_model(channel, "regulars")
-        return model.filter(nick=nick).exists()
+        is_regular = self.user_levels.is_regular(channel, nick)
+
+        if is_regular is None:
+            model = self._get_model(channel, "regulars")
+            is_regular = model.filter(nick=nick).exists()
+
+        return is_regular
 
     def _is_owner(self, nick):
         """
@@ -415,7 +567,8 @@ class Bot(object):
     # Chat commands
     #
 
-    def _handle_custom_command(self, channel, nick, command, args, timestamp):
+    def _handle_custom_command(self, channel, nick, command, args, timestamp,
+                               context=None):
         """
         Handle execution of custom commands triggered via chat
 
@@ -424,10 +577,11 @@ class Bot(object):
         :param command: The command to be triggered
         :param args: The words on the line after the command
         :param timestamp: The unixtime for when the event happened
+        :param context: UserContext from the message tags, if available
         :return: None
         """
 
-        user_level = self._get_user_level(channel, nick)
+        user_level = self._get_user_level(channel, nick, context)
         cm = self.command_managers[channel]
         self.logger.debug(u"_handle_custom_command")
         message = None
@@ -452,6 +606,61 @@ class Bot(object):
         if message:
             self._message(channel, message)
 
+    def _define_command(self, channel, nick, args):
+        """
+        Handler for the "def" -command, adds or removes a custom Lua command
+
+        :param channel: The channel the command was triggered on
+        :param nick: The nick that triggered it
+        :param args: The words on the line after the command
+        :return: The reply to the channel
+        """
+
+        cm = self.command_managers[channel]
+        return self._save_command(channel, nick, cm.add_command(args))
+
+    def _define_simple_command(self, channel, nick, args):
+        """
+        Handler for the "com" -command, adds or removes a simple custom
+        command
+
+        :param channel: The channel the command was triggered on
+        :param nick: The nick that triggered it
+        :param args: The words on the line after the command
+        :return: The reply to the channel
+        """
+
+        cm = self.command_managers[channel]
+        return self._save_command(channel, nick, cm.add_simple_command(args))
+
+    def _save_command(self, channel, nick, result):
+        """
+        Save the command added or removed by the command manager
+
+        :param channel: The channel the command was triggered on
+        :param nick: The nick that triggered it
+        :param result: What the command manager returned
+        :return: The reply to the channel
+        """
+
+        added, channel, command, flags, user_level, code = result
+
+        if added:
+            message = u"{0}, added command {1} for user level " \
+                      u"{2}".format(
+                nick, command, user_level
+            )
+        else:
+            message = u"{0}, removed command {1}".format(
+                nick, command, user_level
+            )
+
+        self.set_command(
+            channel, command, flags, user_level, code
+        )
+
+        return message
+
     def _manage_regulars(self, channel, nick, args):
         """
         Handler for the "reg" -command, allows management of regulars
@@ -583,8 +792,6 @@ class Bot(object):
         """
         
         note_text = " ".join(args)
-        message = None
-        streaminfo = None
         if len(note_text) == 0:
             self.logger.info(u"Got 0 length addnote call from {0} in "
                              u"{1}?".format(nick, channel))
@@ -593,46 +800,65 @@ class Bot(object):
             return
         
         timestamp = datetime.utcnow()
-        
-        try:
-            streaminfo = self.twitchapi._fetchItems(Urls.STREAMS + channel.lstrip("#"), "stream")
-        except TwitchException as e:
-            self.logger.info(u"Caught TwitchException trying to fetch stream info")
-            if e.code != TwitchException.STREAM_OFFLINE:
-                message = u"Accessing Twitch API failed: url/http/json. Sorry, {0}"
-        except Exception as e:
-            self.logger.info(u"Caught unexpected exception {0} trying to fetch stream info.".format(e))
-            message = u"Accessing Twitch API failed. Sorry, {0}"
-            
-        if message is not None:
+
+        def save(info):
+            # Called from the stream info thread
+            self._send_for_channel(channel, "_save_note", channel, nick,
+                                   note_text, timestamp, info)
+
+        info = self.stream_info.request(channel, save)
+        if info is not None:
+            self._save_note(channel, nick, note_text, timestamp, info)
+
+    def _save_note(self, channel, nick, note_text, timestamp, info):
+        """
+        Save a note once the stream information is available
+
+        :param channel: The channel the command was triggered on
+        :param nick: The nick that triggered it
+        :param note_text: The text of the note
+        :param timestamp: The datetime for when the note was added
+        :param info: The StreamInfo for the channel
+        :return: None
+        """
+
+        if info.error is not None:
+            if info.stream is not None:
+                self.logger.info(u"Caught exception trying to parse "
+                                 u"game/starttime")
+                message = u"Twitch API data parsing failed. Sorry, {0}"
+            elif isinstance(info.error, TwitchException):
+                self.logger.info(u"Caught TwitchException trying to fetch "
+                                 u"stream info")
+                message = u"Accessing Twitch API failed: url/http/json. " \
+                          u"Sorry, {0}"
+            else:
+                self.logger.info(u"Caught unexpected exception {0} trying "
+                                 u"to fetch stream info.".format(info.error))
+                message = u"Accessing Twitch API failed. Sorry, {0}"
+
             self._message(channel, message.format(nick))
             return
-        
-        if streaminfo is not None:
-            try:
-                game = streaminfo["game"]
-                starttime = dateutil.parser.parse(streaminfo["created_at"])
-                starttime = starttime.replace(tzinfo=None)
-            except:
-                self.logger.info(u"Caught exception trying to parse game/starttime")
-                self._message(channel, u"Twitch API data parsing failed. Sorry, {0}".format(nick))
-                return
+
+        if info.online:
+            game = info.game
+            starttime = info.created_at
         else:
             game = "None"
             starttime = timestamp
-        
-           
+
         model = self._get_model(channel, "notes")
-        note = model.create(gamename=game, 
-            starttime=starttime, 
+        note = model.create(gamename=game,
+            starttime=starttime,
             notetime=timestamp,
             comment=note_text
         )
 
         elapsed = timestamp - starttime
-        
-        self.logger.info(u"Added note for {0}: {1}".format(channel,note))
-        self._message(channel, u"Note added: {0} after start of stream.".format(elapsed))
+
+        self.logger.info(u"Added note for {0}: {1}".format(channel, note))
+        self._message(channel, u"Note added: {0} after start of "
+                               u"stream.".format(elapsed))
 
     def _del_quote(self, channel, nick, args):
         """
@@ -714,6 +940,7 @@ class Bot(object):
         model.create(
             nick=nick
         )
+        self.user_levels.add_regular(channel, nick)
 
         self.logger.info(u"Added regular {0} to {1}".format(nick, channel))
 
@@ -729,6 +956,8 @@ class Bot(object):
         model = self._get_model(channel, "regulars")
         regular = model.filter(nick=nick).first()
 
+        self.user_levels.remove_regular(channel, nick)
+
         if regular:
             regular.delete_instance()
             self.logger.info(u"Removed regular {0} from {1}".format(
@@ -758,6 +987,8 @@ class Bot(object):
         rule.save()
 
         self.blacklist_managers[channel].add_blacklist(rule)
+        if self.moderation and channel in self.moderation:
+            self.moderation.add_blacklist(channel, rule)
 
         message = u"{nick}, added blacklist rule {match} with ID {id}".format(
             nick=nick, match=rule.match, id=rule.id
@@ -780,6 +1011,8 @@ class Bot(object):
         rule.save()
 
         self.blacklist_managers[channel].add_whitelist(rule)
+        if self.moderation and channel in self.moderation:
+            self.moderation.add_whitelist(channel, rule)
 
         message = u"{nick}, added whitelist rule {match} with ID {id}".format(
             nick=nick, match=rule.match, id=rule.id
@@ -804,7 +1037,9 @@ class Bot(object):
         if item:
             item.delete_instance()
 
-            self.blacklist_managers[channel].remove_blacklist(row_id)
+            self.blacklist_managers[channel].remove_blacklist(item.id)
+            if self.moderation and channel in self.moderation:
+                self.moderation.remove_blacklist(channel, item.id)
 
             message = u"{0}, blacklist item removed.".format(nick)
             self.logger.info(u"Removed blacklist item {0} for {1}".format(
@@ -834,7 +1069,9 @@ class Bot(object):
         if item:
             item.delete_instance()
 
-            self.blacklist_managers[channel].remove_whitelist(row_id)
+            self.blacklist_managers[channel].remove_whitelist(item.id)
+            if self.moderation and channel in self.moderation:
+                self.moderation.remove_whitelist(channel, item.id)
 
             message = u"{0}, whitelist item removed.".format(nick)
             self.logger.info(u"Removed whitelist item {0} for {1}".format(
@@ -847,6 +1084,61 @@ class Bot(object):
 
         return message
 
+    def _show_blacklist_stats(self, channel, nick, options):
+        """
+        Handler for the "blstats" command, lists the blacklist rules that
+        match the most or the least, or are the slowest to check
+
+        :param channel: The channel the command was triggered on
+        :param nick: The nick that triggered it
+        :param options: The parsed arguments
+        :return: The reply to the channel
+        """
+
+        manager = self.blacklist_managers[channel]
+        rules = manager.get_top_rules(options.order, options.count)
+
+        if not rules:
+            return u"{0}, there are no blacklist rules.".format(nick)
+
+        if options.order == "slow":
+            items = [
+                u"#{id} {time:.1f}ms ({hits} hits)".format(
+                    id=rule["id"],
+                    time=rule["total_time"] * 1000,
+                    hits=rule["hits"]
+                )
+                for rule in rules
+            ]
+        else:
+            items = [
+                u"#{id} {hits} hits ({overrides} whitelisted)".format(**rule)
+                for rule in rules
+            ]
+
+        titles = {
+            "hot": u"most matched",
+            "cold": u"least matched",
+            "slow": u"slowest"
+        }
+
+        return u"{0}, {1} blacklist rules: {2}".format(
+            nick, titles[options.order], u", ".join(items)
+        )
+
+    def _update_channel_values(self, channel, values):
+        """
+        Save several values to the channel's database in one transaction
+
+        :param channel: Which channel
+        :param values: Dict of the names of the values to the data
+        :return: None
+        """
+
+        with self.db.transaction():
+            for key, value in values.items():
+                self._update_channel_data(channel, key, value)
+
     def _update_channel_data(self, channel, key, value):
         """
         Save a single value to the channel's database
@@ -885,6 +1177,111 @@ class Bot(object):
 
         return data
 
+    def _initialize_executor(self):
+        """
+        Give the channels their own threads, if configured
+
+        :return: None
+        """
+
+        if not self.settings.CHANNEL_THREADS:
+            return
+
+        self.executor = ChannelExecutor(
+            self.settings.CHANNEL_THREADS,
+            self.settings.CHANNEL_QUEUE_SIZE,
+            self.settings.CHANNEL_LIST,
+            self.logger
+        )
+        self.executor.start()
+
+    def _run_for_channel(self, channel, function, *args):
+        """
+        Run the function on the channel's thread, waiting for room in its
+        queue if needed, or right away if the channels don't have their own
+        threads
+
+        :param channel: Which channel the work is for
+        :param function: The function to run
+        :return: None
+        """
+
+        if self.executor:
+            self.executor.submit(channel, function, *args)
+        else:
+            function(*args)
+
+    def _send_for_channel(self, channel, method, *args):
+        """
+        Call one of our methods from another thread, on the channel's
+        thread, or through our relay if the channels don't have their own
+        threads
+
+        :param channel: Which channel the work is for
+        :param method: Name of the method to call
+        :return: None
+        """
+
+        if self.executor:
+            self._run_for_channel(channel, getattr(self, method), *args)
+        else:
+            self.wrapper.send(method, *args)
+
+    def _handle_event(self, event):
+        """
+        Handle a single chat message from the event queue
+
+        :param event: A bot.inbound.MessageEvent
+        :return: None
+        """
+
+        cmd = False
+
+        if event.command:
+            cmd = self.irc_command(
+                event.channel, event.nick, event.command, event.args,
+                event.timestamp, context=event.context
+            )
+
+        if not cmd:
+            try:
+                self.chat_message(
+                    event.channel, event.nick, event.text,
+                    event.timestamp, context=event.context
+                )
+            except Exception:
+                self.logger.error(u"Failed to process chat message",
+                                  exc_info=True)
+
+        self.event_queue.record_handled([event])
+
+    def _initialize_router(self):
+        """
+        Register the core commands and who can run them
+
+        :return: None
+        """
+
+        add = self.router.add
+
+        add(u"quote", self._show_quote, "user")
+        add(u"addquote", self._add_quote, "reg")
+        add(u"delquote", self._del_quote, "reg")
+        add(u"addnote", self._add_note)
+        add(u"reg", self._manage_regulars)
+        add(u"def", self._define_command)
+        add(u"com", self._define_simple_command)
+        add(u"blacklist", self._add_to_blacklist)
+        add(u"whitelist", self._add_to_whitelist)
+        add(u"unblacklist", self._remove_from_blacklist)
+        add(u"unwhitelist", self._remove_from_whitelist)
+
+        parser = ArgumentParser(prog=u"!blstats")
+        parser.add_argument("order", nargs="?", default="hot",
+                            choices=("hot", "cold", "slow"))
+        parser.add_argument("-n", "--count", type=int, default=5)
+        add(u"blstats", self._show_blacklist_stats, parser=parser)
+
     def _initialize_command_managers(self):
         """
         Initialize all the command managers for all the channels, load our
@@ -903,7 +1300,10 @@ class Bot(object):
                 self.wrapper,
                 self.settings,
                 channel_data,
-                self.logger
+                self.logger,
+                # Ask the IRC wrapper directly, as a blocking call to the bot
+                # from a channel thread could deadlock
+                chat=Chat(self.wrapper, channel, self.ircWrapper)
             )
 
             for filename in lua_files:
@@ -935,7 +1335,10 @@ class Bot(object):
         """
 
         for channel in self.settings.CHANNEL_LIST:
-            manager = BlacklistManager(logger=self.logger)
+            manager = BlacklistManager(
+                logger=self.logger,
+                cache_size=self.settings.BLACKLIST_CACHE_SIZE
+            )
 
             blacklist_model = self._get_model(channel, "blacklist")
             whitelist_model = self._get_model(channel, "whitelist")
@@ -947,6 +1350,38 @@ class Bot(object):
 
             self.blacklist_managers[channel] = manager
 
+            if len(blacklist) >= self.settings.BLACKLIST_PROCESS_MIN_RULES:
+                pool = self._get_moderation_pool()
+                if pool:
+                    pool.set_rules(channel, blacklist, whitelist)
+
+    def _get_moderation_pool(self):
+        """
+        Get the pool of processes checking the lines of the channels with
+        the most blacklist rules, starting it if needed
+
+        :return: A ModerationPool, or None if not configured
+        """
+
+        if self.moderation or not self.settings.BLACKLIST_PROCESSES:
+            return self.moderation
+
+        # Worker processes are daemons, which can't have processes of their
+        # own
+        if current_process().daemon:
+            self.logger.warn(u"Can't start BLACKLIST_PROCESSES in a worker "
+                             u"process, checking blacklists in-process")
+            return None
+
+        self.moderation = ModerationPool(
+            self.settings.BLACKLIST_PROCESSES,
+            cache_size=self.settings.BLACKLIST_CACHE_SIZE,
+            logger=self.logger
+        )
+        self.moderation.start()
+
+        return self.moderation
+
     def _find_lua_files(self):
         """
         Locate all Lua files we want to be globally included in our Lua runtime
@@ -968,6 +1403,19 @@ class Bot(object):
         for channel in self.settings.CHANNEL_LIST:
             self.channel_models[channel] = self.db.get_models(channel)
 
+    def _initialize_user_levels(self):
+        """
+        Load the regulars of all the channels in the user level cache
+
+        :return: None
+        """
+
+        for channel in self.settings.CHANNEL_LIST:
+            model = self._get_model(channel, "regulars")
+            self.user_levels.set_regulars(
+                channel, [regular.nick for regular in model.select()]
+            )
+
     def _initialize_twitchapi(self):
         """
         Create the Twitch API wrapper object
@@ -977,6 +1425,33 @@ class Bot(object):
         
         self.twitchapi = TwitchTV(self.logger)
 
+        self.stream_info = StreamInfoCache(
+            self._fetch_stream_info,
+            self.settings.CHANNEL_LIST,
+            self.settings.STREAM_INFO_POLL_INTERVAL,
+            self.settings.STREAM_INFO_MAX_AGE,
+            self.logger
+        )
+        self.stream_info.start()
+
+    def _fetch_stream_info(self, channel):
+        """
+        Fetch the stream information of a channel from the Twitch API, run
+        in the StreamInfoCache thread
+
+        :param channel: Which channel
+        :return: Dict of the stream data, None if the stream is offline
+        """
+
+        try:
+            return self.twitchapi._fetchItems(
+                Urls.STREAMS + channel.lstrip("#"), "stream"
+            )
+        except TwitchException as e:
+            if e.code == TwitchException.STREAM_OFFLINE:
+                return None
+            raise
+
     def _get_model(self, channel, table):
         """
         Get the model instance for the given channel table
@@ -1,11 +1,22 @@
+from .outbound import PRIORITY_CUSTOM
+
+
 class Chat(object):
     """
     API for Lua to interact with the stream chat
     """
 
-    def __init__(self, bot, channel):
+    def __init__(self, bot, channel, irc=None):
+        """
+        :param bot: The bot, or a relay to it
+        :param channel: Which channel
+        :param irc: The IRC wrapper, or a relay to it, to use instead of
+                    asking the bot for it
+        """
+
         self.bot = bot
         self.channel = channel
+        self.irc = irc
 
     def message(self, text):
         """
@@ -15,7 +26,7 @@ class Chat(object):
         :return:
         """
 
-        self.bot._message(self.channel, text)
+        self.bot._message(self.channel, text, PRIORITY_CUSTOM)
 
     def get_users(self):
         """
@@ -26,9 +37,11 @@ class Chat(object):
 
         users = []
 
-        if self.bot:
+        irc = self.irc
+        if not irc and self.bot:
             irc = self.bot.get_irc()
-            if irc:
-                users = irc.get_users(self.channel)
+
+        if irc:
+            users = irc.get_users(self.channel)
 
         return users
\ No newline at end of file
@@ -8,8 +8,9 @@ import time
 from threading import Thread
 from .utils import human_readable_time, ArgumentParser
 from .http import Http, TupleData
-from .timer import Interval, Delayed
+from .timer import Interval, Delayed, create_trampoline
 from .chat import Chat
+from .router import level_to_number
 
 
 class CommandPermissionError(BaseException):
@@ -122,11 +123,13 @@ class CommandManager(object):
         self.settings = settings
         self.logger = logger
         self.commands = {}
+        self.call_wrappers = {}
         self.timers = []
         self.datasource = DataSource(channel, bot, data)
         self.commands_last_executed = {}
 
         self.lua = lupa.LuaRuntime(unpack_returned_tuples=False)
+        self.timer_trampoline = create_trampoline(self.lua)
         self._inject_globals()
 
     def stop_timers(self):
@@ -210,6 +213,7 @@ class CommandManager(object):
         }
 
         self.load_lua(code)
+        self.call_wrappers.pop(command, None)
 
         return self.channel, command, flags, user_level, code
 
@@ -253,8 +257,7 @@ class CommandManager(object):
         ))
 
         def run():
-            code = self.call_template.format(func_name=command)
-            lua_func = self.lua.eval(code)
+            lua_func = self._get_call_wrapper(command)
             if "want_user" in self.commands[command]["flags"]:
                 if self.commands[command]["flags"]["want_user"] == 1:
                     args.insert(0, nick)
@@ -281,6 +284,23 @@ class CommandManager(object):
 
         self.lua.execute(code)
 
+    def _get_call_wrapper(self, command):
+        """
+        Get the Lua function for calling the command, compiling it the
+        first time the command is run after it was loaded
+
+        :param command: The name of the command
+        :return: The Lua function
+        """
+
+        lua_func = self.call_wrappers.get(command)
+
+        if lua_func is None:
+            code = self.call_template.format(func_name=command)
+            lua_func = self.call_wrappers[command] = self.lua.eval(code)
+
+        return lua_func
+
     def _parse_func(self, args):
         """
         Process the given arguments into a function definition
@@ -402,28 +422,6 @@ class CommandManager(object):
         """
         self.commands_last_executed[command] = timestamp
 
-    def _level_name_to_number(self, name):
-        """
-        Convert the given user level to a number
-
-        :param name: Level name
-        :return: A number between 0 and Infinity, higher number is higher
-                 user level
-        :raise ValueError: In case of invalid user level
-        """
-
-        levels = [
-            "user",
-            "reg",
-            "mod",
-            "owner"
-        ]
-
-        if not name in levels:
-            raise ValueError(u"{0} is not a valid user level".format(name))
-
-        return levels.index(name)
-
     def _can_run_command(self, user_level, command):
         """
         Check if this command can be run with the given user level
@@ -433,11 +431,8 @@ class CommandManager(object):
         :return: True of False
         """
 
-        need_level = self._level_name_to_number(
-            self.commands[command]["user_level"]
-        )
-
-        got_level = self._level_name_to_number(user_level)
+        need_level = level_to_number(self.commands[command]["user_level"])
+        got_level = level_to_number(user_level)
 
         return got_level >= need_level
 
@@ -465,12 +460,14 @@ class CommandManager(object):
             self.logger.debug(u"Lua: " + str(message))
 
         def interval(seconds, function):
-            i = Interval(seconds, function, self.lua)
+            i = Interval(seconds, function, self.lua,
+                         trampoline=self.timer_trampoline)
             self.timers.append(i)
             return i
 
         def delayed(seconds, function):
-            i = Delayed(seconds, function, self.lua)
+            i = Delayed(seconds, function, self.lua,
+                        trampoline=self.timer_trampoline)
             self.timers.append(i)
             return i
 
@@ -225,6 +225,16 @@ class Database(object):
 
         return model_map
 
+    def transaction(self):
+        """
+        Get a context manager that runs the queries in it as a single
+        transaction
+
+        :return: Transaction context manager
+        """
+
+        return self._get_db().transaction()
+
     def _get_db(self):
         """
         Get a database connection, initialize it if not done so yet
@@ -233,7 +243,9 @@ class Database(object):
         """
 
         if not self.db:
-            self.db = SqliteDatabase(self.settings.DATABASE_PATH)
+            # The channels' threads each get their own connection
+            self.db = SqliteDatabase(self.settings.DATABASE_PATH,
+                                     threadlocals=True)
             self.db.connect()
 
         return self.db
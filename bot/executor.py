@@ -0,0 +1,258 @@
+"""
+Run the work for each channel on its own thread, so a slow channel can only
+delay itself
+"""
+
+from threading import Lock, Thread
+from time import time
+from zlib import crc32
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+
+class ChannelStats(object):
+    """
+    How much work a channel has had, and how long it waited to be run
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def as_dict(self):
+        """
+        Get the counters
+
+        :return: Dict with "depth", "queued", "handled", "dropped",
+                 "average_lag" and "max_lag"
+        """
+
+        average_lag = 0.0
+        if self.handled:
+            average_lag = self.total_lag / self.handled
+
+        return {
+            "depth": self.queued - self.handled,
+            "queued": self.queued,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "average_lag": average_lag,
+            "max_lag": self.max_lag
+        }
+
+
+class ChannelExecutor(object):
+    """
+    Runs functions on a fixed number of threads, with every channel
+    assigned to one of them. The work for a channel is run in the order it
+    was submitted, one at a time, while other channels' work runs in
+    parallel on the other threads.
+
+    Neither submit() nor try_submit() ever waits. Work that can be skipped
+    is given to try_submit(), which drops it if the thread already has
+    queue_size such functions waiting. The work given to submit() is never
+    dropped, and doesn't count towards the limit.
+
+    >>> from bot.executor import ChannelExecutor
+    >>> executor = ChannelExecutor(2, channels=["#a", "#b"])
+    >>> executor.start()
+    >>> results = []
+    >>> executor.submit("#a", results.append, 1)
+    True
+    >>> executor.stop()
+    >>> results
+    [1]
+    """
+
+    def __init__(self, threads, queue_size=500, channels=None, logger=None,
+                 clock=time):
+        """
+        :param threads: Number of threads to run the work on
+        :param queue_size: Maximum number of functions that can be skipped
+                           waiting per thread
+        :param channels: The known channels, spread evenly over the threads
+        :param logger: Logger for errors
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.logger = logger
+        self.clock = clock
+        self.queue_size = queue_size
+        self.lock = Lock()
+        self.stats = {}
+        self.shards = {}
+        self.queues = [Queue() for i in range(threads)]
+        self.skippable = [0] * threads
+        self.threads = []
+
+        for index, channel in enumerate(sorted(channels or [])):
+            self.shards[channel] = index % threads
+
+    def start(self):
+        """
+        Start the threads
+
+        :return: None
+        """
+
+        for index in range(len(self.queues)):
+            thread = Thread(target=self._run, args=(index,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Stop the threads once they have run the work already submitted
+
+        :return: None
+        """
+
+        for queue in self.queues:
+            queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    def submit(self, channel, function, *args):
+        """
+        Run the function on the channel's thread, the work is never dropped
+
+        :param channel: Which channel the work is for
+        :param function: The function to run
+        :return: True
+        """
+
+        stats = self._get_stats(channel)
+        index = self._get_shard(channel)
+
+        with self.lock:
+            stats.queued += 1
+
+        self.queues[index].put(
+            (channel, self.clock(), function, args, False)
+        )
+
+        return True
+
+    def try_submit(self, channel, function, *args):
+        """
+        Run the function on the channel's thread, unless the thread already
+        has queue_size functions that can be skipped waiting
+
+        :param channel: Which channel the work is for
+        :param function: The function to run
+        :return: True if queued, False if dropped
+        """
+
+        stats = self._get_stats(channel)
+        index = self._get_shard(channel)
+
+        with self.lock:
+            if self.skippable[index] >= self.queue_size:
+                stats.dropped += 1
+                full = True
+            else:
+                self.skippable[index] += 1
+                stats.queued += 1
+                full = False
+
+        if full:
+            if self.logger:
+                self.logger.warn(u"Work queue for {0} is full, dropping "
+                                 u"{1}".format(channel, function.__name__))
+            return False
+
+        self.queues[index].put(
+            (channel, self.clock(), function, args, True)
+        )
+
+        return True
+
+    def get_stats(self):
+        """
+        Get the counters for every channel that has had work
+
+        :return: Dict of channel to dict of counters
+        """
+
+        with self.lock:
+            return dict(
+                (channel, stats.as_dict())
+                for channel, stats in self.stats.items()
+            )
+
+    def _get_shard(self, channel):
+        """
+        Find the thread the channel is assigned to
+
+        :param channel: Which channel
+        :return: Index of the thread and its queue
+        """
+
+        index = self.shards.get(channel)
+
+        if index is None:
+            index = crc32(channel.encode("utf-8")) % len(self.queues)
+
+        return index
+
+    def _get_stats(self, channel):
+        """
+        Get the counters for the channel, creating them if needed
+
+        :param channel: Which channel
+        :return: A ChannelStats
+        """
+
+        with self.lock:
+            stats = self.stats.get(channel)
+            if stats is None:
+                stats = self.stats[channel] = ChannelStats()
+
+            return stats
+
+    def _run(self, index):
+        """
+        Main loop of a thread, runs the work from its queue
+
+        :param index: Index of the thread and its queue
+        :return: None
+        """
+
+        queue = self.queues[index]
+
+        while True:
+            work = queue.get()
+
+            # Magic message telling us to stop
+            if work is None:
+                break
+
+            channel, queued, function, args, skippable = work
+            lag = max(0, self.clock() - queued)
+
+            if skippable:
+                with self.lock:
+                    self.skippable[index] -= 1
+
+            try:
+                function(*args)
+            except Exception:
+                if self.logger:
+                    self.logger.error(u"Work for {0} failed".format(channel),
+                                      exc_info=True)
+
+            stats = self._get_stats(channel)
+            with self.lock:
+                stats.handled += 1
+                stats.total_lag += lag
+                stats.max_lag = max(stats.max_lag, lag)
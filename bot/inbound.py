@@ -0,0 +1,187 @@
+"""
+Inbound chat event queueing between the IRC connection and the bot
+"""
+
+from collections import deque
+from threading import Lock
+from time import time
+
+
+class MessageEvent(object):
+    """
+    A chat message received from IRC, parsed and waiting to be handled by
+    the bot
+    """
+
+    def __init__(self, channel, nick, text, timestamp, context=None,
+                 command=None, args=None):
+        """
+        :param channel: The channel the message was sent on
+        :param nick: The nick of the user that sent it
+        :param text: The message text
+        :param timestamp: The unixtime for when the message was received
+        :param context: UserContext from the message tags, if available
+        :param command: The command on the line, None if not a command
+        :param args: The words after the command
+        """
+
+        self.channel = channel
+        self.nick = nick
+        self.text = text
+        self.timestamp = timestamp
+        self.context = context
+        self.command = command
+        self.args = args
+
+    def __repr__(self):
+        return "<MessageEvent:{0}:{1}>".format(self.channel, self.nick)
+
+
+class InboundQueue(object):
+    """
+    Thread safe queue for the received chat events. The IRC side puts the
+    events in without waiting for them to be handled, the bot side takes
+    them out in batches.
+
+    The notify function is called when there are events waiting and the
+    bot has not been told about them yet, e.g. to queue a call to the bot
+    through a CallRelay. If events are left after a batch is taken, notify
+    is called again, so other work gets a turn between the batches.
+
+    >>> from bot.inbound import InboundQueue
+    >>> notified = []
+    >>> q = InboundQueue(2, notify=lambda: notified.append(True))
+    >>> for event in ("a", "b", "c"):
+    ...     q.put(event)
+    >>> len(notified)
+    1
+    >>> q.get_batch(), len(notified)
+    (['a', 'b'], 2)
+    >>> q.get_batch(), q.get_batch()
+    (['c'], [])
+    """
+
+    def __init__(self, batch_size=50, notify=None, clock=time):
+        """
+        :param batch_size: Maximum number of events returned by get_batch()
+        :param notify: Function called without arguments when there are
+                       events to handle
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.batch_size = batch_size
+        self.notify = notify
+        self.clock = clock
+        self.lock = Lock()
+        self.events = deque()
+        self.notified = False
+
+        self.received = 0
+        self.handled = 0
+        self.batches = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def put(self, event):
+        """
+        Add an event to the end of the queue
+
+        :param event: A MessageEvent
+        :return: None
+        """
+
+        with self.lock:
+            self.events.append(event)
+            self.received += 1
+
+            notify = self._should_notify()
+
+        if notify:
+            self.notify()
+
+    def get_batch(self):
+        """
+        Take the oldest events from the queue, without waiting
+
+        :return: List of up to batch_size events, empty if there are none
+        """
+
+        with self.lock:
+            batch = []
+            while self.events and len(batch) < self.batch_size:
+                batch.append(self.events.popleft())
+
+            if batch:
+                self.batches += 1
+
+            self.notified = False
+            notify = self._should_notify()
+
+        if notify:
+            self.notify()
+
+        return batch
+
+    def record_handled(self, events):
+        """
+        Record that the events have been handled, to keep track of how far
+        behind the bot is
+
+        :param events: List of MessageEvents
+        :return: None
+        """
+
+        now = self.clock()
+
+        with self.lock:
+            for event in events:
+                lag = max(0, now - event.timestamp)
+                self.handled += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+
+    def qsize(self):
+        """
+        Get the number of events waiting
+
+        :return: Number of events
+        """
+
+        with self.lock:
+            return len(self.events)
+
+    def get_stats(self):
+        """
+        Get the queue depth and the time between receiving the events and
+        handling them
+
+        :return: Dict of counters
+        """
+
+        with self.lock:
+            average_lag = 0.0
+            if self.handled:
+                average_lag = self.total_lag / self.handled
+
+            return {
+                "depth": len(self.events),
+                "received": self.received,
+                "handled": self.handled,
+                "batches": self.batches,
+                "average_lag": average_lag,
+                "max_lag": self.max_lag
+            }
+
+    def _should_notify(self):
+        """
+        Check if the bot needs to be told about waiting events, the caller
+        must hold the lock
+
+        :return: True or False
+        """
+
+        if self.notify is None or self.notified or not self.events:
+            return False
+
+        self.notified = True
+        return True
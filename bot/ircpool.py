@@ -0,0 +1,310 @@
+"""
+Spread the channels over several IRC connections
+"""
+
+from threading import Lock
+from .ircwrapper import BaseIRCWrapper, IRCWrapper
+
+
+class PooledIRCWrapper(IRCWrapper):
+    """
+    A single connection in an IRCConnectionPool, tells the pool when it
+    connects or disconnects so the channels can be moved around
+    """
+
+    def __init__(self, pool, index, *args, **kwargs):
+        """
+        :param pool: The IRCConnectionPool this connection belongs to
+        :param index: Number of this connection in the pool, for logging
+        """
+
+        super(PooledIRCWrapper, self).__init__(*args, **kwargs)
+
+        self.pool = pool
+        self.index = index
+        self.connected = False
+        self.lost = False
+
+    def on_welcome(self, connection, event):
+        super(PooledIRCWrapper, self).on_welcome(connection, event)
+
+        self.connected = True
+        self.lost = False
+        self.pool._connection_up(self)
+
+    def on_disconnect(self, connection, event):
+        super(PooledIRCWrapper, self).on_disconnect(connection, event)
+
+        self.connected = False
+        self.lost = True
+        self.pool._connection_down(self)
+
+    def _add_channel(self, channel):
+        """
+        Start joining a channel moved to this connection, run on our own IRC
+        thread
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        self.joins.add([channel])
+        self._process_joins()
+
+    def _remove_channel(self, channel):
+        """
+        Stop joining or leave a channel moved to another connection, run on
+        our own IRC thread
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        self.joins.remove(channel)
+        if self.connected:
+            self.connection.part(channel)
+
+    def __repr__(self):
+        return "<PooledIRCWrapper:{0}>".format(self.index)
+
+
+class IRCConnectionPool(BaseIRCWrapper):
+    """
+    Drop-in replacement for the IRCWrapper that assigns the channels to
+    several connections, at most `channels_per_connection` channels each.
+
+    Every connection processes the chat events for its own channels. The
+    outbound queue and rate limits are shared, as Twitch counts the
+    messages we send per account, and each message is sent on the
+    connection that owns the channel.
+
+    When a connection drops its channels are moved to the other
+    connections that have room for them, and when it comes back the
+    channels are spread evenly over the connected ones again.
+    """
+
+    def __init__(self, logger=None, bot=None, settings=None, channelList=None,
+                 nickname=None,
+                 server=None, password=None,
+                 port=6667, commandPrefix='!'):
+
+        self._setup(logger, bot, settings, channelList, commandPrefix)
+
+        self.channels_per_connection = settings.CHANNELS_PER_CONNECTION
+        self.lock = Lock()
+        self.owners = {}
+        self.connections = []
+
+        channels = list(channelList or [])
+        per_connection = self.channels_per_connection
+        count = max(1, -(-len(channels) // per_connection))
+
+        # Deal the channels out evenly instead of filling up the first ones
+        for index in range(count):
+            assigned = channels[index::count]
+
+            connection = PooledIRCWrapper(
+                self, index,
+                logger, bot, settings, assigned, nickname, server, password,
+                port, commandPrefix
+            )
+
+            # All connections feed the same queue and rate limits, Twitch
+            # counts them per account
+            connection.queue = self.queue
+            connection.rate_limits = self.rate_limits
+            connection.channel_tiers = self.channel_tiers
+            connection.joins.rate_limit = self.joins.rate_limit
+
+            for channel in assigned:
+                self.owners[channel] = connection
+
+            self.connections.append(connection)
+
+        self.logger.info(u"Using {0} connections for {1} channels".format(
+            len(self.connections), len(channels)
+        ))
+
+    # Public API
+
+    def start(self):
+        """
+        Start all the IRC connections and the outbound thread
+
+        :return: None
+        """
+
+        self._start_outbound_thread()
+
+        for connection in self.connections:
+            connection._start_irc_thread()
+
+    def stop(self):
+        """
+        Stop our threads etc.
+
+        :return: None
+        """
+
+        self.queue.close()
+
+        if self.call_relay:
+            self.call_relay.stop()
+
+    def set_event_queue(self, event_queue):
+        """
+        Put the chat messages from all the connections in the given queue
+
+        :param event_queue: A bot.inbound.InboundQueue
+        :return: None
+        """
+
+        super(IRCConnectionPool, self).set_event_queue(event_queue)
+
+        for connection in self.connections:
+            connection.set_event_queue(event_queue)
+
+    def is_oper(self, channel, nick):
+        """
+        Check if the user is an operator/moderator in the channel
+
+        :param channel: Which channel
+        :param nick: What is the user's nick
+        :return:
+        """
+
+        return self._get_connection(channel).is_oper(channel, nick)
+
+    def get_users(self, channel):
+        """
+        Get the users currently in the given channel
+
+        :param channel: Which channel
+        :return:
+        """
+
+        return self._get_connection(channel).get_users(channel)
+
+    def get_connection_stats(self):
+        """
+        Get the state of each connection and the channels assigned to it
+
+        :return: List of dicts with "connected" and "channels"
+        """
+
+        with self.lock:
+            return [
+                {
+                    "connected": connection.connected,
+                    "channels": list(connection.channelList)
+                }
+                for connection in self.connections
+            ]
+
+    def _get_connection(self, channel):
+        """
+        Find the connection that owns the channel
+
+        :param channel: Which channel
+        :return: A PooledIRCWrapper
+        """
+
+        with self.lock:
+            return self.owners.get(channel, self.connections[0])
+
+    def _send_message(self, channel, message):
+        """
+        Send a message on the connection that owns the channel
+
+        :param channel: The channel to send the message to
+        :param message: The message to be sent
+        :return: None
+        """
+
+        self._get_connection(channel)._send_message(channel, message)
+
+    def _connection_up(self, connection):
+        """
+        Called when one of the connections has (re)connected and joined its
+        channels, takes back channels from the busiest connections
+
+        :param connection: The PooledIRCWrapper
+        :return: None
+        """
+
+        with self.lock:
+            self._rebalance()
+
+    def _connection_down(self, connection):
+        """
+        Called when one of the connections is disconnected, moves its
+        channels to the other connections if they have room
+
+        :param connection: The PooledIRCWrapper
+        :return: None
+        """
+
+        with self.lock:
+            self._rebalance()
+
+    def _rebalance(self):
+        """
+        Move channels off the connections we lost, and even out the number
+        of channels between the connected ones. Connections that are still
+        making their first connection keep their channels. Call with the
+        lock held.
+
+        :return: None
+        """
+
+        connected = [c for c in self.connections if c.connected]
+        if not connected:
+            return
+
+        per_connection = self.channels_per_connection
+
+        for connection in self.connections:
+            if not connection.lost:
+                continue
+
+            for channel in list(connection.channelList):
+                target = min(connected, key=lambda c: len(c.channelList))
+                if len(target.channelList) >= per_connection:
+                    # Nowhere to put it, it's rejoined when the connection
+                    # comes back
+                    break
+
+                self._move_channel(channel, connection, target)
+
+        while True:
+            busiest = max(connected, key=lambda c: len(c.channelList))
+            quietest = min(connected, key=lambda c: len(c.channelList))
+
+            if len(busiest.channelList) - len(quietest.channelList) <= 1:
+                return
+
+            channel = busiest.channelList[-1]
+            self._move_channel(channel, busiest, quietest)
+
+    def _move_channel(self, channel, source, target):
+        """
+        Move a channel from one connection to another
+
+        :param channel: Which channel
+        :param source: The PooledIRCWrapper that owns the channel now
+        :param target: The PooledIRCWrapper that will own it
+        :return: None
+        """
+
+        self.logger.info(u"Moving {0} from connection {1} to {2}".format(
+            channel, source.index, target.index
+        ))
+
+        source.channelList.remove(channel)
+        target.channelList.append(channel)
+        self.owners[channel] = target
+
+        # We're on the thread of whichever connection changed state, each
+        # connection must only be used from its own
+        source._call_later(0, lambda: source._remove_channel(channel))
+        target._call_later(0, lambda: target._add_channel(channel))
@@ -2,14 +2,37 @@
 Handle the IRC connection for the bot
 """
 
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
-
 from threading import Thread
 from irc.bot import SingleServerIRCBot
-from time import sleep, time
+from time import time
+from .inbound import MessageEvent
+from .outbound import TokenBucket, AdaptiveTokenBucket, OutboundQueue, \
+    JoinScheduler, PRIORITY_COMMAND
+
+
+# Separator used when combining several chat messages into one
+MESSAGE_SEPARATOR = u" | "
+
+# Maximum length of a single chat message sent to Twitch, in bytes
+MAX_MESSAGE_BYTES = 500
+
+# Twitch NOTICE msg-ids telling us a message was not sent, and the text
+# used to recognize them when we don't have the msg-id tag available
+REJECTION_NOTICES = {
+    "msg_ratelimit": "sending messages too quickly",
+    "msg_duplicate": "identical to the previous one"
+}
+
+# Rate limit tiers, Twitch lets us send a lot more in channels where we are
+# the broadcaster, a moderator or a VIP
+TIER_USER = "user"
+TIER_MOD = "mod"
+
+# IRCv3 capabilities we request from Twitch
+TWITCH_CAPABILITIES = ("twitch.tv/tags", "twitch.tv/commands")
+
+# Badges that put us on the higher rate limit tier in a channel
+MOD_TIER_BADGES = ("broadcaster", "moderator", "vip")
 
 
 class Task(object):
@@ -23,6 +46,56 @@ class Task(object):
         self.args = args
         self.kwargs = kwargs
 
+    def __eq__(self, other):
+        return isinstance(other, Task) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def merge(self, other, max_bytes=MAX_MESSAGE_BYTES):
+        """
+        Combine two chat messages to the same channel into one, if the
+        result fits in a single message.
+
+        >>> from bot.ircwrapper import Task
+        >>> a = Task("_send_message", "#tmp", "Hello")
+        >>> b = Task("_send_message", "#tmp", "World")
+        >>> a.merge(b).args
+        ('#tmp', 'Hello | World')
+        >>> a.merge(b, max_bytes=10) is None
+        True
+
+        :param other: The Task to be sent after this one
+        :param max_bytes: Maximum length of the resulting message in bytes
+        :return: A new Task, or None if the tasks can't be combined
+        """
+
+        for task in (self, other):
+            if task.method != "_send_message" or task.kwargs:
+                return None
+
+            # Chat commands such as .timeout or /me need to be sent as is
+            if task.args[1].startswith((".", "/")):
+                return None
+
+        channel, text = self.args
+        other_channel, other_text = other.args
+
+        if channel != other_channel:
+            return None
+
+        text = text + MESSAGE_SEPARATOR + other_text
+        if len(text.encode("utf-8")) > max_bytes:
+            return None
+
+        return Task("_send_message", channel, text)
+
+    def _key(self):
+        return self.method, self.args, tuple(sorted(self.kwargs.items()))
+
     def __str__(self):
         return "<Task:(method={0},{1} args,{2} kwargs>".format(
             self.method,
@@ -31,54 +104,118 @@ class Task(object):
         )
 
 
-class IRCWrapper(SingleServerIRCBot):
+class UserContext(object):
     """
-    Convenient wrapper for the irc class methods, rate limits the messages
-    sent to the server to avoid being banned for spamming.
+    What Twitch told us about the user in the tags of a chat message, so we
+    don't need to look it up separately
+
+    >>> from bot.ircwrapper import UserContext
+    >>> c = UserContext(set(["broadcaster", "subscriber"]))
+    >>> c.is_mod, c.is_subscriber, c.is_vip
+    (True, True, False)
     """
 
-    def __init__(self, logger=None, bot=None, settings=None, channelList=None,
-                 nickname=None,
-                 server=None, password=None,
-                 port=6667, commandPrefix='!'):
+    def __init__(self, badges=None, mod=False):
+        """
+        :param badges: Set of the user's badge names
+        :param mod: Was the user flagged as a moderator
+        """
+
+        if badges is None:
+            badges = set()
+
+        self.badges = badges
+        self.is_broadcaster = "broadcaster" in badges
+        self.is_mod = mod or self.is_broadcaster or "moderator" in badges
+        self.is_subscriber = "subscriber" in badges or "founder" in badges
+        self.is_vip = "vip" in badges
+
+    def __repr__(self):
+        return "<UserContext:{0}>".format(",".join(sorted(self.badges)))
+
+
+class BaseIRCWrapper(object):
+    """
+    The parts of the IRC wrapper that don't depend on how we talk to the
+    server: outbound queueing and rate limiting, and handling the Twitch
+    chat events. The transport needs to provide a `connection` with
+    privmsg() and get_nickname(), a `channels` dict of irc.bot.Channel
+    objects, and call the on_* event handlers.
+    """
+
+    def _setup(self, logger, bot, settings, channelList, commandPrefix):
+        """
+        Initialize the shared state
+
+        :param logger: The logger to use
+        :param bot: The bot to relay the chat events to
+        :param settings: The bot settings
+        :param channelList: The channels to join
+        :param commandPrefix: The prefix for chat commands
+        :return: None
+        """
 
         self.bot = bot
         self.logger = logger
         self.channelList = channelList
         self.commandPrefix = commandPrefix
-        self.queue = Queue()
-        self.irc_thread = None
+        self.queue = None
+        self.event_queue = None
+        self.call_relay = None
         self.call_thread = None
         self.out_thread = None
-        self.call_relay = None
 
-        if bot:
-            self.queue_delay = settings.QUEUE_DELAY
-        else:
-            self.queue_delay = 1
+        self.channel_tiers = {}
 
-        serverList = []
-
-        if server:
-            if password:
-                self.logger.info(
-                    "Connecting to {0}:{1} using a password".format(
-                        server, port
-                    ))
-                serverList.append((server, port, password))
+        if bot:
+            self.rate_limits = {
+                TIER_USER: AdaptiveTokenBucket.for_limit(
+                    settings.RATE_LIMIT_MESSAGES,
+                    settings.RATE_LIMIT_PERIOD,
+                    settings.RATE_LIMIT_BURST
+                ),
+                TIER_MOD: AdaptiveTokenBucket.for_limit(
+                    settings.RATE_LIMIT_MOD_MESSAGES,
+                    settings.RATE_LIMIT_PERIOD,
+                    settings.RATE_LIMIT_MOD_BURST
+                )
+            }
+            if settings.OUTBOUND_COALESCE:
+                merge = Task.merge
             else:
-                self.logger.info(
-                    "Connecting to {0}:{1} with no password".format(
-                        server, port
-                    ))
-                serverList.append((server, port))
+                merge = None
+
+            self.queue = OutboundQueue(
+                settings.OUTBOUND_CHANNEL_QUEUE_SIZE,
+                settings.OUTBOUND_MESSAGE_TTL,
+                settings.OUTBOUND_DUPLICATE_WINDOW,
+                merge
+            )
+
+            # The burst must leave room for a refill rate, a batch larger
+            # than it is just sent over several JOINs
+            join_burst = min(settings.JOIN_BATCH_SIZE,
+                             settings.JOIN_RATE_LIMIT_JOINS - 1)
+
+            self.joins = JoinScheduler(
+                TokenBucket.for_limit(
+                    settings.JOIN_RATE_LIMIT_JOINS,
+                    settings.JOIN_RATE_LIMIT_PERIOD,
+                    join_burst
+                ),
+                settings.JOIN_BATCH_SIZE,
+                settings.JOIN_RETRY_DELAY,
+                settings.JOIN_MAX_ATTEMPTS
+            )
+        else:
+            self.rate_limits = {
+                TIER_USER: TokenBucket(1, 1),
+                TIER_MOD: TokenBucket(1, 1)
+            }
+            self.queue = OutboundQueue()
+            self.joins = JoinScheduler(TokenBucket(10, 1))
 
-        super(IRCWrapper, self).__init__(
-            server_list=serverList,
-            nickname=nickname,
-            realname=nickname,
-            reconnection_interval=15,
-        )
+        self.join_due = None
 
     # Public API
 
@@ -93,32 +230,26 @@ class IRCWrapper(SingleServerIRCBot):
         self.call_thread.daemon = True
         self.call_thread.start()
 
-    def start(self):
-        """
-        Start the IRC connection and thread
-
-        :return: None
-        """
-
-        self._start_threads()
-
-    def stop(self):
+    def set_event_queue(self, event_queue):
         """
-        Stop our threads etc.
+        Put the chat messages in the given queue for the bot to handle,
+        instead of calling the bot for every message
 
+        :param event_queue: A bot.inbound.InboundQueue
         :return: None
         """
 
-        self.queue.put(None)
-        self.call_relay.stop()
+        self.event_queue = event_queue
 
-    def message(self, channel, message):
+    def message(self, channel, message, priority=PRIORITY_COMMAND):
         """
         Request to send a message to the channel, request is placed in output
         buffering task queue.
 
         :param channel: The channel to send the message to
         :param message: The message to be sent
+        :param priority: Which outbound lane to use, one of the
+                         bot.outbound.PRIORITY_* constants
         :return: None
         """
 
@@ -131,7 +262,7 @@ class IRCWrapper(SingleServerIRCBot):
                 "_send_message",
                 channel,
                 line
-            ))
+            ), priority, channel)
 
     def is_oper(self, channel, nick):
         """
@@ -144,6 +275,44 @@ class IRCWrapper(SingleServerIRCBot):
 
         return self.channels[channel].is_oper(nick)
 
+    def get_rate_limit_stats(self):
+        """
+        Get the current outbound rate and how many messages the server has
+        rejected for each rate limit tier, and which tier each channel is on
+
+        :return: Dict with "tiers" and "channels"
+        """
+
+        tiers = {}
+        for tier, rate_limit in self.rate_limits.items():
+            if isinstance(rate_limit, AdaptiveTokenBucket):
+                tiers[tier] = rate_limit.get_stats()
+
+        return {
+            "tiers": tiers,
+            "channels": dict(self.channel_tiers)
+        }
+
+    def get_queue_stats(self):
+        """
+        Get the outbound queue counters for every priority lane, including
+        the current queue depth per channel
+
+        :return: Dict of lane name to dict of counters
+        """
+
+        return self.queue.get_stats()
+
+    def get_join_stats(self):
+        """
+        Get how many channels we're on or still trying to join, and which
+        ones we gave up on
+
+        :return: Dict of counters, and a list of the failed channels
+        """
+
+        return self.joins.get_stats()
+
     def get_users(self, channel):
         """
         Get the users currently in the given channel
@@ -154,11 +323,51 @@ class IRCWrapper(SingleServerIRCBot):
 
         users = []
         if channel in self.channels:
-            users = self.channels[channel].users()
+            users = list(self.channels[channel].users())
 
         return users
 
-    def _start_threads(self):
+    def _acquire_send(self, channel):
+        """
+        Try to take a token from the rate limit for the channel's tier
+
+        :param channel: The channel we want to send a message on
+        :return: 0 if we can send now, otherwise seconds until we can
+        """
+
+        rate_limit = self._get_rate_limit(channel)
+        if rate_limit.consume():
+            return 0
+
+        return rate_limit.delay()
+
+    def _get_rate_limit(self, channel):
+        """
+        Get the rate limit that applies to the channel
+
+        :param channel: Which channel
+        :return: A TokenBucket
+        """
+
+        return self.rate_limits[self.channel_tiers.get(channel, TIER_USER)]
+
+    def _set_channel_tier(self, channel, tier):
+        """
+        Update the rate limit tier for the channel
+
+        :param channel: Which channel
+        :param tier: TIER_USER or TIER_MOD
+        :return: None
+        """
+
+        if self.channel_tiers.get(channel, TIER_USER) != tier:
+            self.logger.info(u"Using {0} rate limit in {1}".format(
+                tier, channel
+            ))
+
+        self.channel_tiers[channel] = tier
+
+    def _start_outbound_thread(self):
         """
         Start a thread that will work on the tasks while preventing us from
         getting banned on Twitch servers etc.
@@ -168,24 +377,62 @@ class IRCWrapper(SingleServerIRCBot):
 
         def worker():
             while True:
-                task = self.queue.get()
+                task = self.queue.get(self._acquire_send)
 
                 if task == None:
                     return
 
                 self._process_task(task)
-                sleep(self.queue_delay)
 
         self.out_thread = Thread(target=worker)
         self.out_thread.daemon = True
         self.out_thread.start()
 
-        def irc():
-            super(IRCWrapper, self).start()
+    def _process_joins(self):
+        """
+        Send the next batch of JOINs if the join rate limit allows, and
+        schedule the next check
 
-        self.irc_thread = Thread(target=irc)
-        self.irc_thread.daemon = True
-        self.irc_thread.start()
+        :return: None
+        """
+
+        self.join_due = None
+
+        channels, wait = self.joins.poll()
+        if channels:
+            self.logger.info(u"Joining {0}".format(", ".join(channels)))
+            self.connection.join(",".join(channels))
+
+        if wait is not None:
+            self._schedule_joins(wait)
+
+    def _schedule_joins(self, wait):
+        """
+        Run _process_joins after a delay, unless it's already scheduled to
+        run before that
+
+        :param wait: Seconds to wait
+        :return: None
+        """
+
+        due = time() + wait
+        if self.join_due is not None and self.join_due <= due:
+            return
+
+        self.join_due = due
+        self._call_later(wait, self._process_joins)
+
+    def _call_later(self, delay, function):
+        """
+        Call the function on the connection's thread after a delay, to be
+        implemented by the transport
+
+        :param delay: Seconds to wait
+        :param function: Function to call without arguments
+        :return: None
+        """
+
+        raise NotImplementedError()
 
     def _process_task(self, task):
         """
@@ -214,6 +461,114 @@ class IRCWrapper(SingleServerIRCBot):
 
         self.connection.privmsg(channel, message)
 
+    def on_pubnotice(self, connection, event):
+        """
+        Event handler run when the server sends a NOTICE to a channel, e.g. to
+        tell us our message was not sent
+
+        :param connection: The irc connection object
+        :param event: An event containing more relevant info
+        :return: None
+        """
+
+        self._handle_notice(event)
+
+    def on_privnotice(self, connection, event):
+        """
+        Event handler run when the server sends a NOTICE to us directly
+
+        :param connection: The irc connection object
+        :param event: An event containing more relevant info
+        :return: None
+        """
+
+        self._handle_notice(event)
+
+    def _handle_notice(self, event):
+        """
+        Check if the NOTICE says one of our messages was rejected, and slow
+        down if we were sending too quickly
+
+        :param event: A NOTICE event
+        :return: None
+        """
+
+        msg_id = self._get_notice_id(event)
+        if msg_id not in REJECTION_NOTICES:
+            return
+
+        self.logger.warn(u"Message rejected by server ({0}) on {1}".format(
+            msg_id, self._get_event_channel(event)
+        ))
+
+        rate_limit = self._get_rate_limit(self._get_event_channel(event))
+        if isinstance(rate_limit, AdaptiveTokenBucket):
+            rate_limit.reject(msg_id)
+
+    def on_userstate(self, connection, event):
+        """
+        Event handler run when Twitch tells us about our own state on a
+        channel, after joining and after every message we send. Picks the
+        rate limit tier based on our badges.
+
+        :param connection: The irc connection object
+        :param event: An event containing more relevant info
+        :return: None
+        """
+
+        tags = self._get_event_tags(event)
+        badges = self._get_badges(tags)
+
+        tier = TIER_USER
+        if tags.get("mod") == "1":
+            tier = TIER_MOD
+        else:
+            for badge in MOD_TIER_BADGES:
+                if badge in badges:
+                    tier = TIER_MOD
+
+        self._set_channel_tier(self._get_event_channel(event), tier)
+
+    def on_mode(self, connection, event):
+        """
+        Event handler run when channel modes change, e.g. when someone is
+        (un)modded
+
+        :param connection: The irc connection object
+        :param event: An event containing more relevant info
+        :return: None
+        """
+
+        self._check_oper_tier(connection, self._get_event_channel(event))
+
+    def on_namreply(self, connection, event):
+        """
+        Event handler run when we get the list of users on a channel
+
+        :param connection: The irc connection object
+        :param event: An event containing more relevant info
+        :return: None
+        """
+
+        self._check_oper_tier(connection, event.arguments[1])
+
+    def _check_oper_tier(self, connection, channel):
+        """
+        Switch to the mod tier rate limits if we are an operator on the
+        channel. Only ever upgrades the tier, USERSTATE is the authority on
+        losing moderator status.
+
+        :param connection: The irc connection object
+        :param channel: Which channel
+        :return: None
+        """
+
+        if channel not in self.channels:
+            return
+
+        if self.channels[channel].is_oper(connection.get_nickname()):
+            self._set_channel_tier(channel, TIER_MOD)
+
     def on_disconnect(self, connection, event):
         """
         Event handler run when the bot is disconnected from the server
@@ -227,10 +582,14 @@ class IRCWrapper(SingleServerIRCBot):
             repr(event)
         ))
 
+        # Everything is rejoined after reconnecting
+        self.joins.reset()
+        self.join_due = None
+
     def on_welcome(self, connection, event):
         """
         Event handler run after connection to server has been established,
-        joins the channels the bot should be on.
+        starts joining the channels the bot should be on.
 
         :param connection: The irc connection object
         :param event: An event containing more relevant info
@@ -239,9 +598,11 @@ class IRCWrapper(SingleServerIRCBot):
 
         self.logger.info("Connected to server, joining channels...")
 
-        for channel in self.channelList:
-            self.logger.info("Joining channel {0}".format(channel))
-            connection.join(channel)
+        # Ask Twitch to send us USERSTATE etc. and tag the messages
+        connection.cap("REQ", *TWITCH_CAPABILITIES)
+
+        self.joins.add(self.channelList)
+        self._process_joins()
 
     def on_join(self, connection, event):
         """
@@ -254,7 +615,12 @@ class IRCWrapper(SingleServerIRCBot):
         """
 
         channel = self._get_event_channel(event)
-        self.logger.info("Joined {0}".format(channel))
+        nick = self._get_event_nick(event)
+
+        # Twitch sends the nick in lowercase
+        if nick.lower() == connection.get_nickname().lower():
+            self.logger.info("Joined {0}".format(channel))
+            self.joins.confirm(channel)
 
     def on_pubmsg(self, connection, event, timestamp=None):
         """
@@ -268,6 +634,9 @@ class IRCWrapper(SingleServerIRCBot):
         text = self._get_event_text(event)
         channel = self._get_event_channel(event)
         nick = self._get_event_nick(event)
+        context = self._get_user_context(event)
+
+        self.joins.record_activity(channel)
 
         if timestamp is None:
             timestamp = time()
@@ -275,11 +644,22 @@ class IRCWrapper(SingleServerIRCBot):
         cmd = False
         command, args = self._get_command(text)
 
+        if self.event_queue:
+            # Don't wait for the bot, it handles the events when it can
+            self.event_queue.put(MessageEvent(
+                channel, nick, text, timestamp, context, command, args
+            ))
+            return
+
         if command:
-            cmd = self.bot.irc_command(channel, nick, command, args, timestamp)
+            cmd = self.bot.irc_command(
+                channel, nick, command, args, timestamp, context=context
+            )
 
         if not cmd:
-            self.bot.chat_message(channel, nick, text, timestamp)
+            self.bot.chat_message(
+                channel, nick, text, timestamp, context=context
+            )
 
     def _get_event_channel(self, event):
         """
@@ -301,6 +681,74 @@ class IRCWrapper(SingleServerIRCBot):
 
         return event.arguments[0]
 
+    def _get_event_tags(self, event):
+        """
+        Get the IRCv3 tags sent with the event
+
+        :param event: An event object
+        :return: Dict of tag names to values, empty if there were no tags
+        """
+
+        tags = {}
+        for tag in getattr(event, "tags", None) or []:
+            tags[tag["key"]] = tag["value"]
+
+        return tags
+
+    def _get_user_context(self, event):
+        """
+        Build the UserContext for a message event from its tags
+
+        :param event: A message event
+        :return: A UserContext, or None if the message had no tags
+        """
+
+        tags = self._get_event_tags(event)
+        if not tags:
+            return None
+
+        return UserContext(self._get_badges(tags), tags.get("mod") == "1")
+
+    def _get_badges(self, tags):
+        """
+        Get the names of the Twitch badges in the tags
+
+        >>> from bot.ircwrapper import IRCWrapper
+        >>> i = IRCWrapper()
+        >>> sorted(i._get_badges({"badges": "moderator/1,subscriber/12"}))
+        ['moderator', 'subscriber']
+
+        :param tags: Dict of IRCv3 tags
+        :return: Set of badge names
+        """
+
+        badges = set()
+        for badge in (tags.get("badges") or "").split(","):
+            if badge:
+                badges.add(badge.split("/")[0])
+
+        return badges
+
+    def _get_notice_id(self, event):
+        """
+        Figure out the Twitch msg-id for a NOTICE event, from the tags if
+        available, otherwise by recognizing the text
+
+        :param event: A NOTICE event
+        :return: The msg-id, or None if unknown
+        """
+
+        tags = self._get_event_tags(event)
+        if "msg-id" in tags:
+            return tags["msg-id"]
+
+        text = self._get_event_text(event)
+        for msg_id, notice_text in REJECTION_NOTICES.items():
+            if notice_text in text:
+                return msg_id
+
+        return None
+
     def _get_event_nick(self, event):
         """
         Get the nick for the user that triggered this message event
@@ -341,3 +789,99 @@ class IRCWrapper(SingleServerIRCBot):
         args = parts[1:]
 
         return command, args
+
+
+class IRCWrapper(BaseIRCWrapper, SingleServerIRCBot):
+    """
+    Convenient wrapper for the irc class methods, rate limits the messages
+    sent to the server with a token bucket to avoid being banned for spamming.
+    """
+
+    def __init__(self, logger=None, bot=None, settings=None, channelList=None,
+                 nickname=None,
+                 server=None, password=None,
+                 port=6667, commandPrefix='!'):
+
+        self._setup(logger, bot, settings, channelList, commandPrefix)
+        self.irc_thread = None
+
+        serverList = []
+
+        if server:
+            if password:
+                self.logger.info(
+                    "Connecting to {0}:{1} using a password".format(
+                        server, port
+                    ))
+                serverList.append((server, port, password))
+            else:
+                self.logger.info(
+                    "Connecting to {0}:{1} with no password".format(
+                        server, port
+                    ))
+                serverList.append((server, port))
+
+        super(IRCWrapper, self).__init__(
+            server_list=serverList,
+            nickname=nickname,
+            realname=nickname,
+            reconnection_interval=15,
+        )
+
+    # Public API
+
+    def start(self):
+        """
+        Start the IRC connection and thread
+
+        :return: None
+        """
+
+        self._start_threads()
+
+    def stop(self):
+        """
+        Stop our threads etc.
+
+        :return: None
+        """
+
+        self.queue.close()
+
+        if self.call_relay:
+            self.call_relay.stop()
+
+    def _call_later(self, delay, function):
+        """
+        Call the function on the IRC thread after a delay
+
+        :param delay: Seconds to wait
+        :param function: Function to call without arguments
+        :return: None
+        """
+
+        self.reactor.execute_delayed(delay, function)
+
+    def _start_threads(self):
+        """
+        Start the outbound thread and the thread running the IRC connection
+
+        :return: None
+        """
+
+        self._start_outbound_thread()
+        self._start_irc_thread()
+
+    def _start_irc_thread(self):
+        """
+        Start a thread that connects to the server and processes the events
+
+        :return: None
+        """
+
+        def irc():
+            super(IRCWrapper, self).start()
+
+        self.irc_thread = Thread(target=irc)
+        self.irc_thread.daemon = True
+        self.irc_thread.start()
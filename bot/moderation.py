@@ -0,0 +1,343 @@
+"""
+Check the chat lines against the blacklists in separate processes, so the
+channels with huge rule sets don't keep the bot's own thread busy
+"""
+
+from multiprocessing import Process, Queue as MPQueue
+from threading import Lock, Thread
+from time import time
+from .blacklist import BlacklistManager
+
+try:
+    from Queue import Full
+except ImportError:
+    from queue import Full
+
+
+class Rule(object):
+    """
+    A copy of a black- or whitelist rule with just the fields the
+    BlacklistManager uses, to send to the worker processes instead of the
+    database model
+    """
+
+    def __init__(self, rule_id, match, banTime=None):
+        self.id = rule_id
+        self.match = match
+        self.banTime = banTime
+
+    @classmethod
+    def copy(cls, rule):
+        """
+        Copy the fields of a rule
+
+        :param rule: Any object with id, match and optionally banTime
+        :return: A Rule
+        """
+
+        return cls(rule.id, rule.match, getattr(rule, "banTime", None))
+
+
+class ModerationPool(object):
+    """
+    Checks chat lines against the blacklists of some of the channels in a
+    number of worker processes. Every such channel is assigned to one of
+    the processes, which keeps its own BlacklistManager with a copy of the
+    channel's rules.
+
+    The rule changes and the lines to check for a channel go through the
+    same queue, so a line is always checked against the rules as they were
+    when it was submitted. The verdicts arrive on a thread of this process,
+    which calls the callback given to check().
+
+    Every process has a queue of at most queue_size lines. If a process is
+    that far behind, check() refuses the line so the caller can check it
+    itself instead.
+
+    >>> from bot.moderation import ModerationPool, Rule
+    >>> from threading import Event
+    >>> pool = ModerationPool(1)
+    >>> pool.start()
+    >>> pool.set_rules("#foo", [Rule(1, "spam", "1m")], [])
+    >>> done = Event()
+    >>> verdicts = []
+    >>> pool.check("#foo", "spam spam", lambda verdict: (
+    ...     verdicts.append(verdict), done.set()))
+    True
+    >>> done.wait(10)
+    True
+    >>> pool.stop()
+    >>> verdicts
+    [(True, 1, 60)]
+    """
+
+    def __init__(self, processes, queue_size=1000, cache_size=1000,
+                 logger=None, clock=time):
+        """
+        :param processes: Number of worker processes
+        :param queue_size: Maximum number of lines waiting per process
+        :param cache_size: Size of the verdict cache in each process
+        :param logger: Logger for errors
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.logger = logger
+        self.clock = clock
+        self.cache_size = cache_size
+        self.lock = Lock()
+        self.queues = [MPQueue(queue_size) for i in range(processes)]
+        self.results = MPQueue()
+        self.processes = []
+        self.thread = None
+
+        self.shards = {}
+        self.pending = {}
+        self.next_id = 0
+
+        self.checked = 0
+        self.refused = 0
+        self.total_time = 0.0
+
+    def start(self):
+        """
+        Start the worker processes, and the thread receiving the verdicts
+
+        :return: None
+        """
+
+        for queue in self.queues:
+            process = Process(
+                target=run_moderation_worker,
+                args=(queue, self.results, self.cache_size)
+            )
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        # Start our thread only after forking the workers
+        self.thread = Thread(target=self._receive)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the worker processes once they have checked the lines already
+        submitted
+
+        :return: None
+        """
+
+        for queue in self.queues:
+            queue.put(None)
+
+        for process in self.processes:
+            process.join(10)
+
+        if self.thread:
+            self.results.put(None)
+            self.thread.join()
+
+        self.processes = []
+        self.thread = None
+
+    def __contains__(self, channel):
+        return channel in self.shards
+
+    def set_rules(self, channel, blacklist, whitelist):
+        """
+        Start checking the channel's lines in the pool, or replace all of
+        its rules
+
+        :param channel: Which channel
+        :param blacklist: List of the blacklist rules
+        :param whitelist: List of the whitelist rules
+        :return: None
+        """
+
+        with self.lock:
+            if channel not in self.shards:
+                index = len(self.shards) % len(self.queues)
+                self.shards[channel] = self.queues[index]
+
+        self._send(channel, "set_data",
+                   [Rule.copy(rule) for rule in blacklist],
+                   [Rule.copy(rule) for rule in whitelist])
+
+    def add_blacklist(self, channel, rule):
+        """
+        Add a rule to the channel's blacklist
+
+        :param channel: Which channel
+        :param rule: The rule
+        :return: None
+        """
+
+        self._send(channel, "add_blacklist", Rule.copy(rule))
+
+    def add_whitelist(self, channel, rule):
+        """
+        Add a rule to the channel's whitelist
+
+        :param channel: Which channel
+        :param rule: The rule
+        :return: None
+        """
+
+        self._send(channel, "add_whitelist", Rule.copy(rule))
+
+    def remove_blacklist(self, channel, rule_id):
+        """
+        Remove a rule from the channel's blacklist
+
+        :param channel: Which channel
+        :param rule_id: The rule ID
+        :return: None
+        """
+
+        self._send(channel, "remove_blacklist", rule_id)
+
+    def remove_whitelist(self, channel, rule_id):
+        """
+        Remove a rule from the channel's whitelist
+
+        :param channel: Which channel
+        :param rule_id: The rule ID
+        :return: None
+        """
+
+        self._send(channel, "remove_whitelist", rule_id)
+
+    def check(self, channel, line, callback):
+        """
+        Check the line against the channel's rules in its worker process
+
+        :param channel: Which channel, added with set_rules()
+        :param line: The chat line
+        :param callback: Called with the is_blacklisted() verdict, from the
+                         thread receiving the verdicts
+        :return: True if the line will be checked, False if the process is
+                 too far behind
+        """
+
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 1
+            self.pending[request_id] = (callback, self.clock())
+
+        try:
+            self.shards[channel].put_nowait(
+                (channel, "is_blacklisted", (line,), request_id)
+            )
+        except Full:
+            with self.lock:
+                del self.pending[request_id]
+                self.refused += 1
+            return False
+
+        return True
+
+    def get_stats(self):
+        """
+        Get how many lines have been checked in the pool, and how long it
+        took for the verdicts to arrive
+
+        :return: Dict with "channels", "pending", "checked", "refused" and
+                 "average_time"
+        """
+
+        with self.lock:
+            average_time = 0.0
+            if self.checked:
+                average_time = self.total_time / self.checked
+
+            return {
+                "channels": len(self.shards),
+                "pending": len(self.pending),
+                "checked": self.checked,
+                "refused": self.refused,
+                "average_time": average_time
+            }
+
+    def _send(self, channel, method, *args):
+        """
+        Call a BlacklistManager method in the channel's worker process.
+        Blocks if the queue is full, as the rules must not get out of sync.
+
+        :param channel: Which channel
+        :param method: Name of the method
+        :return: None
+        """
+
+        self.shards[channel].put((channel, method, args, None))
+
+    def _receive(self):
+        """
+        Main loop of the thread receiving the verdicts
+
+        :return: None
+        """
+
+        while True:
+            result = self.results.get()
+
+            # Magic message telling us to stop
+            if result is None:
+                break
+
+            request_id, verdict = result
+
+            with self.lock:
+                callback, submitted = self.pending.pop(request_id)
+                self.checked += 1
+                self.total_time += self.clock() - submitted
+
+            if verdict is None:
+                if self.logger:
+                    self.logger.error(u"Checking a line against the "
+                                      u"blacklist failed")
+                continue
+
+            try:
+                callback(verdict)
+            except Exception:
+                if self.logger:
+                    self.logger.error(u"Blacklist verdict callback failed",
+                                      exc_info=True)
+
+
+def run_moderation_worker(tasks, results, cache_size):
+    """
+    Main function of a moderation worker process, keeps a BlacklistManager
+    for each of its channels and runs the methods it's told to
+
+    :param tasks: Queue of (channel, method, args, request_id) tuples
+    :param results: Queue for the (request_id, result) of the tasks with a
+                    request_id
+    :param cache_size: Size of the verdict cache of the BlacklistManagers
+    :return: None
+    """
+
+    managers = {}
+
+    while True:
+        task = tasks.get()
+
+        # Magic message telling us to stop
+        if task is None:
+            break
+
+        channel, method, args, request_id = task
+
+        manager = managers.get(channel)
+        if manager is None:
+            manager = BlacklistManager(cache_size=cache_size)
+            managers[channel] = manager
+
+        try:
+            result = getattr(manager, method)(*args)
+        except Exception:
+            # Logged by the main process, we may not have a log file here
+            result = None
+
+        if request_id is not None:
+            results.put((request_id, result))
@@ -0,0 +1,905 @@
+"""
+Outbound message scheduling for the IRC connection
+"""
+
+from collections import deque
+from threading import Condition, Lock
+from time import time
+
+# Priority lanes for outbound messages, lower number is drained first
+PRIORITY_MODERATION = 0
+PRIORITY_COMMAND = 1
+PRIORITY_CUSTOM = 2
+
+PRIORITY_NAMES = (
+    "moderation",
+    "command",
+    "custom"
+)
+
+# Maximum length of an IRC line, without the trailing CRLF
+MAX_LINE_BYTES = 510
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter. Holds up to `burst` tokens that are refilled
+    continuously at `rate` tokens per second, every message sent consumes
+    one token. Bursts go out immediately, we only throttle once the bucket
+    runs empty. Safe to share between threads.
+
+    >>> from bot.outbound import TokenBucket
+    >>> now = [0.0]
+    >>> bucket = TokenBucket(2, 0.5, clock=lambda: now[0])
+    >>> bucket.consume(), bucket.consume(), bucket.consume()
+    (True, True, False)
+    >>> bucket.delay()
+    2.0
+    >>> now[0] = 2.0
+    >>> bucket.consume()
+    True
+    """
+
+    def __init__(self, burst, rate, clock=time):
+        """
+        :param burst: Maximum number of tokens the bucket can hold
+        :param rate: How many tokens are added per second
+        :param clock: Function returning the current time in seconds
+        """
+
+        # Floats, so the delays are not integer divisions on Python 2
+        self.burst = float(burst)
+        self.rate = float(rate)
+        self.clock = clock
+        self.lock = Lock()
+        self.tokens = self.burst
+        self.updated = clock()
+
+    @classmethod
+    def for_limit(cls, messages, period, burst, clock=time):
+        """
+        Create a bucket that never lets more than `messages` through in any
+        window of `period` seconds, e.g. Twitch's "20 messages per 30
+        seconds". The first `burst` messages are sent immediately, the
+        remaining allowance is spread evenly over the window.
+
+        >>> from bot.outbound import TokenBucket
+        >>> bucket = TokenBucket.for_limit(20, 30, 5)
+        >>> bucket.burst, bucket.rate
+        (5.0, 0.5)
+
+        :param messages: How many messages are allowed per window
+        :param period: Length of the window in seconds
+        :param burst: How many messages can be sent back to back
+        :param clock: Function returning the current time in seconds
+        :return: A new TokenBucket
+        :raise ValueError: If burst does not leave room for a refill rate
+        """
+
+        if burst < 1 or burst >= messages:
+            raise ValueError(
+                u"Burst must be between 1 and {0}, got {1}".format(
+                    messages - 1, burst
+                )
+            )
+
+        return cls(burst, float(messages - burst) / period, clock)
+
+    def delay(self, tokens=1):
+        """
+        How long until the given number of tokens are available
+
+        :param tokens: How many tokens we want
+        :return: Number of seconds to wait, 0 if available right now
+        """
+
+        with self.lock:
+            self._refill()
+
+            missing = tokens - self.tokens
+            if missing <= 0:
+                return 0
+
+            return missing / self.rate
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket, if there are enough of them
+
+        :param tokens: How many tokens to take
+        :return: True if the tokens were taken, False if we need to wait
+        """
+
+        with self.lock:
+            self._refill()
+
+            if self.tokens < tokens:
+                return False
+
+            self.tokens -= tokens
+            return True
+
+    def _refill(self):
+        """
+        Add the tokens accumulated since the last update. Call with the lock
+        held.
+
+        :return: None
+        """
+
+        now = self.clock()
+        elapsed = max(0, now - self.updated)
+        self.updated = now
+
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    Token bucket that adjusts its refill rate based on feedback from the
+    server. When told we're sending too quickly the rate is cut down, after
+    that it's slowly probed back up towards the configured ceiling.
+
+    >>> from bot.outbound import AdaptiveTokenBucket
+    >>> now = [0.0]
+    >>> bucket = AdaptiveTokenBucket(5, 0.5, clock=lambda: now[0])
+    >>> bucket.reject("msg_ratelimit")
+    >>> bucket.rate
+    0.25
+    >>> now[0] = 60.0
+    >>> bucket.consume()
+    True
+    >>> bucket.rate
+    0.35
+    """
+
+    def __init__(self, burst, rate, clock=time, backoff=0.5, step=0.1,
+                 probe_interval=30, min_rate=None):
+        """
+        :param burst: Maximum number of tokens the bucket can hold
+        :param rate: The highest refill rate we're allowed to use
+        :param clock: Function returning the current time in seconds
+        :param backoff: Multiplier for the rate when rate limited
+        :param step: How much of the ceiling rate to add when probing back up
+        :param probe_interval: Seconds between each step back up
+        :param min_rate: The rate never goes below this, by default a tenth
+                         of the ceiling
+        """
+
+        super(AdaptiveTokenBucket, self).__init__(burst, rate, clock)
+
+        if min_rate is None:
+            min_rate = self.rate / 10.0
+
+        self.ceiling = self.rate
+        self.backoff = backoff
+        self.step = step
+        self.probe_interval = probe_interval
+        self.min_rate = min_rate
+        self.changed = self.updated
+        self.rejected = {}
+
+    @classmethod
+    def for_limit(cls, messages, period, burst, clock=time):
+        """
+        Create an adaptive bucket for Twitch style "N messages per period"
+        limits, probing back up once per period
+
+        :param messages: How many messages are allowed per window
+        :param period: Length of the window in seconds
+        :param burst: How many messages can be sent back to back
+        :param clock: Function returning the current time in seconds
+        :return: A new AdaptiveTokenBucket
+        """
+
+        bucket = super(AdaptiveTokenBucket, cls).for_limit(
+            messages, period, burst, clock
+        )
+        bucket.probe_interval = period
+
+        return bucket
+
+    def reject(self, reason):
+        """
+        Record a message rejected by the server. Being rate limited makes us
+        back off and throws away any tokens we have left.
+
+        :param reason: Why the message was rejected, e.g. "msg_ratelimit"
+        :return: None
+        """
+
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+            if reason == "msg_ratelimit":
+                self._refill()
+                self.tokens = 0.0
+                self.rate = max(self.min_rate, self.rate * self.backoff)
+                self.changed = self.clock()
+
+    def get_stats(self):
+        """
+        Get the current rate limiting state
+
+        :return: Dict with the current rate, ceiling and rejection counts
+        """
+
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "ceiling": self.ceiling,
+                "rejected": dict(self.rejected)
+            }
+
+    def _refill(self):
+        """
+        Add the tokens accumulated since the last update, and step the rate
+        back up towards the ceiling if it's been a while since it changed
+
+        :return: None
+        """
+
+        super(AdaptiveTokenBucket, self)._refill()
+
+        if self.rate < self.ceiling:
+            steps = int((self.updated - self.changed) / self.probe_interval)
+            if steps > 0:
+                self.rate = min(
+                    self.ceiling,
+                    self.rate + steps * self.step * self.ceiling
+                )
+                self.changed = self.updated
+
+
+class Lane(object):
+    """
+    A single priority lane of the OutboundQueue. Every channel gets its own
+    FIFO within the lane, and the channels are drained round-robin so one
+    busy channel can not starve the others.
+    """
+
+    def __init__(self, max_depth=None):
+        """
+        :param max_depth: Maximum number of tasks queued per channel, the
+                          oldest task is dropped when exceeded. None for no
+                          limit.
+        """
+
+        self.max_depth = max_depth
+        self.queues = {}
+        self.order = deque()
+
+        self.queued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.expired = 0
+        self.duplicates = 0
+        self.merged = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, channel, item):
+        """
+        Add an item to the end of the channel's queue
+
+        :param channel: The channel the item is for
+        :param item: The item to queue
+        :return: None
+        """
+
+        if channel not in self.queues:
+            self.queues[channel] = deque()
+            self.order.append(channel)
+
+        queue = self.queues[channel]
+        queue.append(item)
+        self.queued += 1
+
+        if self.max_depth is not None and len(queue) > self.max_depth:
+            queue.popleft()
+            self.dropped += 1
+
+    def pop(self, channel):
+        """
+        Take the next item from the channel's queue, and move the channel to
+        the back of the line
+
+        :param channel: Which channel
+        :return: The item
+        """
+
+        queue = self.queues[channel]
+        item = queue.popleft()
+
+        self.order.remove(channel)
+        if queue:
+            self.order.append(channel)
+        else:
+            del self.queues[channel]
+
+        return item
+
+    def peek(self, channel):
+        """
+        Look at the next item in the channel's queue without removing it
+
+        :param channel: Which channel
+        :return: The item, or None if nothing is queued for the channel
+        """
+
+        if channel in self.queues:
+            return self.queues[channel][0]
+
+        return None
+
+    def discard(self, channel):
+        """
+        Remove the next item from the channel's queue, e.g. after it has been
+        merged with another one
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        queue = self.queues[channel]
+        queue.popleft()
+
+        if not queue:
+            del self.queues[channel]
+            self.order.remove(channel)
+
+    def depth(self, channel):
+        """
+        Get the number of items queued for the channel
+
+        :param channel: Which channel
+        :return: Number of items
+        """
+
+        if channel in self.queues:
+            return len(self.queues[channel])
+
+        return 0
+
+    def record_sent(self, wait):
+        """
+        Update the counters for an item leaving the lane
+
+        :param wait: How many seconds the item was queued for
+        :return: None
+        """
+
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def get_stats(self):
+        """
+        Get the lane counters as a dict
+
+        :return: Dict of the counters
+        """
+
+        if self.sent:
+            average_wait = self.total_wait / self.sent
+        else:
+            average_wait = 0.0
+
+        return {
+            "queued": self.queued,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "expired": self.expired,
+            "duplicates": self.duplicates,
+            "merged": self.merged,
+            "depth": len(self),
+            "average_wait": average_wait,
+            "max_wait": self.max_wait,
+            "channels": dict(
+                (channel, len(queue))
+                for channel, queue in self.queues.items()
+            )
+        }
+
+
+class OutboundQueue(object):
+    """
+    Thread safe queue for the outbound Tasks, with a separate lane for every
+    priority class. The highest priority non-empty lane is always drained
+    first, so e.g. moderation actions never wait behind chat replies. Within
+    a lane every channel has its own queue and the channels take turns, so
+    latency in a quiet channel stays low regardless of load elsewhere.
+
+    Outside of the moderation lane tasks can also be expired after a while,
+    exact duplicates queued within a short window are dropped, and
+    consecutive tasks for the same channel can be merged into one to cut
+    down on the number of messages sent.
+
+    >>> from bot.outbound import OutboundQueue, PRIORITY_MODERATION
+    >>> q = OutboundQueue()
+    >>> q.put("reply1", channel="#a")
+    >>> q.put("reply2", channel="#a")
+    >>> q.put("reply3", channel="#b")
+    >>> q.put("timeout", PRIORITY_MODERATION, "#b")
+    >>> q.get(), q.get(), q.get(), q.get()
+    ('timeout', 'reply1', 'reply3', 'reply2')
+    """
+
+    def __init__(self, max_depth=None, ttl=None, duplicate_window=None,
+                 merge=None, clock=time):
+        """
+        :param max_depth: Maximum number of queued tasks per channel in the
+                          non-moderation lanes, the oldest task is dropped
+                          when exceeded. None for no limit.
+        :param ttl: Seconds after which a non-moderation task is considered
+                    stale and discarded instead of sent. None to disable.
+        :param duplicate_window: Seconds during which a task equal to a
+                                 previously queued one for the same channel
+                                 is dropped. None to disable.
+        :param merge: Function taking two tasks and returning a single task
+                      combining them, or None if they can't be combined.
+                      None to disable merging.
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.ttl = ttl
+        self.duplicate_window = duplicate_window
+        self.merge = merge
+        self.clock = clock
+        self.condition = Condition()
+        self.lanes = [
+            Lane(None if priority == PRIORITY_MODERATION else max_depth)
+            for priority in range(len(PRIORITY_NAMES))
+        ]
+        self.recent = {}
+        self.recent_order = deque()
+        self.closed = False
+
+    def put(self, task, priority=PRIORITY_COMMAND, channel=None):
+        """
+        Add a task to the end of the channel's queue in the given priority
+        lane
+
+        :param task: The task to add
+        :param priority: One of the PRIORITY_* constants
+        :param channel: The channel the task is for
+        :return: None
+        """
+
+        with self.condition:
+            now = self.clock()
+            lane = self.lanes[priority]
+
+            if priority != PRIORITY_MODERATION:
+                if self._is_duplicate(channel, task, now):
+                    lane.duplicates += 1
+                    return
+
+            lane.put(channel, (now, task))
+            self.condition.notify()
+
+    def get(self, acquire=None):
+        """
+        Get the next task, waiting until one is available
+
+        :param acquire: Function called with the channel before a task for
+                        it is taken from the queue, should return 0 if the
+                        task can be sent now, or the number of seconds until
+                        it can. Channels that are not ready are skipped.
+        :return: The next task, or None if the queue has been closed
+        """
+
+        with self.condition:
+            while True:
+                if self.closed:
+                    return None
+
+                task, wait = self._poll(acquire)
+                if task is not None:
+                    return task
+
+                self.condition.wait(wait)
+
+    def poll(self, acquire=None):
+        """
+        Get the next task if one can be sent right now, without waiting
+
+        :param acquire: Function called with the channel before a task for
+                        it is taken from the queue, see get()
+        :return: The task or None, and if there was no task the number of
+                 seconds until one might be ready, None if there are no
+                 tasks at all
+        """
+
+        with self.condition:
+            return self._poll(acquire)
+
+    def close(self):
+        """
+        Close the queue, anyone waiting in get() will receive None
+
+        :return: None
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def qsize(self):
+        """
+        Get the total number of tasks waiting in all lanes
+
+        :return: Number of tasks
+        """
+
+        with self.condition:
+            return sum(len(lane) for lane in self.lanes)
+
+    def channel_depth(self, channel):
+        """
+        Get the number of tasks waiting for the channel in all lanes
+
+        :param channel: Which channel
+        :return: Number of tasks
+        """
+
+        with self.condition:
+            return sum(lane.depth(channel) for lane in self.lanes)
+
+    def get_stats(self):
+        """
+        Get the counters for every priority lane
+
+        :return: Dict of lane name to dict of counters
+        """
+
+        with self.condition:
+            return dict(
+                (name, self.lanes[priority].get_stats())
+                for priority, name in enumerate(PRIORITY_NAMES)
+            )
+
+    def _is_duplicate(self, channel, task, now):
+        """
+        Check if an equal task was queued for the channel within the
+        duplicate window, and remember this one
+
+        :param channel: The channel the task is for
+        :param task: The task being queued
+        :param now: Current time
+        :return: True or False
+        """
+
+        if self.duplicate_window is None:
+            return False
+
+        # Forget about tasks that are outside of the window
+        while self.recent_order:
+            queued, key = self.recent_order[0]
+            if now - queued <= self.duplicate_window:
+                break
+
+            self.recent_order.popleft()
+            if self.recent.get(key) == queued:
+                del self.recent[key]
+
+        key = (channel, task)
+        if key in self.recent:
+            return True
+
+        self.recent[key] = now
+        self.recent_order.append((now, key))
+
+        return False
+
+    def _poll(self, acquire):
+        """
+        Take the next task that can be sent, the caller must hold the lock
+
+        :param acquire: Function called with the channel before a task for
+                        it is taken from the queue, see get()
+        :return: The task or None, and seconds to wait or None
+        """
+
+        wait = None
+
+        for priority, lane in enumerate(self.lanes):
+            for channel in list(lane.order):
+                if not self._expire(priority, lane, channel):
+                    continue
+
+                if acquire:
+                    delay = acquire(channel)
+                    if delay > 0:
+                        if wait is None or delay < wait:
+                            wait = delay
+                        continue
+
+                queued, task = lane.pop(channel)
+
+                if priority != PRIORITY_MODERATION and self.merge:
+                    task = self._merge_queued(lane, channel, task)
+
+                lane.record_sent(self.clock() - queued)
+                return task, None
+
+        return None, wait
+
+    def _expire(self, priority, lane, channel):
+        """
+        Discard any stale tasks from the front of the channel's queue
+
+        :param priority: The priority of the lane
+        :param lane: The lane to check
+        :param channel: Which channel
+        :return: True if there are still tasks queued for the channel
+        """
+
+        if priority == PRIORITY_MODERATION or self.ttl is None:
+            return True
+
+        now = self.clock()
+
+        while True:
+            item = lane.peek(channel)
+            if item is None:
+                return False
+
+            queued, task = item
+            if now - queued <= self.ttl:
+                return True
+
+            lane.discard(channel)
+            lane.expired += 1
+
+    def _merge_queued(self, lane, channel, task):
+        """
+        Merge as many of the tasks queued next for the channel into the
+        given task as possible
+
+        :param lane: The lane the task came from
+        :param channel: The channel the task is for
+        :param task: The task about to be sent
+        :return: The resulting task
+        """
+
+        while True:
+            item = lane.peek(channel)
+            if item is None:
+                break
+
+            merged = self.merge(task, item[1])
+            if merged is None:
+                break
+
+            lane.discard(channel)
+            lane.merged += 1
+            task = merged
+
+        return task
+
+
+class JoinScheduler(object):
+    """
+    Keeps track of the channels we want to be on, and hands them out in
+    batches for comma separated JOIN commands, as fast as the join rate
+    limit allows. Every channel in a batch counts as one join. The most
+    active channels are joined first, channels that haven't been confirmed
+    as joined in time are retried a few times before giving up on them.
+
+    >>> from bot.outbound import JoinScheduler, TokenBucket
+    >>> now = [0.0]
+    >>> clock = lambda: now[0]
+    >>> joins = JoinScheduler(TokenBucket(2, 1, clock), clock=clock)
+    >>> joins.add(["#a", "#b", "#c"])
+    >>> joins.record_activity("#c")
+    >>> joins.poll()
+    (['#c', '#a'], 1.0)
+    >>> joins.confirm("#c")
+    >>> now[0] = 31.0
+    >>> joins.poll()
+    (['#b', '#a'], 30.0)
+    """
+
+    def __init__(self, rate_limit, batch_size=10, retry_delay=30,
+                 max_attempts=3, clock=time):
+        """
+        :param rate_limit: TokenBucket for the joins
+        :param batch_size: Maximum number of channels per JOIN
+        :param retry_delay: Seconds to wait for the join to be confirmed
+                            before trying again
+        :param max_attempts: How many times to try joining a channel
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.rate_limit = rate_limit
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.lock = Lock()
+
+        self.pending = []
+        self.waiting = {}
+        self.attempts = {}
+        self.joined = set()
+        self.failed = set()
+        self.activity = {}
+        self.retries = 0
+
+    def add(self, channels):
+        """
+        Add channels to be joined, ones we're already on or trying to join
+        are ignored
+
+        :param channels: List of channel names
+        :return: None
+        """
+
+        with self.lock:
+            for channel in channels:
+                if channel in self.joined or channel in self.waiting:
+                    continue
+                if channel in self.pending:
+                    continue
+
+                self.failed.discard(channel)
+                self.attempts[channel] = 0
+                self.pending.append(channel)
+
+    def remove(self, channel):
+        """
+        Stop trying to join a channel, or forget that we're on it
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        with self.lock:
+            if channel in self.pending:
+                self.pending.remove(channel)
+
+            self.waiting.pop(channel, None)
+            self.attempts.pop(channel, None)
+            self.joined.discard(channel)
+            self.failed.discard(channel)
+
+    def confirm(self, channel):
+        """
+        Record that the server confirmed we joined the channel
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        with self.lock:
+            if channel in self.pending:
+                self.pending.remove(channel)
+
+            self.waiting.pop(channel, None)
+            self.failed.discard(channel)
+            self.joined.add(channel)
+
+    def reset(self):
+        """
+        Forget all the channels, e.g. when disconnected from the server.
+        The activity counters are kept, so the busiest channels are
+        rejoined first.
+
+        :return: None
+        """
+
+        with self.lock:
+            self.pending = []
+            self.waiting = {}
+            self.attempts = {}
+            self.joined = set()
+            self.failed = set()
+
+    def record_activity(self, channel):
+        """
+        Count a message seen on the channel
+
+        :param channel: Which channel
+        :return: None
+        """
+
+        with self.lock:
+            self.activity[channel] = self.activity.get(channel, 0) + 1
+
+    def is_joined(self, channel):
+        """
+        Check if we've been confirmed to be on the channel
+
+        :param channel: Which channel
+        :return: True or False
+        """
+
+        with self.lock:
+            return channel in self.joined
+
+    def poll(self):
+        """
+        Get the next batch of channels to join, if the rate limit allows
+
+        :return: List of channels to join now, possibly empty, and the
+                 number of seconds until poll() should be called again, or
+                 None if there is nothing left to do
+        """
+
+        with self.lock:
+            now = self.clock()
+
+            self._retry_unconfirmed(now)
+
+            # Busiest channels first, the sort keeps the original order
+            # for channels with the same activity
+            self.pending.sort(key=lambda c: -self.activity.get(c, 0))
+
+            batch = []
+            length = len("JOIN ")
+
+            while self.pending and len(batch) < self.batch_size:
+                channel = self.pending[0]
+                added = len(channel.encode("utf-8")) + (1 if batch else 0)
+
+                if length + added > MAX_LINE_BYTES:
+                    break
+                if not self.rate_limit.consume():
+                    break
+
+                self.pending.pop(0)
+                self.attempts[channel] += 1
+                self.waiting[channel] = now
+                length += added
+                batch.append(channel)
+
+            if self.pending:
+                wait = self.rate_limit.delay()
+            elif self.waiting:
+                wait = max(0, min(self.waiting.values()) + self.retry_delay -
+                           now)
+            else:
+                wait = None
+
+            return batch, wait
+
+    def get_stats(self):
+        """
+        Get the state of the channels we want to be on
+
+        :return: Dict of counters, and the list of channels we gave up on
+        """
+
+        with self.lock:
+            return {
+                "joined": len(self.joined),
+                "pending": len(self.pending),
+                "waiting": len(self.waiting),
+                "retries": self.retries,
+                "failed": sorted(self.failed)
+            }
+
+    def _retry_unconfirmed(self, now):
+        """
+        Put the channels that were not confirmed in time back in the queue,
+        or give up on them. The caller must hold the lock.
+
+        :param now: Current time
+        :return: None
+        """
+
+        for channel, sent in list(self.waiting.items()):
+            if now - sent < self.retry_delay:
+                continue
+
+            del self.waiting[channel]
+
+            if self.attempts[channel] >= self.max_attempts:
+                self.failed.add(channel)
+            else:
+                self.retries += 1
+                self.pending.append(channel)
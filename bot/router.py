@@ -0,0 +1,260 @@
+"""
+Routing of the chat commands to their handlers
+"""
+
+from threading import Lock
+from time import time
+
+
+# The user levels from lowest to highest
+USER_LEVELS = ("user", "reg", "mod", "owner")
+
+
+def level_to_number(name):
+    """
+    Convert the given user level to a number
+
+    >>> from bot.router import level_to_number
+    >>> level_to_number("user") < level_to_number("reg")
+    True
+
+    :param name: Level name
+    :return: A number, higher number is higher user level
+    :raise ValueError: In case of invalid user level
+    """
+
+    if name not in USER_LEVELS:
+        raise ValueError(u"{0} is not a valid user level".format(name))
+
+    return USER_LEVELS.index(name)
+
+
+class CommandStats(object):
+    """
+    How many times a command was run, and how long it took
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.denied = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    def as_dict(self):
+        """
+        Get the counters
+
+        :return: Dict with "calls", "denied", "errors", "total_time" and
+                 "average_time"
+        """
+
+        average_time = 0.0
+        if self.calls:
+            average_time = self.total_time / self.calls
+
+        return {
+            "calls": self.calls,
+            "denied": self.denied,
+            "errors": self.errors,
+            "total_time": self.total_time,
+            "average_time": average_time
+        }
+
+
+class Route(object):
+    """
+    A command registered in the CommandRouter
+    """
+
+    def __init__(self, name, handler, user_level="mod", parser=None):
+        """
+        :param name: Name of the command
+        :param handler: Function called with the channel, nick and args
+        :param user_level: The minimum user level to run the command
+        :param parser: ArgumentParser for the args, if the handler wants
+                       the parsed options instead of the list of words
+        """
+
+        self.name = name
+        self.handler = handler
+        self.user_level = user_level
+        self.level = level_to_number(user_level)
+        self.parser = parser
+
+    def allows(self, user_level):
+        """
+        Check if the command can be run with the given user level
+
+        :param user_level: The calling user's level
+        :return: True or False
+        """
+
+        return level_to_number(user_level) >= self.level
+
+    def __repr__(self):
+        return "<Route:{0}:{1}>".format(self.name, self.user_level)
+
+
+class CommandRouter(object):
+    """
+    Finds the handler for a command with a single dict lookup, and keeps
+    count of how often each command is run and how long it takes.
+
+    Core commands are registered with add(). Custom commands are looked up
+    in their channel's CommandManager instead, but can be timed with
+    timed() as well. The stats are kept per channel, as the custom commands
+    of different channels can share a name.
+
+    >>> from bot.router import CommandRouter
+    >>> router = CommandRouter()
+    >>> router.add("hello", lambda channel, nick, args: "Hello " + nick,
+    ...            user_level="user")
+    >>> route = router.get("hello")
+    >>> route.allows("reg")
+    True
+    >>> router.run(route, "#foo", "bar", [])
+    'Hello bar'
+    >>> router.get_stats()["#foo"]["hello"]["calls"]
+    1
+    """
+
+    def __init__(self, clock=time):
+        """
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.clock = clock
+        self.lock = Lock()
+        self.routes = {}
+        self.stats = {}
+
+    def add(self, name, handler, user_level="mod", parser=None):
+        """
+        Register a command, replacing any existing one with the same name
+
+        :param name: Name of the command
+        :param handler: Function called with the channel, nick and args,
+                        anything it returns is the reply to the channel
+        :param user_level: The minimum user level to run the command
+        :param parser: ArgumentParser for the args, if any
+        :return: None
+        """
+
+        route = Route(name, handler, user_level, parser)
+
+        with self.lock:
+            self.routes[name] = route
+
+    def remove(self, name):
+        """
+        Unregister a command
+
+        :param name: Name of the command
+        :return: None
+        """
+
+        with self.lock:
+            self.routes.pop(name, None)
+
+    def get(self, name):
+        """
+        Find the route for a command
+
+        :param name: Name of the command
+        :return: A Route, or None if the command is not registered
+        """
+
+        return self.routes.get(name)
+
+    def __contains__(self, name):
+        return name in self.routes
+
+    def run(self, route, channel, nick, args):
+        """
+        Run the handler of a core command
+
+        :param route: The Route for the command
+        :param channel: The channel the command was run on
+        :param nick: Who is running the command
+        :param args: The words on the line after the command
+        :return: Whatever the handler returned
+        """
+
+        if route.parser:
+            args = route.parser.parse_args(args)
+
+        return self.timed(channel, route.name, route.handler, channel, nick,
+                          args)
+
+    def deny(self, channel, name):
+        """
+        Record that someone was not allowed to run a command
+
+        :param channel: The channel the command was run on
+        :param name: Name of the command
+        :return: None
+        """
+
+        with self.lock:
+            self._get_stats(channel, name).denied += 1
+
+    def timed(self, channel, name, function, *args):
+        """
+        Call the function, counting the call and the time spent towards the
+        given command on the channel
+
+        :param channel: The channel the command was run on
+        :param name: Name of the command
+        :param function: The function to call with the rest of the args
+        :return: Whatever the function returned
+        """
+
+        start = self.clock()
+        failed = True
+
+        try:
+            result = function(*args)
+            failed = False
+            return result
+        finally:
+            elapsed = self.clock() - start
+
+            with self.lock:
+                stats = self._get_stats(channel, name)
+                stats.calls += 1
+                stats.total_time += elapsed
+                if failed:
+                    stats.errors += 1
+
+    def get_stats(self):
+        """
+        Get the counters of all the commands that have been run
+
+        :return: Dict of channel to dict of command name to dict of counters
+        """
+
+        result = {}
+
+        with self.lock:
+            for (channel, name), stats in self.stats.items():
+                result.setdefault(channel, {})[name] = stats.as_dict()
+
+        return result
+
+    def _get_stats(self, channel, name):
+        """
+        Get the stats for a command on a channel, creating them if needed.
+        The caller must hold the lock.
+
+        :param channel: Which channel
+        :param name: Name of the command
+        :return: A CommandStats
+        """
+
+        key = (channel, name)
+
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = CommandStats()
+
+        return stats
@@ -0,0 +1,253 @@
+"""
+Cache of the stream information from the Twitch API, refreshed in the
+background so the bot never waits for the API
+"""
+
+from threading import Condition, Thread
+from time import time
+import dateutil.parser
+
+
+class StreamInfo(object):
+    """
+    The state of a channel's stream at the time it was fetched
+    """
+
+    def __init__(self, channel, stream=None, error=None, fetched=None):
+        """
+        :param channel: Which channel
+        :param stream: The stream data from the Twitch API, None if the
+                       stream is offline
+        :param error: The exception if fetching or parsing the data failed
+        :param fetched: The unixtime for when the data was fetched
+        """
+
+        self.channel = channel
+        self.stream = stream
+        self.error = error
+        self.fetched = fetched
+        self.online = False
+        self.game = None
+        self.created_at = None
+        self.viewers = None
+
+        if stream is not None and error is None:
+            try:
+                self.game = stream["game"]
+                self.viewers = stream.get("viewers")
+                created_at = dateutil.parser.parse(stream["created_at"])
+                self.created_at = created_at.replace(tzinfo=None)
+                self.online = True
+            except Exception as e:
+                self.error = e
+
+    def __repr__(self):
+        return "<StreamInfo:{0}:{1}>".format(self.channel, self.game)
+
+
+class StreamInfoCache(object):
+    """
+    Keeps the latest StreamInfo of every channel. A background thread
+    fetches them one at a time, so every channel is refreshed about once
+    per interval.
+
+    The bot reads the cache with request(). If the data is too old the
+    channel is refreshed before the others, and the callback is called
+    from the background thread once it's done.
+    """
+
+    def __init__(self, fetch, channels, interval=60, max_age=120,
+                 logger=None, clock=time):
+        """
+        :param fetch: Function that returns the stream data for a channel,
+                      None if the stream is offline. Can raise an exception.
+        :param channels: List of the channels to keep up to date
+        :param interval: Seconds between the refreshes of a channel
+        :param max_age: How many seconds old data request() accepts
+        :param logger: Logger for errors
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.fetch = fetch
+        self.interval = interval
+        self.max_age = max_age
+        self.logger = logger
+        self.clock = clock
+
+        self.condition = Condition()
+        self.info = {}
+        self.due = dict((channel, 0) for channel in channels)
+        self.callbacks = {}
+        self.running = False
+        self.thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.errors = 0
+
+    def start(self):
+        """
+        Start the background thread
+
+        :return: None
+        """
+
+        with self.condition:
+            self.running = True
+
+        self.thread = Thread(target=self._poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread after the current fetch
+
+        :return: None
+        """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def get(self, channel):
+        """
+        Get the cached data for the channel, however old it is
+
+        :param channel: Which channel
+        :return: A StreamInfo, or None if not fetched yet
+        """
+
+        with self.condition:
+            return self.info.get(channel)
+
+    def request(self, channel, callback):
+        """
+        Get fresh enough data for the channel. If the cache has it, it's
+        returned right away. Otherwise the channel is refreshed next, and
+        the callback is called with the StreamInfo from the background
+        thread.
+
+        :param channel: Which channel
+        :param callback: Function called with the StreamInfo if it is not
+                         returned
+        :return: A StreamInfo, or None if the callback will be called
+        """
+
+        now = self.clock()
+
+        with self.condition:
+            info = self.info.get(channel)
+
+            if info is not None and info.error is None and \
+                    now - info.fetched <= self.max_age:
+                self.hits += 1
+                return info
+
+            self.misses += 1
+            self.callbacks.setdefault(channel, []).append(callback)
+            self.due[channel] = now
+            self.condition.notify_all()
+
+        return None
+
+    def get_stats(self):
+        """
+        Get how often the cache was useful and how the fetching went
+
+        :return: Dict of counters
+        """
+
+        with self.condition:
+            return {
+                "channels": len(self.due),
+                "hits": self.hits,
+                "misses": self.misses,
+                "fetches": self.fetches,
+                "errors": self.errors
+            }
+
+    def _poll(self):
+        """
+        Main loop of the background thread, refreshes whichever channel is
+        due next
+
+        :return: None
+        """
+
+        while True:
+            with self.condition:
+                channel = self._wait_for_due()
+                if channel is None:
+                    return
+
+                # Until it's refreshed, the others get their turn first
+                self.due[channel] = self.clock() + self.interval
+
+            info = self._refresh(channel)
+
+            with self.condition:
+                self.info[channel] = info
+                self.due[channel] = info.fetched + self.interval
+                callbacks = self.callbacks.pop(channel, [])
+
+            for callback in callbacks:
+                try:
+                    callback(info)
+                except Exception:
+                    if self.logger:
+                        self.logger.error(u"Stream info callback for {0} "
+                                          u"failed".format(channel),
+                                          exc_info=True)
+
+    def _wait_for_due(self):
+        """
+        Wait until a channel needs to be refreshed, the caller must hold the
+        lock
+
+        :return: The channel, or None if we're stopping
+        """
+
+        while self.running:
+            if not self.due:
+                self.condition.wait()
+                continue
+
+            channel = min(self.due, key=self.due.get)
+            wait = self.due[channel] - self.clock()
+
+            if wait <= 0:
+                return channel
+
+            self.condition.wait(wait)
+
+        return None
+
+    def _refresh(self, channel):
+        """
+        Fetch the data for the channel
+
+        :param channel: Which channel
+        :return: A StreamInfo
+        """
+
+        stream = None
+        error = None
+
+        try:
+            stream = self.fetch(channel)
+        except Exception as e:
+            if self.logger:
+                self.logger.info(u"Fetching stream info for {0} failed: "
+                                 u"{1}".format(channel, e))
+            error = e
+
+        info = StreamInfo(channel, stream, error, self.clock())
+
+        with self.condition:
+            self.fetches += 1
+            if info.error is not None:
+                self.errors += 1
+
+        return info
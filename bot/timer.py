@@ -1,17 +1,41 @@
 from threading import Timer
 
 
+# Lua function calling the function it's given, timers call their Lua
+# functions through it
+TRAMPOLINE_CODE = """
+function (func)
+    func()
+end
+"""
+
+
+def create_trampoline(lua):
+    """
+    Compile the trampoline for calling Lua functions from the timers, it
+    can be shared by all the timers of the runtime
+
+    :param lua: The Lua runtime
+    :return: The trampoline Lua function
+    """
+
+    return lua.eval(TRAMPOLINE_CODE)
+
+
 class Delayed(object):
     """
     Does a delayed Lua function call
     """
 
-    def __init__(self, seconds, lua_function, lua, start=True):
+    def __init__(self, seconds, lua_function, lua, start=True,
+                 trampoline=None):
         """
         :param seconds: Number of seconds to wait
         :param lua_function: The Lua function to execute
         :param lua: The Lua runtime to execute in
         :param start: Autostart the timer?
+        :param trampoline: The runtime's shared create_trampoline() result,
+                           compiled for this timer if not given
         :return:
         """
 
@@ -20,6 +44,11 @@ class Delayed(object):
         self.lua = lua
         self.timer = None
 
+        if trampoline is None:
+            trampoline = create_trampoline(lua)
+
+        self.trampoline = trampoline
+
         if start:
             self.start()
 
@@ -48,13 +77,7 @@ class Delayed(object):
         :return:
         """
 
-        call_lua = self.lua.eval("""
-        function (func)
-            func()
-        end
-        """)
-
-        call_lua(self.lua_function)
+        self.trampoline(self.lua_function)
 
 
 class Interval(Delayed):
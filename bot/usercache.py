@@ -0,0 +1,178 @@
+"""
+In-memory cache of the user levels, so checking them for every chat message
+doesn't need the database or the IRC connection
+"""
+
+from threading import Lock
+from time import time
+
+
+class UserLevelCache(object):
+    """
+    Keeps the regulars of each channel in memory, and remembers the
+    moderator status of the users for mod_ttl seconds.
+
+    The regulars are loaded once per channel with set_regulars(), and kept
+    up to date with add_regular() and remove_regular() when they change.
+    Channels that have not been loaded are reported as unknown, so the
+    caller can fall back to the database.
+
+    >>> from bot.usercache import UserLevelCache
+    >>> cache = UserLevelCache(mod_ttl=60, clock=lambda: 0)
+    >>> cache.is_regular("#foo", "bar") is None
+    True
+    >>> cache.set_regulars("#foo", ["bar"])
+    >>> cache.is_regular("#foo", "bar"), cache.is_regular("#foo", "baz")
+    (True, False)
+    >>> cache.set_mod("#foo", "baz", True)
+    >>> cache.is_mod("#foo", "baz"), cache.is_mod("#foo", "bar")
+    (True, None)
+    """
+
+    def __init__(self, mod_ttl=60, clock=time):
+        """
+        :param mod_ttl: Seconds to remember the moderator status for, None
+                        to not cache it at all
+        :param clock: Function returning the current time in seconds
+        """
+
+        self.mod_ttl = mod_ttl
+        self.clock = clock
+        self.lock = Lock()
+        self.regulars = {}
+        self.mods = {}
+        self.next_expire = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def set_regulars(self, channel, nicks):
+        """
+        Replace the regulars of the channel
+
+        :param channel: Which channel
+        :param nicks: The nicks of all the regulars on the channel
+        :return: None
+        """
+
+        with self.lock:
+            self.regulars[channel] = set(nicks)
+
+    def add_regular(self, channel, nick):
+        """
+        Record a new regular on a loaded channel
+
+        :param channel: Which channel
+        :param nick: The nick of the new regular
+        :return: None
+        """
+
+        with self.lock:
+            if channel in self.regulars:
+                self.regulars[channel].add(nick)
+
+    def remove_regular(self, channel, nick):
+        """
+        Record that a user is no longer a regular on a loaded channel
+
+        :param channel: Which channel
+        :param nick: The nick of the old regular
+        :return: None
+        """
+
+        with self.lock:
+            if channel in self.regulars:
+                self.regulars[channel].discard(nick)
+
+    def is_regular(self, channel, nick):
+        """
+        Check if the nick is a regular on the channel
+
+        :param channel: Which channel
+        :param nick: The nick
+        :return: True or False, None if the channel is not loaded
+        """
+
+        with self.lock:
+            regulars = self.regulars.get(channel)
+
+            if regulars is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return nick in regulars
+
+    def set_mod(self, channel, nick, is_mod):
+        """
+        Remember the moderator status of the nick on the channel
+
+        :param channel: Which channel
+        :param nick: The nick
+        :param is_mod: True or False
+        :return: None
+        """
+
+        if self.mod_ttl is None:
+            return
+
+        now = self.clock()
+
+        with self.lock:
+            self.mods[(channel, nick)] = (is_mod, now + self.mod_ttl)
+
+            # Don't keep everyone who ever chatted around forever
+            if now >= self.next_expire:
+                self._expire(now)
+                self.next_expire = now + self.mod_ttl
+
+    def is_mod(self, channel, nick):
+        """
+        Check if the nick is a moderator on the channel, if we know
+
+        :param channel: Which channel
+        :param nick: The nick
+        :return: True or False, None if not known or too old
+        """
+
+        with self.lock:
+            cached = self.mods.get((channel, nick))
+
+            if cached is not None:
+                is_mod, expires = cached
+                if self.clock() < expires:
+                    self.hits += 1
+                    return is_mod
+
+                del self.mods[(channel, nick)]
+
+            self.misses += 1
+            return None
+
+    def get_stats(self):
+        """
+        Get the size of the cache and how often it was useful
+
+        :return: Dict of counters
+        """
+
+        with self.lock:
+            return {
+                "regulars": sum(len(r) for r in self.regulars.values()),
+                "mods": len(self.mods),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _expire(self, now):
+        """
+        Forget the moderator statuses that are too old, the caller must hold
+        the lock
+
+        :param now: The current time
+        :return: None
+        """
+
+        for key, (is_mod, expires) in list(self.mods.items()):
+            if now >= expires:
+                del self.mods[key]
@@ -1,11 +1,14 @@
 import argparse
+import os
 import sys
+from itertools import count
 from multiprocessing import Queue as MPQueue
+from threading import Condition, Lock, Thread
 
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
 
 from math import floor
 import logging
@@ -108,16 +111,172 @@ class CallData(object):
         self.args = args
         self.kwargs = kwargs
 
+        # Set by the CallRelay, None if no response is wanted
+        self.call_id = None
+
+
+class CallFuture(object):
+    """
+    The pending result of a call made through a CallRelay. Wait for it with
+    result(), get notified with add_done_callback(), or await it in a
+    coroutine (Python 3.5+).
+
+    >>> from bot.utils import CallFuture
+    >>> future = CallFuture()
+    >>> finished = []
+    >>> future.add_done_callback(finished.append)
+    >>> future.done(), finished
+    (False, [])
+    >>> future.set_result("done")
+    >>> future.result(), finished == [future]
+    ('done', True)
+    """
+
+    def __init__(self):
+        self.condition = Condition()
+        self.callbacks = []
+        self.finished = False
+        self.value = None
+        self.error = None
+
+    def done(self):
+        """
+        Check if the call has finished
+
+        :return: True or False
+        """
+
+        with self.condition:
+            return self.finished
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and get the result
+
+        :param timeout: Seconds to wait at most, None to wait forever
+        :return: The value returned by the called method
+        :raise: The exception raised by the called method
+        :raise RuntimeError: If the timeout expires
+        """
+
+        with self.condition:
+            if timeout is None:
+                while not self.finished:
+                    self.condition.wait()
+            elif not self.finished:
+                self.condition.wait(timeout)
+
+            if not self.finished:
+                raise RuntimeError("Timed out waiting for the call result")
+
+            if self.error is not None:
+                raise self.error
+
+            return self.value
+
+    def add_done_callback(self, callback):
+        """
+        Call the callback with this future when the call finishes, right away
+        if it already has. The callback is run on the thread that receives
+        the result.
+
+        :param callback: Function taking the future as the argument
+        :return: None
+        """
+
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(callback)
+                return
+
+        callback(self)
+
+    def set_result(self, value):
+        self._finish(value, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def __await__(self):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+
+        def _copy(future):
+            if waiter.cancelled():
+                return
+
+            if future.error is not None:
+                waiter.set_exception(future.error)
+            else:
+                waiter.set_result(future.value)
+
+        self.add_done_callback(
+            lambda future: loop.call_soon_threadsafe(_copy, future)
+        )
+
+        return waiter.__await__()
+
+    def _finish(self, value, error):
+        with self.condition:
+            self.value = value
+            self.error = error
+            self.finished = True
+            self.condition.notify_all()
+
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        for callback in callbacks:
+            callback(self)
+
 
 class CallRelay(object):
+    """
+    Relays method calls to an object owned by another thread or process.
+    The calls are put in in_queue and run one at a time by loop() on the
+    owning side. The results come back through out_queue tagged with the
+    ID of the call, so any number of threads can make calls at the same
+    time and each gets its own result.
+
+    Calling relay.method(...) waits for the result. call_async() returns a
+    CallFuture instead. Methods listed in fire_and_forget return None right
+    away, and their results are never sent back.
+
+    The loop takes all the calls waiting in in_queue at once. If the call
+    object has a <method>_batch method, runs of fire and forget calls to
+    <method> are given to it together as a list of argument tuples.
+    """
+
+    # Maximum number of calls the loop takes from in_queue at once
+    max_batch = 100
+
+    def __init__(self, logger=None, in_queue=None, out_queue=None,
+                 fire_and_forget=None, trace=False):
+        """
+        :param logger: Logger for debug output
+        :param in_queue: Queue for the calls
+        :param out_queue: Queue for the results
+        :param fire_and_forget: Names of the methods whose results are not
+                                needed
+        :param trace: Log every call and response, for debugging
+        """
 
-    def __init__(self, logger=None, in_queue=None, out_queue=None):
         self.logger = logger
         self.in_queue = in_queue
         self.out_queue = out_queue
+        self.fire_and_forget = frozenset(fire_and_forget or ())
+        self.trace = bool(trace and logger)
 
         self.call_object = None
 
+        self.lock = Lock()
+        self.call_ids = count()
+        self.pending = {}
+        self.response_thread = None
+        self.response_pid = None
+
     def set_call_object(self, call_object):
         if self.logger:
             self.logger.debug("Updated call object to {0}".format(
@@ -132,22 +291,64 @@ class CallRelay(object):
             ))
         self.in_queue.put(None)
 
+    def call_async(self, name, *args, **kwargs):
+        """
+        Call a method on the call object without waiting for it
+
+        :param name: Name of the method
+        :return: A CallFuture for the result
+        """
+
+        if self.trace:
+            self.logger.debug("ChannelCall call to {0}.{1}".format(
+                type(self.call_object),
+                name
+            ))
+
+        call = CallData(name, *args, **kwargs)
+        future = CallFuture()
+
+        with self.lock:
+            self._start_response_thread()
+            call.call_id = next(self.call_ids)
+            self.pending[call.call_id] = future
+
+        self.in_queue.put(call)
+
+        return future
+
+    def send(self, name, *args, **kwargs):
+        """
+        Call a method on the call object without waiting for it, or getting
+        the result
+
+        :param name: Name of the method
+        :return: None
+        """
+
+        if self.trace:
+            self.logger.debug("ChannelCall send to {0}.{1}".format(
+                type(self.call_object),
+                name
+            ))
+
+        self.in_queue.put(CallData(name, *args, **kwargs))
+
     def _create_call_handler(self, name):
-        def _handler(*args, **kwargs):
-            if self.logger:
-                self.logger.debug("ChannelCall call to {0}.{1}".format(
-                    type(self.call_object),
-                    name
-                ))
-            self.in_queue.put(CallData(name, *args, **kwargs))
-            response = self.out_queue.get()
-            if self.logger:
-                self.logger.debug("ChannelCall response from {0}.{1}".format(
-                    type(self.call_object),
-                    name
-                ))
+        if name in self.fire_and_forget:
+            def _handler(*args, **kwargs):
+                self.send(name, *args, **kwargs)
+        else:
+            def _handler(*args, **kwargs):
+                response = self.call_async(name, *args, **kwargs).result()
+                if self.trace:
+                    self.logger.debug("ChannelCall response from "
+                                      "{0}.{1}".format(
+                        type(self.call_object),
+                        name
+                    ))
 
-            return response
+                return response
 
         _handler.__name__ = name
         return _handler
@@ -155,62 +356,250 @@ class CallRelay(object):
     def __getattr__(self, name):
         return self._create_call_handler(name)
 
-    def loop(self):
+    def __getstate__(self):
+        """
+        Only the queues and settings are passed on when sent to another
+        process, the call object and the pending calls stay behind
+
+        :return: Dict of the state to pickle
+        """
+
+        return {
+            "logger": self.logger,
+            "in_queue": self.in_queue,
+            "out_queue": self.out_queue,
+            "fire_and_forget": self.fire_and_forget,
+            "trace": self.trace
+        }
+
+    def __setstate__(self, state):
+        CallRelay.__init__(self, **state)
+
+    def _start_response_thread(self):
+        """
+        Start the thread that hands the results to the waiting futures, in
+        this process, if not running yet. The caller must hold the lock.
+
+        :return: None
+        """
+
+        if self.response_pid == os.getpid():
+            return
+
+        # Futures from the parent process never get their results here
+        self.pending = {}
+        self.response_pid = os.getpid()
+
+        self.response_thread = Thread(target=self._read_responses)
+        self.response_thread.daemon = True
+        self.response_thread.start()
+
+    def _read_responses(self):
+        """
+        Match the results coming back from the loop to the pending futures
+
+        :return: None
+        """
+
         while True:
-            if self.logger:
-                self.logger.debug("ChannelCall waiting for calls to {"
-                                  "0}".format(
-                    type(self.call_object)
-                ))
+            response = self.out_queue.get()
 
-            call = self.in_queue.get()
+            # Magic message telling us the loop stopped
+            if response is None:
+                break
 
-            if self.logger:
-                self.logger.debug("ChannelCall for {0} got call".format(
-                    type(self.call_object)
-                ))
+            call_id, value, error = response
+
+            with self.lock:
+                future = self.pending.pop(call_id, None)
+
+            if future is None:
+                continue
+
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
+
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            self.response_pid = None
+
+        for future in pending.values():
+            future.set_exception(RuntimeError("Call relay stopped"))
+
+    def loop(self):
+        while True:
+            calls = self._get_calls()
 
             # Magic message telling us to stop
-            if call is None:
+            stop = None in calls
+            if stop:
+                calls = calls[:calls.index(None)]
+
+            self._dispatch(calls)
+
+            if stop:
                 if self.logger:
                     self.logger.debug("ChannelCall for {0} stopping".format(
                         type(self.call_object)
                     ))
+                self.out_queue.put(None)
+                break
+
+    def _get_calls(self):
+        """
+        Wait for a call, and take the others waiting behind it as well
+
+        :return: List of CallData, ending in None if we should stop
+        """
+
+        calls = [self.in_queue.get()]
+
+        while calls[-1] is not None and len(calls) < self.max_batch:
+            try:
+                calls.append(self.in_queue.get_nowait())
+            except Empty:
                 break
 
+        if self.trace:
+            self.logger.debug("ChannelCall for {0} got {1} calls".format(
+                type(self.call_object),
+                len(calls)
+            ))
+
+        return calls
+
+    def _dispatch(self, calls):
+        """
+        Run the calls in order, giving runs of fire and forget calls to the
+        same method to its batch handler if there is one
+
+        :param calls: List of CallData
+        :return: None
+        """
+
+        index = 0
+
+        while index < len(calls):
+            call = calls[index]
+            end = index + 1
+
+            handler = None
+            if self._can_batch(call):
+                handler = getattr(self.call_object, call.method + "_batch",
+                                  None)
+
+            if handler:
+                while end < len(calls) and self._can_batch(calls[end]) and \
+                        calls[end].method == call.method:
+                    end += 1
+
+            if end - index > 1:
+                self._run_batch(handler, calls[index:end])
+            else:
+                self._run(call)
+
+            index = end
+
+    def _can_batch(self, call):
+        """
+        Check if the call could be given to a batch handler
+
+        :param call: The CallData
+        :return: True or False
+        """
+
+        return call.call_id is None and not call.kwargs
+
+    def _run_batch(self, handler, calls):
+        """
+        Run several fire and forget calls with one call to the batch handler
+
+        :param handler: The <method>_batch method
+        :param calls: List of CallData for the same method
+        :return: None
+        """
+
+        if self.trace:
+            self.logger.debug("ChannelCall calling {0}.{1} with {2} "
+                              "calls".format(
+                type(self.call_object),
+                handler.__name__,
+                len(calls)
+            ))
+
+        try:
+            handler([call.args for call in calls])
+        except Exception:
             if self.logger:
-                self.logger.debug("ChannelCall calling {0}.{1}".format(
+                self.logger.error("ChannelCall {0}.{1} failed".format(
                     type(self.call_object),
-                    call.method
-                ))
+                    handler.__name__
+                ), exc_info=True)
+
+    def _run(self, call):
+        """
+        Run a single call, and send back the result if someone is waiting
+        for it
 
+        :param call: The CallData
+        :return: None
+        """
+
+        if self.trace:
+            self.logger.debug("ChannelCall calling {0}.{1}".format(
+                type(self.call_object),
+                call.method
+            ))
+
+        result = None
+        error = None
+
+        try:
             method = getattr(self.call_object, call.method)
             result = method(*call.args, **call.kwargs)
-
-            if self.logger:
-                self.logger.debug("ChannelCall returning {0}.{1} "
-                                  "response".format(
+        except Exception as e:
+            if call.call_id is None and self.logger:
+                self.logger.error("ChannelCall {0}.{1} failed".format(
                     type(self.call_object),
                     call.method
-                ))
+                ), exc_info=True)
+            error = e
+
+        # Nobody is waiting for fire and forget calls
+        if call.call_id is None:
+            return
+
+        if self.trace:
+            self.logger.debug("ChannelCall returning {0}.{1} "
+                              "response".format(
+                type(self.call_object),
+                call.method
+            ))
 
-            self.out_queue.put(result)
+        self.out_queue.put((call.call_id, result, error))
 
 
 class ProcessCallRelay(CallRelay):
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, fire_and_forget=None, trace=False):
         in_queue = MPQueue()
         out_queue = MPQueue()
 
-        super(ProcessCallRelay, self).__init__(logger, in_queue, out_queue)
+        super(ProcessCallRelay, self).__init__(
+            logger, in_queue, out_queue, fire_and_forget, trace
+        )
 
 
 class ThreadCallRelay(CallRelay):
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, fire_and_forget=None, trace=False):
         in_queue = Queue()
         out_queue = Queue()
 
-        super(ThreadCallRelay, self).__init__(logger, in_queue, out_queue)
+        super(ThreadCallRelay, self).__init__(
+            logger, in_queue, out_queue, fire_and_forget, trace
+        )
 
 
 class ArgumentError(BaseException):
@@ -0,0 +1,227 @@
+"""
+Run the channels in separate worker processes, so the bot can use more than
+one CPU core
+"""
+
+import logging
+import os
+from multiprocessing import Process, Queue as MPQueue
+from threading import Thread
+from .bot import Bot, BOT_FIRE_AND_FORGET
+from .database import Database
+from .utils import ProcessCallRelay, ThreadCallRelay, log, set_log_file
+
+
+class WorkerSettings(object):
+    """
+    The bot settings as seen by a worker process, with CHANNEL_LIST limited
+    to the worker's own channels
+    """
+
+    def __init__(self, settings, channels):
+        self._settings = settings
+        self.CHANNEL_LIST = dict(
+            (channel, settings.CHANNEL_LIST[channel]) for channel in channels
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._settings, name)
+
+
+class Worker(object):
+    """
+    The IRC process' handle to a single worker process
+    """
+
+    def __init__(self, index, channels):
+        """
+        :param index: Number of the worker, for logging
+        :param channels: List of the channels the worker handles
+        """
+
+        self.index = index
+        self.channels = channels
+        self.events = MPQueue()
+        self.irc = ProcessCallRelay(fire_and_forget=("message",))
+        self.process = None
+        self.irc_thread = None
+
+
+class WorkerPool(object):
+    """
+    Splits the channels between WORKER_PROCESSES worker processes. Each
+    worker runs its own Bot with the CommandManagers, BlacklistManagers and
+    models for its channels.
+
+    This process owns the IRC connection. The chat messages are routed to
+    the worker that owns the channel, the workers send their messages and
+    other IRC calls back through a ProcessCallRelay.
+
+    Can be given to the IRC wrapper's set_event_queue(), as it has the
+    same put() as bot.inbound.InboundQueue.
+    """
+
+    def __init__(self, settings, logger):
+        """
+        :param settings: The bot settings
+        :param logger: The logger to use
+        """
+
+        self.settings = settings
+        self.logger = logger
+        self.irc = None
+        self.workers = []
+        self.routes = {}
+
+        channels = sorted(settings.CHANNEL_LIST)
+        count = max(1, min(settings.WORKER_PROCESSES, len(channels)))
+
+        for index in range(count):
+            worker = Worker(index, channels[index::count])
+            for channel in worker.channels:
+                self.routes[channel] = worker
+
+            self.workers.append(worker)
+
+    # Public API
+
+    def start(self, irc_wrapper):
+        """
+        Run the migrations, start the workers, and then the IRC connection
+
+        :param irc_wrapper: The IRC wrapper class to use
+        :return: None
+        """
+
+        settings = self.settings
+
+        # Run these once here, instead of every worker racing to do them
+        Database(settings).run_migrations()
+
+        self.irc = irc_wrapper(
+            self.logger,
+            self,
+            settings,
+            settings.CHANNEL_LIST,
+            settings.USER,
+            settings.HOST,
+            settings.OAUTH_TOKEN,
+            settings.PORT,
+            settings.COMMAND_PREFIX
+        )
+        self.irc.set_event_queue(self)
+
+        for worker in self.workers:
+            self.logger.info(u"Starting worker {0} for {1}".format(
+                worker.index, ", ".join(worker.channels)
+            ))
+
+            worker.process = Process(
+                target=run_worker,
+                args=(worker.channels, worker.events, worker.irc)
+            )
+            worker.process.daemon = True
+            worker.process.start()
+
+        # Start our threads only after forking the workers
+        for worker in self.workers:
+            worker.irc.set_call_object(self.irc)
+            worker.irc_thread = Thread(target=worker.irc.loop)
+            worker.irc_thread.daemon = True
+            worker.irc_thread.start()
+
+        self.irc.start()
+
+    def stop(self):
+        """
+        Stop the IRC connection and tell the workers to stop
+
+        :return: None
+        """
+
+        if self.irc:
+            self.irc.stop()
+
+        for worker in self.workers:
+            worker.events.put(None)
+            worker.irc.stop()
+
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(10)
+
+    def put(self, event):
+        """
+        Send a chat event to the worker that handles the channel
+
+        :param event: A bot.inbound.MessageEvent
+        :return: None
+        """
+
+        worker = self.routes.get(event.channel)
+        if worker is None:
+            self.logger.warn(u"No worker for {0}".format(event.channel))
+            return
+
+        worker.events.put(event)
+
+    def get_stats(self):
+        """
+        Get the state of the worker processes
+
+        :return: List of dicts with "channels", "pid" and "alive"
+        """
+
+        return [
+            {
+                "channels": list(worker.channels),
+                "pid": worker.process.pid if worker.process else None,
+                "alive": bool(worker.process and worker.process.is_alive())
+            }
+            for worker in self.workers
+        ]
+
+
+def run_worker(channels, events, irc):
+    """
+    Main function of a worker process, runs a Bot for the given channels
+
+    :param channels: List of the channels to handle
+    :param events: Queue the chat events for the channels arrive in
+    :param irc: ProcessCallRelay to the IRC wrapper in the main process
+    :return: None
+    """
+
+    # Imported here, the worker process loads its own copy of the settings
+    import settings
+
+    # A forked worker already has the log file set up
+    has_file = [h for h in log.handlers if isinstance(h, logging.FileHandler)]
+    if settings.LOG_FILE and not has_file:
+        set_log_file(settings.LOG_FILE)
+
+    log.info(u"Worker {0} handling {1}".format(os.getpid(),
+                                                ", ".join(channels)))
+
+    wrapper = ThreadCallRelay(fire_and_forget=BOT_FIRE_AND_FORGET)
+    bot = Bot(WorkerSettings(settings, channels), wrapper=wrapper,
+              logger=log)
+    bot.set_remote_irc(irc)
+    wrapper.set_call_object(bot)
+
+    def receive():
+        while True:
+            event = events.get()
+
+            # Magic message telling us to stop
+            if event is None:
+                wrapper.stop()
+                return
+
+            bot.event_queue.put(event)
+
+    thread = Thread(target=receive)
+    thread.daemon = True
+    thread.start()
+
+    bot.run()
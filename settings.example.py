@@ -119,8 +119,106 @@ BACKUP_COMPRESS_CMD = ["gzip", "-9", "{filename}"]
 #
 # You probably don't need to touch these settings
 
-# How many seconds the IRC layer will wait between processing outgoing
-# commands, set this too low and Twitch can globally ban you or drop your
-# messages, set it too high and the bot will seem seriously laggy.
-QUEUE_DELAY = 2.5
-
+# How to talk to the IRC server, "thread" uses separate threads for reading
+# and sending, "asyncio" runs the whole connection on a single event loop
+# (requires Python 3.5 or newer)
+IRC_TRANSPORT = "thread"
+
+# Split the channels over several connections to the server, with at most
+# this many channels on each, so a single connection doesn't have to carry
+# all the chat traffic. Channels are moved to the other connections while
+# one is reconnecting. Only used with the "thread" transport, None to use a
+# single connection for everything.
+CHANNELS_PER_CONNECTION = None
+
+# Run the channels in this many separate processes to use more CPU cores,
+# each process handles the commands, blacklists etc. for its own share of
+# the channels while the IRC connection stays in the main process. Only
+# used with the "thread" transport, None to run everything in one process.
+WORKER_PROCESSES = None
+
+# Chat messages are queued for the bot to process, so reading from the
+# server never waits for the bot. How many messages the bot processes at a
+# time before letting other work run.
+INBOUND_BATCH_SIZE = 50
+
+# Run the work for the channels (commands, blacklists, database writes) on
+# this many threads, each channel always on the same one, so a slow channel
+# only delays the others sharing its thread. 0 to do everything on a single
+# thread, as it's done by default. Up to CHANNEL_QUEUE_SIZE plain chat lines
+# can be waiting per thread, after that they're dropped. Commands and
+# database writes are never dropped, and don't count towards the limit.
+CHANNEL_THREADS = 0
+CHANNEL_QUEUE_SIZE = 500
+
+# Remember the blacklist verdicts for this many recently seen chat lines, so
+# repeated spam is only checked against the rules once. 0 to disable.
+BLACKLIST_CACHE_SIZE = 1000
+
+# Check the lines of the channels with at least BLACKLIST_PROCESS_MIN_RULES
+# blacklist rules in this many separate processes, so they don't hold up
+# the commands in the other channels. The timeouts are given when the
+# verdicts arrive. None to check every line in the bot's own process. Not
+# available with WORKER_PROCESSES.
+BLACKLIST_PROCESSES = None
+BLACKLIST_PROCESS_MIN_RULES = 1000
+
+# How many seconds to remember whether a user is a moderator, instead of
+# asking the IRC connection on every message. The regulars are always kept
+# in memory. None to not remember the moderators.
+MOD_STATUS_CACHE_TTL = 60
+
+# The stream information (game, start time, viewers) of every channel is
+# fetched from the Twitch API in the background, about once every
+# STREAM_INFO_POLL_INTERVAL seconds. !addnote uses it if it's at most
+# STREAM_INFO_MAX_AGE seconds old, otherwise it's fetched again first.
+STREAM_INFO_POLL_INTERVAL = 60
+STREAM_INFO_MAX_AGE = 120
+
+# Outgoing messages are rate limited with a token bucket. Twitch allows
+# RATE_LIMIT_MESSAGES messages per RATE_LIMIT_PERIOD seconds, set this too
+# high and Twitch can globally ban you or drop your messages. Up to
+# RATE_LIMIT_BURST messages are sent immediately, the rest are spread out
+# so the limit is never exceeded within any period.
+RATE_LIMIT_MESSAGES = 20
+RATE_LIMIT_PERIOD = 30
+RATE_LIMIT_BURST = 5
+
+# Twitch allows a higher rate in channels where the bot is the broadcaster,
+# a moderator or a VIP. This is detected automatically, and these limits
+# are used instead for those channels.
+RATE_LIMIT_MOD_MESSAGES = 100
+RATE_LIMIT_MOD_BURST = 20
+
+# Every channel has its own outbound queue, and the channels take turns
+# sending, so a busy channel can't delay the replies in a quiet one. How many
+# replies can be waiting per channel before the oldest ones are dropped.
+# Moderation actions (e.g. timeouts) are never dropped.
+OUTBOUND_CHANNEL_QUEUE_SIZE = 20
+
+# Replies that have been waiting in the outbound queue for longer than this
+# many seconds are discarded instead of sent, as they're probably no longer
+# relevant. Moderation actions never expire. None to disable.
+OUTBOUND_MESSAGE_TTL = 60
+
+# Identical messages queued to the same channel within this many seconds of
+# each other are only sent once. None to disable.
+OUTBOUND_DUPLICATE_WINDOW = 30
+
+# Combine consecutive short replies to the same channel into one message,
+# as long as the result fits in Twitch's 500 byte limit.
+OUTBOUND_COALESCE = True
+
+# Channels are joined several at a time with a single JOIN, at most
+# JOIN_BATCH_SIZE channels each. Twitch allows JOIN_RATE_LIMIT_JOINS joins
+# per JOIN_RATE_LIMIT_PERIOD seconds, every channel in a batch counts as one,
+# so a batch never has more than JOIN_RATE_LIMIT_JOINS - 1 channels. The
+# busiest channels are rejoined first after reconnecting.
+JOIN_RATE_LIMIT_JOINS = 20
+JOIN_RATE_LIMIT_PERIOD = 10
+JOIN_BATCH_SIZE = 10
+
+# If joining a channel is not confirmed within JOIN_RETRY_DELAY seconds it's
+# tried again, up to JOIN_MAX_ATTEMPTS times in total.
+JOIN_RETRY_DELAY = 30
+JOIN_MAX_ATTEMPTS = 3
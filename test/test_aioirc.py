@@ -0,0 +1,151 @@
+import logging
+import socket
+import sys
+import time
+from threading import Thread
+from unittest import TestCase, skipIf
+from .utils import FakeSettings
+
+if sys.version_info >= (3, 5):
+    from bot.aioirc import AsyncIRCWrapper, parse_line
+
+
+nullLogger = logging.getLogger('null')
+nullLogger.setLevel(999)
+
+
+class FakeBot(object):
+    def __init__(self):
+        self.commands = []
+        self.chat = []
+
+    def irc_command(self, channel, nick, command, args, timestamp,
+                    context=None):
+        self.commands.append((channel, nick, command, args, context))
+        return True
+
+    def chat_message(self, channel, nick, text, timestamp, context=None):
+        self.chat.append((channel, nick, text))
+
+
+class FakeServer(object):
+    """Accepts a single connection and records the lines sent to it"""
+
+    def __init__(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(1)
+        self.port = self.socket.getsockname()[1]
+        self.client = None
+        self.lines = []
+
+        self.thread = Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, line):
+        self.client.sendall((line + "\r\n").encode("utf-8"))
+
+    def wait_for(self, check, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if check():
+                return True
+            time.sleep(0.01)
+
+        return False
+
+    def close(self):
+        if self.client:
+            self.client.close()
+        self.socket.close()
+
+    def _serve(self):
+        self.client, address = self.socket.accept()
+        handle = self.client.makefile("rb")
+
+        for line in handle:
+            self.lines.append(line.decode("utf-8").rstrip("\r\n"))
+
+
+@skipIf(sys.version_info < (3, 5), "asyncio transport needs Python 3.5+")
+class AsyncIRCWrapperTest(TestCase):
+    """Make sure the asyncio transport seems sane"""
+
+    def test_parse_line(self):
+        event = parse_line(
+            "@badges=moderator/1;display-name=Foo\\sBar :foo!foo@foo "
+            "PRIVMSG #tmp :!quote now please"
+        )
+
+        self.assertEqual(event.type, "pubmsg")
+        self.assertEqual(event.source.nick, "foo")
+        self.assertEqual(event.target, "#tmp")
+        self.assertEqual(event.arguments, ["!quote now please"])
+        self.assertEqual(event.tags[1], {
+            "key": "display-name", "value": "Foo Bar"
+        })
+
+        event = parse_line(":tmi.twitch.tv 353 bot = #tmp :bot foo @bar")
+        self.assertEqual(event.type, "namreply")
+        self.assertEqual(event.arguments, ["=", "#tmp", "bot foo @bar"])
+
+        event = parse_line("@msg-id=msg_ratelimit :tmi.twitch.tv NOTICE #tmp "
+                           ":Your message was not sent")
+        self.assertEqual(event.type, "pubnotice")
+
+        self.assertEqual(parse_line("PING :tmi.twitch.tv").target,
+                         "tmi.twitch.tv")
+
+    def test_connection(self):
+        server = FakeServer()
+        bot = FakeBot()
+
+        wrapper = AsyncIRCWrapper(
+            nullLogger, bot, FakeSettings(), ["#tmp"], "bot", "127.0.0.1",
+            "oauth:secret", server.port
+        )
+        wrapper.start()
+
+        try:
+            assert server.wait_for(lambda: "NICK bot" in server.lines)
+            self.assertEqual(server.lines[0], "PASS oauth:secret")
+
+            server.send(":tmi.twitch.tv 001 bot :Welcome, GLHF!")
+            assert server.wait_for(lambda: "JOIN #tmp" in server.lines)
+            assert "CAP REQ :twitch.tv/tags twitch.tv/commands" in \
+                server.lines
+
+            server.send(":bot!bot@bot JOIN #tmp")
+            server.send(":tmi.twitch.tv 353 bot = #tmp :bot foo @bar")
+            server.send("PING :tmi.twitch.tv")
+            # A broken line doesn't drop the connection
+            server.send(":broken")
+            server.send("@badges=moderator/1;mod=1 :bar!bar@bar PRIVMSG #tmp "
+                        ":!quote 1")
+
+            assert server.wait_for(lambda: bot.commands)
+            channel, nick, command, args, context = bot.commands[0]
+            self.assertEqual((channel, nick, command, args),
+                             ("#tmp", "bar", "quote", ["1"]))
+            assert context.is_mod is True
+
+            assert server.wait_for(
+                lambda: "PONG :tmi.twitch.tv" in server.lines
+            )
+            assert wrapper.is_oper("#tmp", "bar") is True
+            assert wrapper.is_oper("#tmp", "foo") is False
+            self.assertEqual(sorted(wrapper.get_users("#tmp")),
+                             ["bar", "bot", "foo"])
+
+            wrapper.message("#tmp", "Quote #1: hello")
+            assert server.wait_for(
+                lambda: "PRIVMSG #tmp :Quote #1: hello" in server.lines
+            )
+
+            # Our own nick is recognized regardless of its case
+            server.send(":BOT!bot@bot PART #tmp")
+            assert server.wait_for(lambda: "#tmp" not in wrapper.channels)
+        finally:
+            wrapper.stop()
+            server.close()
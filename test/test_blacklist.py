@@ -1,4 +1,6 @@
 import logging
+import random
+import re
 from unittest import TestCase
 
 from bot.blacklist import BlacklistManager
@@ -59,3 +61,157 @@ class BlacklistTest(TestCase):
                                              "fu2bgwcv43o")
         assert res is False
 
+    def test_matcher(self):
+        blacklist = [
+            Model(1, "xy"),
+            Model(2, "ab*"),
+            Model(3, "*.com"),
+            Model(4, "a c")
+        ]
+
+        manager = BlacklistManager()
+        manager.set_data(blacklist, [])
+
+        def expected(line):
+            # A single alternation of all the rules
+            rules = manager.blacklist
+            pattern = "|".join(
+                "(?P<r{0}>{1})".format(index, rule.regex.pattern)
+                for index, rule in enumerate(rules)
+            )
+            return [
+                (match.group(), rules[int(match.lastgroup[1:])].id, 3600)
+                for match in re.finditer(pattern, line)
+            ]
+
+        # Every occurrence is a hit, the earlier rule wins where several
+        # match
+        self.assertEqual(manager._get_blacklist_hits("abxy.com xy axy c"), [
+            ("abxy.com", 2, 3600), ("xy", 1, 3600), ("xy", 1, 3600)
+        ])
+
+        chars = "abcxy. "
+        rng = random.Random(1)
+        for i in range(2000):
+            line = "".join(rng.choice(chars) for j in range(12))
+            self.assertEqual(manager._get_blacklist_hits(line),
+                             expected(line))
+
+        manager.remove_blacklist(1)
+        manager.remove_blacklist(2)
+        manager.remove_blacklist(3)
+        self.assertEqual(manager._get_blacklist_hits("abxy.com"), [])
+        manager.remove_blacklist(4)
+        self.assertEqual(manager._get_blacklist_hits("a c"), [])
+
+    def test_verdict_cache(self):
+        manager = BlacklistManager()
+        manager.set_data([Model(1, "spam")], [])
+
+        for line in ("buy spam", "buy spam", u"buy spam \U000E0000", "ok"):
+            manager.is_blacklisted(line)
+
+        self.assertEqual(manager.get_cache_stats(), {
+            "size": 2,
+            "hits": 2,
+            "misses": 2,
+            "hit_rate": 0.5
+        })
+
+        # Changing the rules forgets the old verdicts
+        manager.add_whitelist(Model(1, "spam"))
+        self.assertEqual(manager.is_blacklisted("buy spam"),
+                         (False, None, None))
+        manager.remove_whitelist(1)
+        self.assertEqual(manager.is_blacklisted("buy spam"), (True, 1, 3600))
+        manager.add_blacklist(Model(2, "ok"))
+        self.assertEqual(manager.is_blacklisted("ok"), (True, 2, 3600))
+        manager.remove_blacklist(2)
+        self.assertEqual(manager.is_blacklisted("ok"), (False, None, None))
+        manager.set_data([], [])
+        self.assertEqual(manager.is_blacklisted("buy spam"),
+                         (False, None, None))
+
+    def test_rule_stats(self):
+        class FakeClock(object):
+            def __init__(self):
+                self.now = 0
+
+            def __call__(self):
+                self.now += 1
+                return self.now
+
+        blacklist = [
+            Model(1, "spam"),
+            Model(2, "http://example.com/*"),
+            Model(3, "never")
+        ]
+
+        manager = BlacklistManager(cache_size=0, clock=FakeClock())
+        manager.set_data(blacklist, [Model(1, "http://example.com/ok")])
+
+        manager.is_blacklisted("hello")
+        manager.is_blacklisted("spam spam")
+        manager.is_blacklisted("more spam")
+        manager.is_blacklisted("http://example.com/ok")
+
+        stats = dict((rule["id"], rule) for rule in manager.get_rule_stats())
+        self.assertEqual(stats[1]["hits"], 3)
+        self.assertEqual(stats[1]["total_time"], 3.0)
+        self.assertEqual(stats[2]["hits"], 1)
+        self.assertEqual(stats[2]["overrides"], 1)
+        self.assertEqual(stats[3]["hits"], 0)
+        self.assertEqual(stats[3]["total_time"], 0.0)
+        self.assertEqual(manager.get_line_stats()["lines"], 4)
+
+        self.assertEqual([r["id"] for r in manager.get_top_rules("hot", 2)],
+                         [1, 2])
+        self.assertEqual([r["id"] for r in manager.get_top_rules("cold", 1)],
+                         [3])
+
+        manager.remove_blacklist(1)
+        self.assertEqual([r["id"] for r in manager.get_rule_stats()], [2, 3])
+
+    def test_incremental_updates(self):
+        manager = BlacklistManager(cache_size=10)
+        manager.set_data([Model(1, "spam"), Model(2, "eggs")],
+                         [Model(1, "spam*ok")])
+
+        assert manager.is_blacklisted("spam")[0] is True
+        assert manager.is_blacklisted("spamisok")[0] is False
+
+        # IDs from the chat are strings
+        assert manager.remove_blacklist("1") is True
+        assert manager.remove_blacklist("1") is False
+        assert manager.remove_blacklist("foo") is False
+        assert manager.is_blacklisted("spam")[0] is False
+        self.assertEqual([rule.id for rule in manager.blacklist], [2])
+
+        manager.add_blacklist(Model(3, "ham*"))
+        manager.add_blacklist(Model(4, "spam"))
+        assert manager.is_blacklisted("hamster")[0] is True
+        assert manager.is_blacklisted("spam")[0] is True
+        self.assertEqual([rule.id for rule in manager.blacklist], [2, 3, 4])
+
+        assert manager.remove_whitelist(1) is True
+        assert manager.is_blacklisted("spamisok")[0] is True
+        self.assertEqual(len(manager.whitelist), 0)
+
+        # A check that started before a change keeps using the old rules
+        snapshot = manager.blacklist_rules.snapshot
+        manager.remove_blacklist(3)
+        self.assertEqual(len(manager._get_blacklist_hits("ham", snapshot)), 1)
+        self.assertEqual(manager._get_blacklist_hits("ham"), [])
+
+    def test_stale_verdicts(self):
+        manager = BlacklistManager(cache_size=10)
+        manager.set_data([Model(1, "spam")], [])
+
+        # A verdict made with rules that have changed since is not cached
+        generation = manager.verdicts.generation
+        verdict = manager._check_line("spam")
+        manager.remove_blacklist(1)
+        manager.verdicts.put("spam", verdict, generation)
+
+        assert manager.verdicts.get("spam") is None
+        assert manager.is_blacklisted("spam")[0] is False
@@ -35,6 +35,9 @@ class FakeWrapper(object):
     def set_call_relay(self, call_relay):
         pass
 
+    def set_event_queue(self, event_queue):
+        pass
+
 
 class FakeCommandManager(object):
     def is_valid_command(self, command):
@@ -52,6 +55,12 @@ class Settings(object):
     OWNER_USERS = ["owner_user"]
     QUOTE_AUTO_SUFFIX = False
     QUOTE_AUTO_SUFFIX_TEMPLATE = " - {streamer} @ {year}-{month:02}-{day:02}"
+    INBOUND_BATCH_SIZE = 50
+    MOD_STATUS_CACHE_TTL = 60
+    CHANNEL_THREADS = None
+    BLACKLIST_CACHE_SIZE = 1000
+    BLACKLIST_PROCESSES = None
+    BLACKLIST_PROCESS_MIN_RULES = 1000
 
 
 class BotTest(TestCase):
@@ -186,36 +195,52 @@ class BotTest(TestCase):
         # This shouldn't crash
         bot.irc_command("#tmp", "test", "ヽ༼ຈل͜ຈ༽ﾉ", ["AMENO", "ヽ༼ຈل͜ຈ༽ﾉ"], 1)
 
-    def test__is_allowed_to_run_command(self):
+    def test_command_user_levels(self):
         bot = Bot()
 
-        bot._get_user_level = Mock(return_value="user")
-        assert bot._is_allowed_to_run_command("#a", "a", "addquote") is False
-        assert bot._is_allowed_to_run_command("#a", "a", "delquote") is False
-        assert bot._is_allowed_to_run_command("#a", "a", "quote") is False
-        assert bot._is_allowed_to_run_command("#a", "a", "reg") is False
-        assert bot._is_allowed_to_run_command("#a", "a", "def") is False
-
-        bot._get_user_level = Mock(return_value="reg")
-        assert bot._is_allowed_to_run_command("#a", "a", "addquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "delquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "quote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "reg") is False
-        assert bot._is_allowed_to_run_command("#a", "a", "def") is False
-
-        bot._get_user_level = Mock(return_value="mod")
-        assert bot._is_allowed_to_run_command("#a", "a", "addquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "delquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "quote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "reg") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "def") is True
-
-        bot._get_user_level = Mock(return_value="owner")
-        assert bot._is_allowed_to_run_command("#a", "a", "addquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "delquote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "quote") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "reg") is True
-        assert bot._is_allowed_to_run_command("#a", "a", "def") is True
+        def allowed(command, user_level):
+            return bot.router.get(command).allows(user_level)
+
+        assert allowed("addquote", "user") is False
+        assert allowed("delquote", "user") is False
+        assert allowed("quote", "user") is False
+        assert allowed("reg", "user") is False
+        assert allowed("def", "user") is False
+
+        assert allowed("addquote", "reg") is True
+        assert allowed("delquote", "reg") is True
+        assert allowed("quote", "reg") is True
+        assert allowed("reg", "reg") is False
+        assert allowed("def", "reg") is False
+
+        assert allowed("addquote", "mod") is True
+        assert allowed("delquote", "mod") is True
+        assert allowed("quote", "mod") is True
+        assert allowed("reg", "mod") is True
+        assert allowed("def", "mod") is True
+
+        assert allowed("addquote", "owner") is True
+        assert allowed("delquote", "owner") is True
+        assert allowed("quote", "owner") is True
+        assert allowed("reg", "owner") is True
+        assert allowed("def", "owner") is True
+
+    def test__get_user_level_context(self):
+        settings = Settings()
+        bot = Bot(settings)
+        bot._is_mod = Mock(return_value=True)
+        bot._is_regular = Mock(return_value=False)
+
+        mod = Mock(is_mod=True)
+        user = Mock(is_mod=False)
+
+        assert bot._get_user_level("#a", "a", mod) == "mod"
+        assert bot._get_user_level("#a", "a", user) == "user"
+        assert bot._get_user_level("#a", "owner_user", user) == "owner"
+        assert bot._is_mod.called is False
+
+        assert bot._get_user_level("#a", "a") == "mod"
+        assert bot._is_mod.called is True
 
     def _delete(self, path):
         """Delete a file"""
@@ -46,6 +46,21 @@ class CommandManagerTest(TestCase):
         )
         assert retval == 6
 
+    def test_call_wrapper_cache(self):
+        chat = Chat(None, None)
+        chat.message = Mock()
+        cm = bot.commandmanager.CommandManager("#tmp", FakeBot(), chat=chat)
+
+        cm.add_command("-ul=user test_cache return 1".split(" "))
+
+        wrapper = cm._get_call_wrapper("test_cache")
+        assert cm._get_call_wrapper("test_cache") is wrapper
+
+        # Redefining the command compiles a new wrapper
+        cm.add_command("-ul=user test_cache return 2".split(" "))
+        assert "test_cache" not in cm.call_wrappers
+        assert cm._get_call_wrapper("test_cache") is not wrapper
+
     def test_simple_functions(self):
         chat = Chat(None, None)
         chat.message = Mock()
@@ -0,0 +1,102 @@
+import logging
+from threading import Event, Thread
+from unittest import TestCase
+from bot.executor import ChannelExecutor
+
+
+nullLogger = logging.getLogger('null')
+nullLogger.setLevel(999)
+
+
+class ChannelExecutorTest(TestCase):
+    """Make sure the channel executor seems sane"""
+
+    def test_order(self):
+        executor = ChannelExecutor(2, channels=["#a", "#b"],
+                                   logger=nullLogger)
+        executor.start()
+
+        results = {"#a": [], "#b": []}
+        for i in range(100):
+            for channel in ("#a", "#b"):
+                executor.submit(channel, results[channel].append, i)
+
+        def fail():
+            raise ValueError("nope")
+
+        executor.submit("#a", fail)
+        executor.stop()
+
+        self.assertEqual(results["#a"], list(range(100)))
+        self.assertEqual(results["#b"], list(range(100)))
+
+        stats = executor.get_stats()
+        self.assertEqual(stats["#a"]["handled"], 101)
+        self.assertEqual(stats["#a"]["depth"], 0)
+        self.assertEqual(stats["#b"]["queued"], 100)
+
+    def test_isolation(self):
+        executor = ChannelExecutor(2, queue_size=2, channels=["#a", "#b"],
+                                   logger=nullLogger)
+        executor.start()
+
+        blocked = Event()
+        done = Event()
+
+        try:
+            # A stuck channel does not hold up the others
+            executor.submit("#a", blocked.wait, 5)
+            executor.submit("#b", done.set)
+            assert done.wait(5)
+
+            # Its queue fills up, and more work that can be skipped is
+            # dropped
+            assert executor.try_submit("#a", lambda: None) is True
+            assert executor.try_submit("#a", lambda: None) is True
+            assert executor.try_submit("#a", lambda: None) is False
+        finally:
+            blocked.set()
+            executor.stop()
+
+        stats = executor.get_stats()
+        self.assertEqual(stats["#a"]["dropped"], 1)
+        self.assertEqual(stats["#a"]["handled"], 3)
+
+    def test_never_wait(self):
+        executor = ChannelExecutor(1, queue_size=1, channels=["#a"],
+                                   logger=nullLogger)
+        executor.start()
+
+        started = Event()
+        blocked = Event()
+        results = []
+
+        def block():
+            started.set()
+            blocked.wait(5)
+
+        try:
+            executor.submit("#a", block)
+            assert started.wait(5)
+            assert executor.try_submit("#a", results.append, 1) is True
+
+            # The queue is full, work that must not be lost is still queued
+            # right away, and doesn't take the room of the work that can be
+            # skipped
+            submitter = Thread(target=executor.submit,
+                               args=("#a", results.append, 2))
+            submitter.start()
+            submitter.join(5)
+            assert not submitter.is_alive()
+
+            assert executor.try_submit("#a", results.append, 3) is False
+            executor.submit("#a", results.append, 4)
+        finally:
+            blocked.set()
+            executor.stop()
+
+        self.assertEqual(results, [1, 2, 4])
+
+        stats = executor.get_stats()
+        self.assertEqual(stats["#a"]["dropped"], 1)
+        self.assertEqual(stats["#a"]["handled"], 4)
@@ -0,0 +1,57 @@
+from unittest import TestCase
+from bot.inbound import InboundQueue, MessageEvent
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class InboundQueueTest(TestCase):
+    """Make sure the inbound event queue works"""
+
+    def test_notify(self):
+        notified = []
+        q = InboundQueue(3, notify=lambda: notified.append(q.qsize()))
+
+        for i in range(5):
+            q.put(MessageEvent("#tmp", "foo", str(i), 0))
+
+        # Only told once about the events waiting
+        self.assertEqual(notified, [1])
+
+        batch = q.get_batch()
+        self.assertEqual([e.text for e in batch], ["0", "1", "2"])
+        self.assertEqual(notified, [1, 2])
+
+        q.put(MessageEvent("#tmp", "foo", "5", 0))
+        self.assertEqual(notified, [1, 2])
+
+        batch = q.get_batch()
+        self.assertEqual([e.text for e in batch], ["3", "4", "5"])
+        self.assertEqual(q.get_batch(), [])
+
+        q.put(MessageEvent("#tmp", "foo", "6", 0))
+        self.assertEqual(notified, [1, 2, 1])
+
+    def test_stats(self):
+        clock = FakeClock()
+        q = InboundQueue(clock=clock)
+
+        q.put(MessageEvent("#tmp", "foo", "a", 1.0))
+        q.put(MessageEvent("#tmp", "foo", "b", 2.0))
+        q.put(MessageEvent("#tmp", "foo", "c", 3.0))
+
+        clock.now = 4.0
+        q.record_handled(q.get_batch())
+
+        stats = q.get_stats()
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["received"], 3)
+        self.assertEqual(stats["handled"], 3)
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["average_lag"], 2.0)
+        self.assertEqual(stats["max_lag"], 3.0)
@@ -0,0 +1,134 @@
+import logging
+from unittest import TestCase
+from bot.ircpool import IRCConnectionPool
+from irc.bot import Channel
+from .utils import FakeSettings
+
+
+nullLogger = logging.getLogger('null')
+nullLogger.setLevel(999)
+
+
+class PoolSettings(FakeSettings):
+    CHANNELS_PER_CONNECTION = 3
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sent = []
+
+    def cap(self, *args):
+        pass
+
+    def join(self, channel):
+        self.sent.append(("join", channel))
+
+    def part(self, channel):
+        self.sent.append(("part", channel))
+
+    def privmsg(self, channel, message):
+        self.sent.append(("privmsg", channel, message))
+
+
+class IRCConnectionPoolTest(TestCase):
+    """Make sure the channels are spread over the connections sanely"""
+
+    def _get_pool(self, channels):
+        pool = IRCConnectionPool(
+            nullLogger, object(), PoolSettings(), channels
+        )
+
+        for connection in pool.connections:
+            connection.connection = FakeConnection()
+
+        return pool
+
+    def _run_scheduled(self, pool):
+        # Run the calls scheduled on the connections' IRC threads
+        for connection in pool.connections:
+            connection.reactor.process_timeout()
+
+    def test_assign(self):
+        pool = self._get_pool(["#a", "#b", "#c", "#d", "#e", "#f", "#g"])
+
+        self.assertEqual([c.channelList for c in pool.connections], [
+            ["#a", "#d", "#g"],
+            ["#b", "#e"],
+            ["#c", "#f"]
+        ])
+
+        for connection in pool.connections:
+            assert connection.queue is pool.queue
+            assert connection.rate_limits is pool.rate_limits
+
+        pool.connections[1].channels["#b"] = Channel()
+        pool.connections[1].channels["#b"].add_user("foo")
+        pool.connections[1].channels["#b"].set_mode("o", "foo")
+
+        assert pool.is_oper("#b", "foo") is True
+        self.assertEqual(list(pool.get_users("#b")), ["foo"])
+        self.assertEqual(list(pool.get_users("#c")), [])
+
+        pool._send_message("#c", "hello")
+        self.assertEqual(pool.connections[2].connection.sent, [
+            ("privmsg", "#c", "hello")
+        ])
+
+    def test_rebalance(self):
+        pool = self._get_pool(["#a", "#b", "#c", "#d"])
+        first, second = pool.connections
+
+        first.on_welcome(first.connection, None)
+
+        # The second one has not connected yet, it keeps its channels
+        self.assertEqual(second.channelList, ["#b", "#d"])
+
+        second.on_welcome(second.connection, None)
+        second.connection.sent = []
+
+        first.on_disconnect(first.connection, None)
+
+        # The join is sent from the connection's own IRC thread
+        self.assertEqual(second.connection.sent, [])
+        self._run_scheduled(pool)
+
+        self.assertEqual(first.channelList, ["#c"])
+        self.assertEqual(second.channelList, ["#b", "#d", "#a"])
+        self.assertEqual(second.connection.sent, [("join", "#a")])
+        assert pool._get_connection("#a") is second
+
+        first.connection = FakeConnection()
+        first.on_welcome(first.connection, None)
+        self._run_scheduled(pool)
+
+        self.assertEqual(first.channelList, ["#c", "#a"])
+        self.assertEqual(second.channelList, ["#b", "#d"])
+        self.assertEqual(first.connection.sent, [
+            ("join", "#c"), ("join", "#a")
+        ])
+        self.assertEqual(second.connection.sent, [
+            ("join", "#a"), ("part", "#a")
+        ])
+
+        self.assertEqual(pool.get_connection_stats(), [
+            {"connected": True, "channels": ["#c", "#a"]},
+            {"connected": True, "channels": ["#b", "#d"]}
+        ])
+
+    def test_rebalance_full(self):
+        pool = self._get_pool(["#a", "#b", "#c", "#d", "#e", "#f", "#g",
+                               "#h", "#i"])
+        first, second, third = pool.connections
+
+        for connection in pool.connections:
+            connection.on_welcome(connection.connection, None)
+
+        pool._move_channel("#c", third, first)
+        pool._move_channel("#f", third, first)
+
+        # No room for the lost channel, the others are still evened out
+        third.on_disconnect(third.connection, None)
+
+        self.assertEqual(len(first.channelList), 4)
+        self.assertEqual(len(second.channelList), 4)
+        self.assertEqual(third.channelList, ["#i"])
@@ -1,7 +1,9 @@
 import logging
 from unittest import TestCase
-from bot.ircwrapper import IRCWrapper
+from bot.inbound import InboundQueue
+from bot.ircwrapper import IRCWrapper, Task, UserContext
 from irc.bot import Channel
+from .utils import FakeSettings
 
 
 nullLogger = logging.getLogger('null')
@@ -20,27 +22,73 @@ class IRCWrapperTest(TestCase):
         assert tmp.is_oper("#tmp", "quux") is False
 
     def test_on_welcome(self):
-        expected = ["#foo", "#bar"]
+        expected = ["#foo,#bar"]
         joinList = []
 
         class FakeConnection(object):
+            def cap(self, *args):
+                pass
+
             def join(self, channel):
                 joinList.append(channel)
 
-        tmp = IRCWrapper(nullLogger, channelList=expected)
-        tmp.on_welcome(FakeConnection(), None)
+        tmp = IRCWrapper(nullLogger, channelList=["#foo", "#bar"])
+        tmp.connection = FakeConnection()
+        tmp.on_welcome(tmp.connection, None)
 
         self.assertEqual(joinList, expected)
 
+    def test_join_batch_size(self):
+        class BigBatchSettings(FakeSettings):
+            JOIN_BATCH_SIZE = 50
+
+        joinList = []
+
+        class FakeConnection(object):
+            def cap(self, *args):
+                pass
+
+            def join(self, channel):
+                joinList.append(channel)
+
+        channels = ["#{0}".format(i) for i in range(20)]
+        tmp = IRCWrapper(nullLogger, object(), BigBatchSettings(), channels)
+        tmp.connection = FakeConnection()
+        tmp.on_welcome(tmp.connection, None)
+
+        # The batch can't be larger than the join rate limit allows
+        self.assertEqual(joinList, [",".join(channels[:19])])
+
     def test_on_join(self):
+        class EventSource(object):
+            def __init__(self, nick):
+                self.nick = nick
+
         class Event(object):
-            target = "#tmp"
+            def __init__(self, nick):
+                self.target = "#tmp"
+                self.source = EventSource(nick)
+
+        class FakeConnection(object):
+            def get_nickname(self):
+                return "bot"
 
         tmp = IRCWrapper(nullLogger)
-        tmp.on_join(None, Event())
+        tmp.joins.add(["#tmp"])
 
-        # Just making sure this does not crash
-        assert True
+        tmp.on_join(FakeConnection(), Event("foobar"))
+        assert tmp.joins.is_joined("#tmp") is False
+
+        tmp.on_join(FakeConnection(), Event("bot"))
+        assert tmp.joins.is_joined("#tmp") is True
+
+        # Twitch sends the nick in lowercase, whatever the bot's name is
+        FakeConnection.get_nickname = lambda self: "Bot"
+        tmp.joins.add(["#other"])
+        event = Event("bot")
+        event.target = "#other"
+        tmp.on_join(FakeConnection(), event)
+        assert tmp.joins.is_joined("#other") is True
 
     def test_on_pubmsg(self):
         class EventSource(object):
@@ -53,16 +101,13 @@ class IRCWrapperTest(TestCase):
                 self.target = channel
                 self.source = EventSource(nick)
 
-        class FakeSettings(object):
-            QUEUE_DELAY = 1
-
         class FakeBot(object):
             data = None
 
-            def irc_command(self, *args):
+            def irc_command(self, *args, **kwargs):
                 self.data = args
 
-            def chat_message(self, *args):
+            def chat_message(self, *args, **kwargs):
                 pass
 
         bot = FakeBot()
@@ -131,3 +176,152 @@ class IRCWrapperTest(TestCase):
 
         # Just making sure this does not crash
         assert True
+
+    def test_task_merge(self):
+        a = Task("_send_message", "#tmp", "Quote #1: foo")
+        b = Task("_send_message", "#tmp", "Quote #2: bar")
+
+        merged = a.merge(b)
+        self.assertEqual(merged.args, (
+            "#tmp", "Quote #1: foo | Quote #2: bar"
+        ))
+
+        assert a.merge(Task("_send_message", "#other", "bar")) is None
+        assert a.merge(Task("_send_message", "#tmp", ".timeout foo 1")) is None
+        assert a.merge(Task("_send_message", "#tmp", "x" * 490)) is None
+
+        assert a == Task("_send_message", "#tmp", "Quote #1: foo")
+        assert a != b
+
+    def test_on_pubnotice(self):
+        class Event(object):
+            def __init__(self, text, tags=None):
+                self.target = "#tmp"
+                self.arguments = [text]
+                self.tags = tags
+
+        tmp = IRCWrapper(nullLogger, object(), FakeSettings())
+        ceiling = tmp.rate_limits["user"].rate
+
+        tmp.on_pubnotice(None, Event(
+            "Your message was not sent because you are sending messages too "
+            "quickly."
+        ))
+        tmp.on_pubnotice(None, Event(
+            "Your message was not sent because it is identical to the "
+            "previous one you sent, less than 30 seconds ago.",
+            [{"key": "msg-id", "value": "msg_duplicate"}]
+        ))
+        tmp.on_pubnotice(None, Event("This room is now in slow mode."))
+
+        stats = tmp.get_rate_limit_stats()["tiers"]["user"]
+
+        self.assertEqual(stats["rejected"], {
+            "msg_ratelimit": 1,
+            "msg_duplicate": 1
+        })
+        assert stats["rate"] < ceiling
+        self.assertEqual(stats["ceiling"], ceiling)
+
+    def test_on_userstate(self):
+        class Event(object):
+            def __init__(self, channel, tags):
+                self.target = channel
+                self.tags = [
+                    {"key": key, "value": value}
+                    for key, value in tags.items()
+                ]
+
+        tmp = IRCWrapper(nullLogger)
+
+        tmp.on_userstate(None, Event("#a", {"mod": "1", "badges": ""}))
+        tmp.on_userstate(None, Event("#b", {
+            "mod": "0", "badges": "broadcaster/1"
+        }))
+        tmp.on_userstate(None, Event("#c", {
+            "mod": "0", "badges": "subscriber/6"
+        }))
+
+        self.assertEqual(tmp.get_rate_limit_stats()["channels"], {
+            "#a": "mod",
+            "#b": "mod",
+            "#c": "user"
+        })
+
+        assert tmp._get_rate_limit("#a") is tmp.rate_limits["mod"]
+        assert tmp._get_rate_limit("#c") is tmp.rate_limits["user"]
+        assert tmp._get_rate_limit("#unknown") is tmp.rate_limits["user"]
+
+        tmp.on_userstate(None, Event("#a", {"mod": "0", "badges": ""}))
+        assert tmp._get_rate_limit("#a") is tmp.rate_limits["user"]
+
+    def test_user_context(self):
+        class EventSource(object):
+            nick = "foobar"
+
+        class Event(object):
+            def __init__(self, tags):
+                self.arguments = ["!quote"]
+                self.target = "#tmp"
+                self.source = EventSource()
+                self.tags = tags
+
+        class FakeBot(object):
+            context = None
+
+            def irc_command(self, *args, **kwargs):
+                self.context = kwargs["context"]
+                return True
+
+        bot = FakeBot()
+        tmp = IRCWrapper(nullLogger)
+        tmp.bot = bot
+
+        tmp.on_pubmsg(None, Event([
+            {"key": "badges", "value": "moderator/1,subscriber/3"},
+            {"key": "mod", "value": "1"}
+        ]), timestamp=1)
+
+        assert bot.context.is_mod is True
+        assert bot.context.is_subscriber is True
+        assert bot.context.is_vip is False
+
+        tmp.on_pubmsg(None, Event([
+            {"key": "badges", "value": "vip/1"},
+            {"key": "mod", "value": "0"}
+        ]), timestamp=1)
+
+        assert bot.context.is_mod is False
+        assert bot.context.is_vip is True
+
+        tmp.on_pubmsg(None, Event(None), timestamp=1)
+        assert bot.context is None
+
+        assert UserContext(mod=True).is_mod is True
+
+    def test_event_queue(self):
+        class EventSource(object):
+            nick = "foobar"
+
+        class Event(object):
+            arguments = ["!quote 1"]
+            target = "#tmp"
+            source = EventSource()
+            tags = [{"key": "mod", "value": "1"}]
+
+        class FakeBot(object):
+            def irc_command(self, *args, **kwargs):
+                raise AssertionError("Bot should not be called directly")
+
+        queue = InboundQueue()
+        tmp = IRCWrapper(nullLogger)
+        tmp.bot = FakeBot()
+        tmp.set_event_queue(queue)
+
+        tmp.on_pubmsg(None, Event(), timestamp=1)
+
+        event, = queue.get_batch()
+        self.assertEqual((event.channel, event.nick, event.command,
+                          event.args, event.timestamp),
+                         ("#tmp", "foobar", "quote", ["1"], 1))
+        assert event.context.is_mod is True
@@ -0,0 +1,70 @@
+import logging
+from threading import Event
+from unittest import TestCase
+from bot.moderation import ModerationPool, Rule
+
+
+nullLogger = logging.getLogger('null')
+nullLogger.setLevel(999)
+
+
+class ModerationPoolTest(TestCase):
+    """Make sure the moderation pool seems sane"""
+
+    def test_check(self):
+        pool = ModerationPool(2, logger=nullLogger)
+        pool.start()
+
+        verdicts = {"#a": [], "#b": []}
+        done = Event()
+
+        def check(channel, line):
+            def callback(verdict):
+                verdicts[channel].append(verdict)
+                if len(verdicts["#a"]) + len(verdicts["#b"]) == 5:
+                    done.set()
+
+            assert pool.check(channel, line, callback) is True
+
+        try:
+            pool.set_rules("#a", [Rule(1, "spam", "1m")], [])
+            pool.set_rules("#b", [Rule(1, "eggs", "10s")],
+                           [Rule(1, "eggsok")])
+            check("#a", "spam")
+            check("#b", "eggsok")
+
+            # The lines are checked against the rules when they were sent
+            pool.remove_blacklist("#a", "1")
+            pool.add_blacklist("#a", Rule(2, "ham", "1h"))
+            check("#a", "spam")
+            check("#a", "ham")
+            pool.remove_whitelist("#b", 1)
+            check("#b", "eggsok")
+
+            assert done.wait(10)
+        finally:
+            pool.stop()
+
+        self.assertEqual(verdicts["#a"], [
+            (True, 1, 60), (False, None, None), (True, 2, 3600)
+        ])
+        self.assertEqual(verdicts["#b"], [
+            (False, None, None), (True, 1, 10)
+        ])
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["channels"], 2)
+        self.assertEqual(stats["checked"], 5)
+        self.assertEqual(stats["pending"], 0)
+
+    def test_refuse(self):
+        # Not started, so nothing takes the lines off the queue
+        pool = ModerationPool(1, queue_size=1, logger=nullLogger)
+        pool.shards["#a"] = pool.queues[0]
+
+        assert pool.check("#a", "spam", lambda verdict: None) is True
+        assert pool.check("#a", "spam", lambda verdict: None) is False
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["refused"], 1)
+        self.assertEqual(stats["pending"], 1)
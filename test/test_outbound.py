@@ -0,0 +1,298 @@
+from unittest import TestCase
+from bot.outbound import TokenBucket, AdaptiveTokenBucket, OutboundQueue, \
+    JoinScheduler, PRIORITY_MODERATION, PRIORITY_COMMAND, PRIORITY_CUSTOM
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(TestCase):
+    """Make sure the outbound rate limiting works"""
+
+    def test_burst(self):
+        clock = FakeClock()
+        bucket = TokenBucket.for_limit(20, 30, 5, clock=clock)
+
+        for i in range(5):
+            assert bucket.consume() is True
+
+        assert bucket.consume() is False
+        assert bucket.delay() == 2.0
+
+        clock.now = 2.0
+        assert bucket.consume() is True
+        assert bucket.consume() is False
+
+    def test_window_limit(self):
+        clock = FakeClock()
+        bucket = TokenBucket.for_limit(20, 30, 5, clock=clock)
+
+        sent = 0
+        while clock.now <= 30:
+            if bucket.consume():
+                sent += 1
+            else:
+                clock.now += bucket.delay()
+
+        self.assertEqual(sent, 20)
+
+    def test_refill_cap(self):
+        clock = FakeClock()
+        bucket = TokenBucket(3, 1, clock=clock)
+
+        clock.now = 1000
+        assert bucket.consume(3) is True
+        assert bucket.consume() is False
+
+    def test_invalid_burst(self):
+        self.assertRaises(ValueError, TokenBucket.for_limit, 20, 30, 20)
+        self.assertRaises(ValueError, TokenBucket.for_limit, 20, 30, 0)
+
+    def test_adaptive_rate(self):
+        clock = FakeClock()
+        bucket = AdaptiveTokenBucket.for_limit(20, 30, 5, clock=clock)
+        ceiling = bucket.rate
+
+        bucket.reject("msg_ratelimit")
+        bucket.reject("msg_ratelimit")
+        bucket.reject("msg_duplicate")
+
+        self.assertEqual(bucket.rate, ceiling / 4)
+        assert bucket.consume() is False
+
+        clock.now = 30
+        bucket.consume()
+        self.assertEqual(bucket.rate, ceiling * 0.35)
+
+        clock.now = 1000
+        bucket.consume()
+        self.assertEqual(bucket.rate, ceiling)
+
+        for i in range(10):
+            bucket.reject("msg_ratelimit")
+        self.assertEqual(bucket.rate, ceiling / 10)
+
+        self.assertEqual(bucket.get_stats()["rejected"], {
+            "msg_ratelimit": 12,
+            "msg_duplicate": 1
+        })
+
+
+class OutboundQueueTest(TestCase):
+    """Make sure the outbound queue priority lanes work"""
+
+    def test_priority_order(self):
+        q = OutboundQueue()
+        q.put("custom1", PRIORITY_CUSTOM)
+        q.put("reply1", PRIORITY_COMMAND)
+        q.put("custom2", PRIORITY_CUSTOM)
+        q.put("timeout1", PRIORITY_MODERATION)
+        q.put("reply2", PRIORITY_COMMAND)
+
+        result = [q.get() for i in range(5)]
+
+        self.assertEqual(result, [
+            "timeout1", "reply1", "reply2", "custom1", "custom2"
+        ])
+
+    def test_close(self):
+        q = OutboundQueue()
+        q.put("reply")
+        q.close()
+
+        assert q.get() is None
+
+    def test_stats(self):
+        clock = FakeClock()
+        q = OutboundQueue(clock=clock)
+        q.put("timeout", PRIORITY_MODERATION)
+        q.put("custom1", PRIORITY_CUSTOM)
+        q.put("custom2", PRIORITY_CUSTOM)
+
+        clock.now = 3.0
+        q.get()
+        q.get()
+
+        stats = q.get_stats()
+
+        self.assertEqual(stats["moderation"]["sent"], 1)
+        self.assertEqual(stats["moderation"]["max_wait"], 3.0)
+        self.assertEqual(stats["custom"]["queued"], 2)
+        self.assertEqual(stats["custom"]["sent"], 1)
+        self.assertEqual(stats["custom"]["depth"], 1)
+        self.assertEqual(stats["command"]["queued"], 0)
+
+    def test_round_robin(self):
+        q = OutboundQueue()
+        for i in range(3):
+            q.put("a{0}".format(i), channel="#a")
+        q.put("b0", channel="#b")
+        q.put("c0", channel="#c")
+        q.put("b1", channel="#b")
+
+        result = [q.get() for i in range(6)]
+
+        self.assertEqual(result, ["a0", "b0", "c0", "a1", "b1", "a2"])
+
+    def test_max_depth(self):
+        q = OutboundQueue(max_depth=2)
+        for i in range(4):
+            q.put("a{0}".format(i), PRIORITY_CUSTOM, "#a")
+            q.put("t{0}".format(i), PRIORITY_MODERATION, "#a")
+        q.put("b0", PRIORITY_CUSTOM, "#b")
+
+        self.assertEqual(q.channel_depth("#a"), 6)
+        self.assertEqual(q.channel_depth("#b"), 1)
+
+        result = [q.get() for i in range(7)]
+
+        self.assertEqual(result, [
+            "t0", "t1", "t2", "t3", "a2", "b0", "a3"
+        ])
+
+        stats = q.get_stats()
+        self.assertEqual(stats["custom"]["dropped"], 2)
+        self.assertEqual(stats["moderation"]["dropped"], 0)
+
+    def test_acquire(self):
+        q = OutboundQueue()
+        q.put("a0", PRIORITY_CUSTOM, "#a")
+        q.put("t0", PRIORITY_MODERATION, "#a")
+        q.put("b0", PRIORITY_CUSTOM, "#b")
+        q.put("b1", PRIORITY_CUSTOM, "#b")
+
+        ready = {"#a": False, "#b": True}
+        asked = []
+
+        def acquire(channel):
+            asked.append(channel)
+            if ready[channel]:
+                return 0
+            return 0.01
+
+        self.assertEqual(q.get(acquire), "b0")
+        self.assertEqual(q.get(acquire), "b1")
+        self.assertEqual(asked, ["#a", "#a", "#b", "#a", "#a", "#b"])
+
+        self.assertEqual(q.poll(acquire), (None, 0.01))
+
+        ready["#a"] = True
+        self.assertEqual([q.get(acquire), q.get(acquire)], ["t0", "a0"])
+        self.assertEqual(q.poll(acquire), (None, None))
+
+
+class OutboundPipelineTest(TestCase):
+    """Make sure expiry, duplicate removal and merging work"""
+
+    def test_ttl(self):
+        clock = FakeClock()
+        q = OutboundQueue(ttl=60, clock=clock)
+        q.put("old", PRIORITY_COMMAND, "#a")
+        q.put("timeout", PRIORITY_MODERATION, "#a")
+
+        clock.now = 30
+        q.put("new", PRIORITY_COMMAND, "#a")
+
+        clock.now = 61
+        self.assertEqual([q.get(), q.get()], ["timeout", "new"])
+        self.assertEqual(q.get_stats()["command"]["expired"], 1)
+
+    def test_duplicates(self):
+        clock = FakeClock()
+        q = OutboundQueue(duplicate_window=30, clock=clock)
+        q.put("hello", PRIORITY_CUSTOM, "#a")
+        q.put("hello", PRIORITY_CUSTOM, "#a")
+        q.put("hello", PRIORITY_CUSTOM, "#b")
+        q.put("timeout", PRIORITY_MODERATION, "#a")
+        q.put("timeout", PRIORITY_MODERATION, "#a")
+
+        clock.now = 31
+        q.put("hello", PRIORITY_CUSTOM, "#a")
+
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(q.get_stats()["custom"]["duplicates"], 1)
+
+    def test_merge(self):
+        def merge(a, b):
+            if len(a) + len(b) > 5:
+                return None
+            return a + b
+
+        q = OutboundQueue(merge=merge)
+        for text in ("a", "b", "c", "defg", "h"):
+            q.put(text, PRIORITY_CUSTOM, "#a")
+        q.put("x", PRIORITY_CUSTOM, "#b")
+        q.put("t", PRIORITY_MODERATION, "#a")
+        q.put("u", PRIORITY_MODERATION, "#a")
+
+        result = [q.get() for i in range(5)]
+
+        self.assertEqual(result, ["t", "u", "abc", "x", "defgh"])
+        self.assertEqual(q.qsize(), 0)
+        self.assertEqual(q.get_stats()["custom"]["merged"], 3)
+
+
+class JoinSchedulerTest(TestCase):
+    """Make sure the channels are joined in sane batches"""
+
+    def test_batches(self):
+        clock = FakeClock()
+        joins = JoinScheduler(
+            TokenBucket.for_limit(20, 10, 10, clock=clock), batch_size=4,
+            clock=clock
+        )
+        channels = ["#c{0}".format(i) for i in range(15)]
+        joins.add(channels)
+
+        batches = []
+        while clock.now < 10:
+            batch, wait = joins.poll()
+            if batch:
+                batches.append(batch)
+            clock.now += wait
+
+        self.assertEqual([len(batch) for batch in batches],
+                         [4, 4, 2, 1, 1, 1, 1, 1])
+        self.assertEqual(sum(batches, []), channels)
+
+    def test_line_length(self):
+        joins = JoinScheduler(TokenBucket(100, 1), batch_size=100)
+        joins.add(["#" + "x" * 99 + str(i) for i in range(10)])
+
+        batch, wait = joins.poll()
+        self.assertEqual(len(batch), 4)
+        assert len("JOIN " + ",".join(batch)) <= 510
+
+    def test_retry(self):
+        clock = FakeClock()
+        joins = JoinScheduler(TokenBucket(10, 1, clock), retry_delay=30,
+                              max_attempts=2, clock=clock)
+        joins.add(["#a", "#b", "#c"])
+        joins.record_activity("#b")
+        joins.record_activity("#b")
+        joins.record_activity("#c")
+
+        self.assertEqual(joins.poll(), (["#b", "#c", "#a"], 30))
+
+        joins.confirm("#b")
+        clock.now = 30
+        self.assertEqual(joins.poll(), (["#c", "#a"], 30))
+
+        joins.confirm("#c")
+        clock.now = 60
+        self.assertEqual(joins.poll(), ([], None))
+
+        stats = joins.get_stats()
+        self.assertEqual(stats["joined"], 2)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["failed"], ["#a"])
+
+        # Reconnecting starts over, busiest channels first
+        joins.reset()
+        joins.add(["#a", "#b", "#c"])
+        self.assertEqual(joins.poll()[0], ["#b", "#c", "#a"])
@@ -0,0 +1,86 @@
+from unittest import TestCase
+from bot.router import CommandRouter
+from bot.utils import ArgumentParser
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        self.now += 1
+        return self.now
+
+
+class CommandRouterTest(TestCase):
+    """Make sure the command router seems sane"""
+
+    def test_routes(self):
+        router = CommandRouter()
+        calls = []
+
+        def handler(channel, nick, args):
+            calls.append((channel, nick, args))
+            return u"done"
+
+        router.add(u"foo", handler, "reg")
+
+        assert u"foo" in router
+        assert u"bar" not in router
+        assert router.get(u"bar") is None
+
+        route = router.get(u"foo")
+        assert route.allows("user") is False
+        assert route.allows("reg") is True
+        assert route.allows("owner") is True
+
+        self.assertEqual(router.run(route, "#a", "b", ["c"]), u"done")
+        self.assertEqual(calls, [("#a", "b", ["c"])])
+
+        router.remove(u"foo")
+        assert u"foo" not in router
+        self.assertRaises(ValueError, router.add, u"foo", handler, "admin")
+
+    def test_parser(self):
+        router = CommandRouter()
+
+        parser = ArgumentParser(prog="!foo")
+        parser.add_argument("number", type=int)
+
+        router.add(u"foo", lambda channel, nick, options: options.number * 2,
+                   "user", parser)
+
+        self.assertEqual(router.run(router.get(u"foo"), "#a", "b", ["21"]),
+                         42)
+
+    def test_stats(self):
+        router = CommandRouter(clock=FakeClock())
+
+        def fail(channel, nick, args):
+            raise ValueError("nope")
+
+        router.add(u"foo", lambda channel, nick, args: None)
+        router.add(u"fail", fail)
+
+        router.run(router.get(u"foo"), "#a", "b", [])
+        router.run(router.get(u"foo"), "#a", "b", [])
+        router.deny("#a", u"foo")
+        self.assertRaises(ValueError, router.run, router.get(u"fail"), "#a",
+                          "b", [])
+        router.timed("#a", u"custom", lambda: None)
+        router.timed("#b", u"custom", lambda: None)
+        router.timed("#b", u"custom", lambda: None)
+
+        stats = router.get_stats()
+        self.assertEqual(stats["#a"][u"foo"], {
+            "calls": 2,
+            "denied": 1,
+            "errors": 0,
+            "total_time": 2.0,
+            "average_time": 1.0
+        })
+        self.assertEqual(stats["#a"][u"fail"]["errors"], 1)
+
+        # Custom commands of different channels are kept apart
+        self.assertEqual(stats["#a"][u"custom"]["calls"], 1)
+        self.assertEqual(stats["#b"][u"custom"]["calls"], 2)
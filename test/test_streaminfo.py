@@ -0,0 +1,74 @@
+from datetime import datetime
+from threading import Event
+from unittest import TestCase
+from bot.streaminfo import StreamInfo, StreamInfoCache
+
+
+class StreamInfoTest(TestCase):
+    """Make sure the stream info cache seems sane"""
+
+    def test_stream_info(self):
+        info = StreamInfo("#foo", {
+            "game": "Tetris",
+            "viewers": 10,
+            "created_at": "2015-01-02T03:04:05Z"
+        }, fetched=1)
+
+        assert info.online is True
+        assert info.error is None
+        self.assertEqual(info.game, "Tetris")
+        self.assertEqual(info.viewers, 10)
+        self.assertEqual(info.created_at, datetime(2015, 1, 2, 3, 4, 5))
+
+        info = StreamInfo("#foo", None, fetched=1)
+        assert info.online is False
+        assert info.error is None
+
+        info = StreamInfo("#foo", {"game": "Tetris"}, fetched=1)
+        assert info.online is False
+        assert isinstance(info.error, KeyError)
+
+    def test_request(self):
+        fetched = []
+
+        def fetch(channel):
+            fetched.append(channel)
+            if channel == "#bad":
+                raise ValueError("nope")
+
+            return {"game": "Tetris", "created_at": "2015-01-02T03:04:05Z"}
+
+        cache = StreamInfoCache(fetch, [], interval=60, max_age=120)
+        cache.start()
+
+        try:
+            done = Event()
+            results = []
+
+            def callback(info):
+                results.append(info)
+                done.set()
+
+            assert cache.request("#foo", callback) is None
+            assert done.wait(5)
+            self.assertEqual(results[0].game, "Tetris")
+
+            # Fresh enough now, no need to wait
+            info = cache.request("#foo", callback)
+            self.assertEqual(info.game, "Tetris")
+            self.assertEqual(fetched, ["#foo"])
+
+            done.clear()
+            assert cache.request("#bad", callback) is None
+            assert done.wait(5)
+            assert isinstance(results[1].error, ValueError)
+
+            self.assertEqual(cache.get_stats(), {
+                "channels": 2,
+                "hits": 1,
+                "misses": 2,
+                "fetches": 2,
+                "errors": 1
+            })
+        finally:
+            cache.stop()
@@ -0,0 +1,63 @@
+from unittest import TestCase
+from bot.usercache import UserLevelCache
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class UserLevelCacheTest(TestCase):
+    """Make sure the user level cache seems sane"""
+
+    def test_regulars(self):
+        cache = UserLevelCache()
+
+        assert cache.is_regular("#foo", "bar") is None
+
+        cache.set_regulars("#foo", ["bar"])
+        cache.add_regular("#foo", "baz")
+        cache.add_regular("#other", "baz")
+
+        assert cache.is_regular("#foo", "bar") is True
+        assert cache.is_regular("#foo", "baz") is True
+        assert cache.is_regular("#other", "baz") is None
+
+        cache.remove_regular("#foo", "bar")
+        assert cache.is_regular("#foo", "bar") is False
+
+        stats = cache.get_stats()
+        self.assertEqual(stats["regulars"], 1)
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 2))
+
+    def test_mods(self):
+        clock = FakeClock()
+        cache = UserLevelCache(mod_ttl=60, clock=clock)
+
+        cache.set_mod("#foo", "bar", True)
+        cache.set_mod("#foo", "baz", False)
+
+        clock.now = 30
+        assert cache.is_mod("#foo", "bar") is True
+        assert cache.is_mod("#foo", "baz") is False
+        assert cache.is_mod("#other", "bar") is None
+
+        cache.set_mod("#foo", "baz", True)
+
+        clock.now = 60
+        assert cache.is_mod("#foo", "bar") is None
+        assert cache.is_mod("#foo", "baz") is True
+
+        # Old entries are dropped when new ones are added
+        clock.now = 100
+        cache.set_mod("#foo", "new", False)
+        self.assertEqual(cache.get_stats()["mods"], 1)
+
+    def test_mods_disabled(self):
+        cache = UserLevelCache(mod_ttl=None)
+
+        cache.set_mod("#foo", "bar", True)
+        assert cache.is_mod("#foo", "bar") is None
@@ -1,4 +1,5 @@
 import bot.utils
+from threading import Thread
 from unittest import TestCase
 
 class UtilsTest(TestCase):
@@ -16,3 +17,95 @@ class UtilsTest(TestCase):
 
         output = bot.utils.human_readable_time(seconds)
         assert output == expected
+
+    def test_call_relay(self):
+        class Target(object):
+            def __init__(self):
+                self.values = []
+
+            def double(self, value):
+                return value * 2
+
+            def store(self, value):
+                self.values.append(value)
+                return value
+
+            def fail(self):
+                raise ValueError("nope")
+
+        target = Target()
+        relay = bot.utils.ThreadCallRelay(fire_and_forget=("store",))
+        relay.set_call_object(target)
+
+        thread = Thread(target=relay.loop)
+        thread.daemon = True
+        thread.start()
+
+        results = {}
+
+        def caller(number):
+            results[number] = [relay.double(number * 10 + i)
+                               for i in range(20)]
+
+        callers = [Thread(target=caller, args=(n,)) for n in range(5)]
+        for t in callers:
+            t.start()
+        for t in callers:
+            t.join()
+
+        for number in range(5):
+            self.assertEqual(results[number], [
+                (number * 10 + i) * 2 for i in range(20)
+            ])
+
+        assert relay.store("foo") is None
+
+        future = relay.call_async("double", 21)
+        self.assertEqual(future.result(timeout=5), 42)
+
+        done = []
+        relay.call_async("double", 1).add_done_callback(done.append)
+        self.assertRaises(ValueError, relay.fail)
+
+        assert done[0].result() == 2
+        self.assertEqual(target.values, ["foo"])
+
+        relay.stop()
+        thread.join(5)
+        assert not thread.is_alive()
+
+    def test_call_relay_batch(self):
+        class Target(object):
+            def __init__(self):
+                self.calls = []
+
+            def store(self, key, value):
+                self.calls.append(("store", key, value))
+
+            def store_batch(self, calls):
+                self.calls.append(("store_batch", calls))
+
+            def get(self, key):
+                return key
+
+        target = Target()
+        relay = bot.utils.ThreadCallRelay(fire_and_forget=("store",))
+        relay.set_call_object(target)
+
+        # Queue the calls before the loop runs, so it gets them all at once
+        relay.store("a", 1)
+        relay.store("b", 2)
+        relay.store("a", 3)
+        future = relay.call_async("get", "c")
+        relay.store("d", 4)
+        relay.store("e", value=5)
+        relay.stop()
+
+        relay.loop()
+
+        self.assertEqual(future.result(timeout=5), "c")
+        self.assertEqual(target.calls, [
+            ("store_batch", [("a", 1), ("b", 2), ("a", 3)]),
+            ("store", "d", 4),
+            ("store", "e", 5)
+        ])
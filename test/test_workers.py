@@ -0,0 +1,47 @@
+import logging
+from unittest import TestCase
+from bot.inbound import MessageEvent
+from bot.workers import WorkerPool, WorkerSettings
+
+
+nullLogger = logging.getLogger('null')
+nullLogger.setLevel(999)
+
+
+class Settings(object):
+    CHANNEL_LIST = {
+        "#a": "A",
+        "#b": "B",
+        "#c": "C"
+    }
+    WORKER_PROCESSES = 2
+    USER = "bot"
+
+
+class WorkersTest(TestCase):
+    """Make sure the channels are split between the workers sanely"""
+
+    def test_settings(self):
+        settings = WorkerSettings(Settings(), ["#b"])
+
+        self.assertEqual(settings.CHANNEL_LIST, {"#b": "B"})
+        self.assertEqual(settings.USER, "bot")
+
+    def test_routing(self):
+        pool = WorkerPool(Settings(), nullLogger)
+
+        self.assertEqual([w.channels for w in pool.workers], [
+            ["#a", "#c"],
+            ["#b"]
+        ])
+
+        event = MessageEvent("#c", "foo", "hello", 1)
+        pool.put(event)
+        pool.put(MessageEvent("#unknown", "foo", "hello", 1))
+
+        self.assertEqual(pool.workers[0].events.get(timeout=5).text, "hello")
+        assert pool.workers[1].events.empty()
+
+        settings = Settings()
+        settings.WORKER_PROCESSES = 10
+        self.assertEqual(len(WorkerPool(settings, nullLogger).workers), 3)
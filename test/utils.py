@@ -0,0 +1,17 @@
+class FakeSettings(object):
+    """The settings the IRC wrappers need, subclass to change them"""
+
+    RATE_LIMIT_MESSAGES = 20
+    RATE_LIMIT_PERIOD = 30
+    RATE_LIMIT_BURST = 5
+    RATE_LIMIT_MOD_MESSAGES = 100
+    RATE_LIMIT_MOD_BURST = 20
+    OUTBOUND_CHANNEL_QUEUE_SIZE = 20
+    OUTBOUND_MESSAGE_TTL = 60
+    OUTBOUND_DUPLICATE_WINDOW = 30
+    OUTBOUND_COALESCE = True
+    JOIN_RATE_LIMIT_JOINS = 20
+    JOIN_RATE_LIMIT_PERIOD = 10
+    JOIN_BATCH_SIZE = 10
+    JOIN_RETRY_DELAY = 30
+    JOIN_MAX_ATTEMPTS = 3